@@ -17,7 +17,8 @@ a = Analysis(
     pathex=[],
     binaries=binaries,
     datas=datas,
-    hiddenimports=[],
+    # main.py imports these through lazy_import (importlib), which the analyser can't follow
+    hiddenimports=['yt_dlp', 'pytubefix'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,414 @@
+"""End-to-end latency / throughput benchmark against a local media stand-in.
+
+Starts the API server (uvicorn, in its own process and temp dir) and a local
+HTTP server with synthetic MP4, M4A and HLS assets, so yt-dlp's generic
+extractor does the work and nothing touches YouTube. Then drives
+/video/info, /video/download, /video/file and /video/download_link at each
+concurrency level and reports p50/p95/p99 latency, time to first byte,
+throughput, peak RSS of the server and its children (per concurrent
+request), and the peak number of child processes. Results are written as
+JSON; --compare prints the change against an earlier run.
+
+    python bench_e2e.py
+    python bench_e2e.py --concurrency 1 4 16 --requests 32 --size-mb 16
+    python bench_e2e.py --compare bench_e2e_20250101-120000.json
+
+With ffmpeg on PATH the assets are real H.264/AAC media; without it they
+are random bytes with the right extensions, which the downloaders don't
+mind. Server settings come from the environment as usual (STREAM_WORKERS,
+PIPE_MUX, ...). RSS and process counts need Linux /proc.
+"""
+import argparse
+import http.server
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).parent.resolve()
+CHUNK_SIZE = 64 * 1024
+SCENARIOS = ("info", "download", "file", "download_link")
+
+# --- Media stand-in ---
+
+class MediaHandler(http.server.SimpleHTTPRequestHandler):
+    """Static files with single byte-range support (the segmented fetchers need it)."""
+    rate = 0  # bytes per second per connection, 0 = unthrottled
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", self.guess_type(str(path)))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        began = time.perf_counter()
+        sent = 0
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                remaining -= len(data)
+                sent += len(data)
+                if self.rate:
+                    ahead = sent / self.rate - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+def make_media(media_dir: Path, size_mb: int, duration: int):
+    """Writes clip.mp4, audio.m4a and hls/index.m3u8. Returns whether they are real media."""
+    ffmpeg = shutil.which("ffmpeg")
+    hls_dir = media_dir / "hls"
+    hls_dir.mkdir()
+    if ffmpeg:
+        # Bitrate chosen so the MP4 comes out at roughly size_mb
+        video_kbps = max(200, size_mb * 8 * 1024 // duration - 128)
+        video = ["-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={duration}",
+                 "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}"]
+        encode = ["-c:v", "libx264", "-preset", "ultrafast", "-b:v", f"{video_kbps}k", "-c:a", "aac", "-b:a", "128k"]
+        try:
+            for args in (
+                [*video, *encode, "-movflags", "+faststart", str(media_dir / "clip.mp4")],
+                ["-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}", "-c:a", "aac", "-b:a", "128k",
+                 str(media_dir / "audio.m4a")],
+                [*video, *encode, "-f", "hls", "-hls_time", "2", "-hls_playlist_type", "vod",
+                 str(hls_dir / "index.m3u8")],
+            ):
+                subprocess.run([ffmpeg, "-y", "-loglevel", "error", *args], check=True)
+            return True
+        except subprocess.CalledProcessError as e:
+            print(f"ffmpeg failed ({e}), using synthetic bytes")
+
+    (media_dir / "clip.mp4").write_bytes(b"\x00\x00\x00\x18ftypmp42" + os.urandom(size_mb * 1024 * 1024))
+    (media_dir / "audio.m4a").write_bytes(b"\x00\x00\x00\x18ftypM4A " + os.urandom(max(1, size_mb // 8) * 1024 * 1024))
+    segments = max(1, duration // 2)
+    playlist = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    for i in range(segments):
+        (hls_dir / f"seg{i}.ts").write_bytes(os.urandom(size_mb * 1024 * 1024 // segments))
+        playlist += ["#EXTINF:2.0,", f"seg{i}.ts"]
+    playlist.append("#EXT-X-ENDLIST")
+    (hls_dir / "index.m3u8").write_text("\n".join(playlist) + "\n")
+    return False
+
+def start_media_server(media_dir: Path, rate: int):
+    handler = type("Handler", (MediaHandler,), {"rate": rate})
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), lambda *a, **kw: handler(*a, directory=str(media_dir), **kw))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# --- API server ---
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_api_server(work_dir: Path):
+    """uvicorn main:app in its own process. TMPDIR points the server-mode Downloads dir
+    (and server.log, via the cwd) into work_dir so runs don't share a store."""
+    port = free_port()
+    env = {**os.environ, "SERVER_ENV": "1", "TMPDIR": str(work_dir)}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", str(ROOT),
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=work_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API server exited with code {process.returncode} (see {work_dir / 'server.log'})")
+        try:
+            if requests.get(f"{base}/health", timeout=1).ok:
+                return process, base
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("API server did not come up within 60s")
+
+# --- Resource sampling ---
+
+def process_tree(root_pid: int):
+    """root_pid and all its descendants, from /proc."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        tree.append(pid)
+        stack.extend(children.get(pid, ()))
+    return tree
+
+def rss_bytes(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+class ResourceSampler:
+    """Samples the server's RSS (including children) and child count in the background."""
+
+    def __init__(self, pid: int, interval: float = 0.1):
+        self.pid = pid
+        self.interval = interval
+        self.supported = os.path.isdir("/proc/self")
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def sample(self):
+        tree = process_tree(self.pid)
+        return sum(rss_bytes(pid) for pid in tree), len(tree) - 1
+
+    def reset(self):
+        rss, children = self.sample() if self.supported else (0, 0)
+        with self._lock:
+            self.baseline_rss = rss
+            self.peak_rss = rss
+            self.peak_children = children
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss, children = self.sample()
+            with self._lock:
+                self.peak_rss = max(self.peak_rss, rss)
+                self.peak_children = max(self.peak_children, children)
+
+    def start(self):
+        if self.supported:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+# --- Scenarios ---
+
+def percentile(values, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 4)
+
+def timed_request(method: str, url: str, **kwargs) -> dict:
+    """Sends a request and reads the whole body, timing the first and last byte."""
+    start = time.perf_counter()
+    ttfb = None
+    size = 0
+    body = []
+    try:
+        with requests.request(method, url, stream=True, timeout=600, **kwargs) as response:
+            keep_body = "json" in response.headers.get("content-type", "")
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                size += len(chunk)
+                if keep_body:
+                    body.append(chunk)
+            ok = response.ok
+            error = None if ok else f"HTTP {response.status_code}: {b''.join(body)[:200].decode(errors='replace')}"
+    except requests.RequestException as e:
+        ok, error = False, str(e)
+    return {"ok": ok, "error": error, "latency": time.perf_counter() - start, "ttfb": ttfb, "bytes": size,
+            "json": json.loads(b"".join(body)) if ok and body else None}
+
+def run_scenario(name: str, fn, jobs, concurrency: int, sampler: ResourceSampler) -> dict:
+    sampler.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fn, jobs))
+    wall = time.perf_counter() - start
+
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in ok]
+    ttfbs = [r["ttfb"] for r in ok if r["ttfb"] is not None]
+    total_bytes = sum(r["bytes"] for r in ok)
+    extra_rss = max(0, sampler.peak_rss - sampler.baseline_rss)
+    summary = {
+        "scenario": name,
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "error_samples": sorted({r["error"] for r in results if r["error"]})[:3],
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(results) / wall, 2) if wall else None,
+        "latency": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+        "ttfb": {f"p{p}": percentile(ttfbs, p) for p in (50, 95, 99)},
+        "bytes": total_bytes,
+        "throughput_mb_s": round(total_bytes / wall / 1024 / 1024, 2) if wall else None,
+        "peak_rss_mb": round(sampler.peak_rss / 1024 / 1024, 1) if sampler.supported else None,
+        "peak_rss_per_request_mb": round(extra_rss / concurrency / 1024 / 1024, 2) if sampler.supported else None,
+        "peak_subprocesses": sampler.peak_children if sampler.supported else None,
+    }
+    return summary, results
+
+def run_level(base: str, media_base: str, concurrency: int, count: int, fmt: str, warm: bool,
+              sampler: ResourceSampler, run_id: str):
+    assets = ["clip.mp4", "audio.m4a", "hls/index.m3u8"]
+
+    def media_url(i: int) -> str:
+        # A query string per request makes every URL a metadata / store cache miss
+        url = f"{media_base}/{assets[i % len(assets)]}"
+        return url if warm else f"{url}?run={run_id}-c{concurrency}-{i}"
+
+    summaries = []
+    summary, _ = run_scenario("info", lambda i: timed_request("POST", f"{base}/video/info", json={"url": media_url(i)}),
+                              range(count), concurrency, sampler)
+    summaries.append(summary)
+
+    summary, results = run_scenario(
+        "download", lambda i: timed_request("POST", f"{base}/video/download", json={"url": media_url(i), "format": fmt}),
+        range(count), concurrency, sampler)
+    summaries.append(summary)
+    filenames = [r["json"]["data"]["filename"] for r in results if r["ok"] and r["json"]]
+
+    if filenames:
+        summary, _ = run_scenario("file", lambda name: timed_request("GET", f"{base}/video/file/{name}"),
+                                  filenames, concurrency, sampler)
+        summaries.append(summary)
+
+    # Streams get their own cache-busting ids so they aren't served from the store filled above
+    summary, _ = run_scenario(
+        "download_link",
+        lambda i: timed_request("GET", f"{base}/video/download_link", params={"url": media_url(i + count), "format": fmt}),
+        range(count), concurrency, sampler)
+    summaries.append(summary)
+    return summaries
+
+def print_summary(s: dict):
+    fmt = lambda v: "-" if v is None else f"{v:.3f}"
+    print(f"{s['scenario']:>14} x{s['concurrency']:<3} {s['requests'] - s['errors']:>4}/{s['requests']:<4} "
+          f"lat p50 {fmt(s['latency']['p50'])} p95 {fmt(s['latency']['p95'])} p99 {fmt(s['latency']['p99'])} | "
+          f"ttfb p50 {fmt(s['ttfb']['p50'])} p95 {fmt(s['ttfb']['p95'])} | "
+          f"{s['throughput_mb_s']:7.2f} MB/s | rss {s['peak_rss_mb']} MB "
+          f"(+{s['peak_rss_per_request_mb']} MB/req) | procs {s['peak_subprocesses']}")
+    for error in s["error_samples"]:
+        print(f"{'':>20}error: {error[:160]}")
+
+def print_comparison(baseline: dict, current: dict):
+    old = {(s["scenario"], s["concurrency"]): s for s in baseline["results"]}
+    print(f"\nChange vs {baseline['meta'].get('started')} ({baseline['meta'].get('commit')}):")
+    for s in current["results"]:
+        before = old.get((s["scenario"], s["concurrency"]))
+        if not before:
+            continue
+        parts = []
+        for label, key, sub in (("lat p50", "latency", "p50"), ("lat p95", "latency", "p95"), ("ttfb p50", "ttfb", "p50")):
+            a, b = before[key][sub], s[key][sub]
+            if a and b:
+                parts.append(f"{label} {(b - a) / a * 100:+.1f}%")
+        if before["throughput_mb_s"] and s["throughput_mb_s"]:
+            parts.append(f"throughput {(s['throughput_mb_s'] - before['throughput_mb_s']) / before['throughput_mb_s'] * 100:+.1f}%")
+        print(f"{s['scenario']:>14} x{s['concurrency']:<3} " + " | ".join(parts))
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--requests", type=int, default=12, help="requests per scenario and concurrency level")
+    parser.add_argument("--size-mb", type=int, default=8, help="approximate size of the MP4 / HLS assets")
+    parser.add_argument("--duration", type=int, default=20, help="media duration in seconds (real media only)")
+    parser.add_argument("--rate-mb", type=float, default=0, help="per-connection media server limit (MB/s), 0 = none")
+    parser.add_argument("--format", default="best", choices=["best", "mp4", "mp3"])
+    parser.add_argument("--warm", action="store_true", help="reuse the same URLs so caches are hit")
+    parser.add_argument("--output", help="results file (default: bench_e2e_<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    started = time.strftime("%Y%m%d-%H%M%S")
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_e2e_"))
+    media_dir = work_dir / "media"
+    media_dir.mkdir()
+    real_media = make_media(media_dir, args.size_mb, args.duration)
+    media_server, media_base = start_media_server(media_dir, int(args.rate_mb * 1024 * 1024))
+    api, base = start_api_server(work_dir)
+    sampler = ResourceSampler(api.pid)
+    sampler.start()
+    print(f"API {base}, media {media_base} ({'real' if real_media else 'synthetic'} assets, {args.size_mb} MB), "
+          f"work dir {work_dir}")
+
+    summaries = []
+    try:
+        for concurrency in args.concurrency:
+            for summary in run_level(base, media_base, concurrency, args.requests, args.format, args.warm,
+                                     sampler, started):
+                print_summary(summary)
+                summaries.append(summary)
+    finally:
+        sampler.stop()
+        api.terminate()
+        try:
+            api.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            api.kill()
+        media_server.shutdown()
+
+    report = {
+        "meta": {
+            "started": started,
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "real_media": real_media,
+            "args": vars(args),
+            "env": {k: v for k, v in os.environ.items()
+                    if re.match(r"^(STREAM|PIPE|SEGMENT|TRANSCODE|DOWNLOAD|EXTRACT|STORE|BATCH)_", k)},
+        },
+        "results": summaries,
+    }
+    output = Path(args.output or f"bench_e2e_{started}.json")
+    output.write_text(json.dumps(report, indent=2))
+    print(f"\nResults written to {output}")
+    if args.compare:
+        print_comparison(json.loads(Path(args.compare).read_text()), report)
+    shutil.rmtree(work_dir, ignore_errors=True)
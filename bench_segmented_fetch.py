@@ -0,0 +1,117 @@
+"""Sequential vs segmented fetch of a DASH-style video + audio pair.
+
+Serves two files from a local HTTP server that honours Range requests and
+throttles every connection (like a CDN limiting per-connection throughput),
+then downloads them the way download_pytube used to (video, then audio, one
+connection each) and with main.fetch_parts (both at once, split into
+segments over several connections).
+
+    python bench_segmented_fetch.py
+    python bench_segmented_fetch.py --video-mb 64 --audio-mb 8 --rate-mb 8 --connections 8
+"""
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import main
+
+class ThrottledRangeHandler(http.server.BaseHTTPRequestHandler):
+    directory = None
+    rate = 0  # bytes per second per connection
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = Path(self.directory) / self.path.lstrip("/")
+        if not path.is_file():
+            self.send_error(404)
+            return
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+        chunk = 64 * 1024
+        began = time.perf_counter()
+        sent = 0
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(chunk, remaining))
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                remaining -= len(data)
+                sent += len(data)
+                # Sleep until we are back under the per-connection rate
+                ahead = sent / self.rate - (time.perf_counter() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+def start_server(media_dir: Path, rate: int):
+    handler = type("Handler", (ThrottledRangeHandler,), {"directory": str(media_dir), "rate": rate})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def sha1(path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def run_sequential(parts):
+    for part in parts:
+        main.fetch_parts([part], connections=1)
+
+def run_segmented(parts, connections):
+    main.fetch_parts(parts, connections=connections)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--video-mb", type=int, default=32)
+    parser.add_argument("--audio-mb", type=int, default=4)
+    parser.add_argument("--rate-mb", type=float, default=8, help="per-connection throughput limit (MB/s)")
+    parser.add_argument("--connections", type=int, default=main.SEGMENT_CONNECTIONS)
+    args = parser.parse_args()
+
+    media_dir = Path(tempfile.mkdtemp(prefix="bench_segments_"))
+    out_dir = Path(tempfile.mkdtemp(prefix="bench_segments_out_"))
+    sources = {"video.mp4": args.video_mb, "audio.m4a": args.audio_mb}
+    for name, mb in sources.items():
+        (media_dir / name).write_bytes(os.urandom(mb * 1024 * 1024))
+
+    server, base = start_server(media_dir, int(args.rate_mb * 1024 * 1024))
+    parts = [(f"{base}/{name}", (media_dir / name).stat().st_size, str(out_dir / name)) for name in sources]
+    print(f"video {args.video_mb} MB + audio {args.audio_mb} MB, {args.rate_mb} MB/s per connection, "
+          f"segments of {main.SEGMENT_SIZE // (1024 * 1024)} MB")
+
+    results = {}
+    for label, fn in (("sequential", lambda: run_sequential(parts)),
+                      (f"segmented x{args.connections}", lambda: run_segmented(parts, args.connections))):
+        start = time.perf_counter()
+        fn()
+        results[label] = time.perf_counter() - start
+        for name in sources:
+            assert sha1(out_dir / name) == sha1(media_dir / name), f"{label}: {name} corrupted"
+        print(f"{label:>15}: {results[label]:6.2f} s")
+
+    times = list(results.values())
+    print(f"speedup: {times[0] / times[1]:.2f}x")
+    server.shutdown()
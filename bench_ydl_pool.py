@@ -0,0 +1,83 @@
+"""Cold vs warm yt-dlp extraction latency.
+
+Compares building a new yt_dlp.YoutubeDL for every extraction (the old
+behaviour) with checking one out of main.ydl_pool. By default it extracts a
+small file from a local HTTP server, so only the per-instance setup cost is
+measured; pass --url to benchmark a real site instead.
+
+    python bench_ydl_pool.py --runs 20
+    python bench_ydl_pool.py --url "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+"""
+import argparse
+import functools
+import http.server
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import yt_dlp
+
+import main
+
+OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'nocheckcertificate': True,
+    'socket_timeout': 30,
+}
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def start_local_server():
+    media_dir = Path(tempfile.mkdtemp(prefix="bench_ydl_"))
+    (media_dir / "clip.mp4").write_bytes(b"\x00\x00\x00\x18ftypmp42" + b"\x00" * 64 * 1024)
+    handler = functools.partial(QuietHandler, directory=str(media_dir))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/clip.mp4"
+
+def extract_cold(url):
+    with yt_dlp.YoutubeDL(dict(OPTS)) as ydl:
+        return ydl.extract_info(url, download=False)
+
+def extract_warm(url):
+    with main.ydl_pool.checkout(dict(OPTS)) as ydl:
+        return ydl.extract_info(url, download=False)
+
+def measure(fn, url, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(url)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def report(name, timings):
+    print(f"{name:>5}: median {statistics.median(timings):8.1f} ms | "
+          f"mean {statistics.mean(timings):8.1f} ms | min {min(timings):8.1f} ms | max {max(timings):8.1f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="URL to extract (default: local test file)")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if not url:
+        server, url = start_local_server()
+
+    print(f"Extracting {url} {args.runs} times each...")
+    # Warm-up so that the first measured run doesn't pay for imports / regex compilation
+    extract_cold(url)
+
+    report("cold", measure(extract_cold, url, args.runs))
+    report("warm", measure(extract_warm, url, args.runs))
+    print(f"Pool: {main.ydl_pool.stats()}")
+
+    if server:
+        server.shutdown()
@@ -1,10 +1,10 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+import time
+STARTED_AT = time.perf_counter()  # import/startup timings are reported at /debug/toolchain
+
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from pydantic import BaseModel, HttpUrl
-import yt_dlp
-from pytubefix import YouTube
-from pytubefix.cli import on_progress
 import os
 import uuid
 from pathlib import Path
@@ -12,25 +12,208 @@ from typing import Optional, List
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import logging
+import logging.handlers
+import queue
+import contextvars
+import atexit
 import shutil
 import subprocess
+import threading
+import json
+import copy
+import re
+import functools
+import importlib
+import contextlib
+import hashlib
+import itertools
+import heapq
+import random
+import struct
+import zlib
+from collections import OrderedDict, deque
 
 import sys
 import tempfile
-from urllib.parse import quote
+import urllib.request
+from urllib.parse import quote, urlsplit, urlunsplit, parse_qsl, urlencode
+from email.utils import formatdate, parsedate_to_datetime
+
+from stream_worker import StreamWorkerPool, StreamWorkerError
 
 # Configure logging to file and console
+# Log calls only put the record on a queue; formatting (tracebacks included)
+# and the file/console writes happen on a QueueListener thread, off the event
+# loop. server.log holds one JSON object per line, with the id of the request
+# or job a record belongs to, and rotates by size. Records that repeat on hot
+# paths carry a sample_key and are rate-limited per key (see LogSampler).
 log_file_path = Path.cwd() / "server.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(log_file_path, encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("LOG_BACKUPS", "5"))
+LOG_CONSOLE_FORMAT = os.environ.get("LOG_CONSOLE_FORMAT", "text")  # text | json
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_BURST = int(os.environ.get("LOG_SAMPLE_BURST", "5"))  # records per sample_key per window
+LOG_SAMPLE_WINDOW = float(os.environ.get("LOG_SAMPLE_WINDOW", "10"))
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+job_id_var = contextvars.ContextVar("job_id", default=None)
+phase_timings_var = contextvars.ContextVar("phase_timings", default=None)
+
+def record_phase(phase: str, seconds: float):
+    """Adds a phase duration to the access log record of the current request."""
+    timings = phase_timings_var.get()
+    if timings is not None:
+        timings[phase] = round(timings.get(phase, 0.0) + seconds, 3)
+
+# Record attributes that aren't extras (color_message: uvicorn's ANSI copy of msg)
+LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName", "sample_key", "color_message"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class LogContextFilter(logging.Filter):
+    """Stamps records with the request/job id of the code that logged them."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.job_id = job_id_var.get()
+        return True
+
+class LogSampler(logging.Filter):
+    """Lets `burst` records per sample_key through every `window` seconds. The first record
+    of the next window carries how many were suppressed. Warnings and errors always pass."""
+
+    def __init__(self, burst: int, window: float):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._windows = {}  # sample_key -> [window start, passed, suppressed]
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = getattr(record, "sample_key", None)
+        if key is None or record.levelno >= logging.WARNING or self.burst <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            state = self._windows.get(key)
+            if state is None or now - state[0] >= self.window:
+                if state is not None and state[2]:
+                    record.suppressed = state[2]
+                if len(self._windows) > 1000:
+                    self._windows = {k: v for k, v in self._windows.items() if now - v[0] < self.window}
+                state = self._windows[key] = [now, 0, 0]
+            if state[1] >= self.burst:
+                state[2] += 1
+                self.suppressed += 1
+                return False
+            state[1] += 1
+            return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks or raises on a full queue (the record is counted and dropped), and leaves
+    traceback formatting to the listener thread."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+log_file_handler = logging.handlers.RotatingFileHandler(log_file_path, maxBytes=LOG_MAX_BYTES,
+                                                        backupCount=LOG_BACKUPS, encoding='utf-8')
+log_file_handler.setFormatter(JsonFormatter())
+log_console_handler = logging.StreamHandler()
+log_console_handler.setFormatter(JsonFormatter() if LOG_CONSOLE_FORMAT == "json"
+                                 else logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+log_sampler = LogSampler(LOG_SAMPLE_BURST, LOG_SAMPLE_WINDOW)
+log_queue_handler = LogQueueHandler(log_queue)
+log_queue_handler.addFilter(LogContextFilter())
+log_queue_handler.addFilter(log_sampler)
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler, log_console_handler,
+                                              respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_queue_handler])
 logging.getLogger("multipart").setLevel(logging.WARNING)
+# `uvicorn main:app` installs its own synchronous handlers before importing the app;
+# send its records through the queue too (`python main.py` passes log_config=None so
+# uvicorn.run doesn't install them again). Its access lines are replaced by
+# RequestContextMiddleware.
+for uvicorn_logger in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+    logging.getLogger(uvicorn_logger).handlers = []
+    logging.getLogger(uvicorn_logger).propagate = True
+logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("avy.access")
+
+class RequestContextMiddleware:
+    """Gives every HTTP request an id (the client's X-Request-ID if it sent one), which its
+    log records carry, and writes one access log record per request with its phase timings."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        client_id = dict(scope.get("headers") or ()).get(b"x-request-id", b"").decode("latin-1")
+        request_id = re.sub(r"[^\w.-]", "", client_id)[:64] or uuid.uuid4().hex[:16]
+        # Not reset afterwards: each request runs in its own task context, and the
+        # server error handler, which runs outside this middleware, still sees the id
+        request_id_var.set(request_id)
+        timings = {}
+        phase_timings_var.set(timings)
+        started = time.monotonic()
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", ()), (b"x-request-id", request_id.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            extra = {"http": {"method": scope["method"], "path": scope["path"], "route": route, "status": status,
+                              "duration_ms": round((time.monotonic() - started) * 1000, 1)}}
+            if timings:
+                extra["phases"] = timings
+            if status < 400:
+                extra["sample_key"] = f"access {scope['method']} {route}"
+            access_logger.info(f"{scope['method']} {scope['path']} {status}", extra=extra)
 
 # Determine the application base path (works for Python script and PyInstaller exe)
 if getattr(sys, 'frozen', False):
@@ -49,7 +232,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
+app.add_middleware(RequestContextMiddleware)
 
 # Environment Detection (Server vs Desktop)
 IS_SERVER = os.environ.get("RAILWAY_ENVIRONMENT") or os.environ.get("RENDER") or os.environ.get("DYNO") or os.environ.get("SERVER_ENV")
@@ -67,18 +252,37 @@ DOWNLOADS_DIR.mkdir(parents=True, exist_ok=True)
 import base64
 cookies_b64 = os.environ.get("YOUTUBE_COOKIES")
 cookies_file = BASE_DIR / "cookies.txt"
+# More cookie jars (one account each) for the cookie pool: *.txt files in
+# COOKIES_DIR, plus YOUTUBE_COOKIES_<name> env vars restored into it
+COOKIES_DIR = Path(os.environ.get("COOKIES_DIR", str(BASE_DIR / "cookies")))
+# yt-dlp writes its cookie jar back to the cookie file when it closes; it is
+# handed a copy from here instead, so the jars themselves only change when
+# someone replaces them (see CookieJar.snapshot)
+COOKIE_SNAPSHOT_DIR = Path(tempfile.gettempdir()) / "avy_cookie_snapshots"
+extra_cookies_b64 = {name[len("YOUTUBE_COOKIES_"):]: value for name, value in os.environ.items()
+                     if name.startswith("YOUTUBE_COOKIES_") and value.strip()}
 
 def restore_cookies():
+    restored = False
     if cookies_b64:
         try:
             # Always try to restore/overwrite if env var is present to ensure latest cookies
             decoded = base64.b64decode(cookies_b64.strip())
             cookies_file.write_bytes(decoded)
             logger.info(f"✅ Successfully restored cookies.txt from YOUTUBE_COOKIES ({len(decoded)} bytes)")
-            return True
+            restored = True
         except Exception as e:
             logger.error(f"❌ Failed to decode YOUTUBE_COOKIES: {e}")
-    return False
+    for name, value in sorted(extra_cookies_b64.items()):
+        try:
+            decoded = base64.b64decode(value.strip())
+            COOKIES_DIR.mkdir(parents=True, exist_ok=True)
+            (COOKIES_DIR / f"env-{name.lower()}.txt").write_bytes(decoded)
+            logger.info(f"✅ Restored cookie jar env-{name.lower()}.txt from YOUTUBE_COOKIES_{name} ({len(decoded)} bytes)")
+            restored = True
+        except Exception as e:
+            logger.error(f"❌ Failed to decode YOUTUBE_COOKIES_{name}: {e}")
+    return restored
 
 # Run restoration on startup
 cookies_restored = restore_cookies()
@@ -93,6 +297,8 @@ async def debug_cookies():
         "cookies_file_exists": exists,
         "cookies_file_size": size,
         "cookies_restored_success": cookies_restored,
+        "extra_cookie_env_vars": sorted(extra_cookies_b64),
+        "pool": cookie_pool.stats(),
         "is_server": IS_SERVER,
         "base_dir": str(BASE_DIR)
     }
@@ -103,8 +309,487 @@ assets_path = BASE_DIR / "assets"
 assets_path.mkdir(exist_ok=True)
 app.mount("/assets", StaticFiles(directory=assets_path), name="assets")
 
-# Thread pool
-executor = ThreadPoolExecutor(max_workers=4)
+# --- Metrics ---
+# Prometheus text format at /metrics without a client library. Every label
+# value comes from a small fixed set (see bounded_label) so the number of
+# series stays bounded whatever URLs clients send.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+METRIC_EXTRACTORS = ("Youtube", "Facebook", "Instagram", "TikTok", "Twitter", "Vimeo", "Reddit", "Dailymotion", "generic")
+METRIC_FORMATS = ("best", "mp4", "mp3")
+METRIC_QUALITIES = ("360p", "480p", "720p", "1080p", "best")
+
+def bounded_label(value, allowed, other: str = "other") -> str:
+    return value if value in allowed else other
+
+def extractor_label(url_str: str) -> str:
+    extractor, _, _ = canonical_video_key(url_str).partition(":")
+    return bounded_label("generic" if extractor == "url" else extractor, METRIC_EXTRACTORS)
+
+def format_labels(fmt: Optional[str], quality: Optional[str]) -> dict:
+    return {"format": bounded_label(fmt or "best", METRIC_FORMATS),
+            "quality": "audio" if fmt == "mp3" else bounded_label(quality or "best", METRIC_QUALITIES)}
+
+def format_metric_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_metric_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}  # label values tuple -> value(s)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = list(self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(dict(zip(self.labelnames, key)), value))
+        return lines
+
+    def _render_series(self, labels: dict, value) -> List[str]:
+        return [f"{self.name}{format_metric_labels(labels)} {format_metric_value(value)}"]
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]  # bucket counts, sum, count
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def _render_series(self, labels: dict, series) -> List[str]:
+        counts, total, count = series
+        lines = [f"{self.name}_bucket{format_metric_labels({**labels, 'le': format_metric_value(bound)})} {n}"
+                 for bound, n in zip(self.buckets, counts)]
+        lines.append(f"{self.name}_bucket{format_metric_labels({**labels, 'le': '+Inf'})} {count}")
+        lines.append(f"{self.name}_sum{format_metric_labels(labels)} {format_metric_value(total)}")
+        lines.append(f"{self.name}_count{format_metric_labels(labels)} {count}")
+        return lines
+
+class CollectedMetric(Metric):
+    """Read at scrape time from existing stats, by a function returning [(labels, value), ...]."""
+
+    def __init__(self, name: str, help_text: str, kind: str, collect):
+        super().__init__(name, help_text)
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self.collect():
+            lines.extend(self._render_series(labels, value))
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> CounterMetric:
+        return self.register(CounterMetric(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS) -> HistogramMetric:
+        return self.register(HistogramMetric(name, help_text, labelnames, buckets))
+
+    def collected(self, name: str, help_text: str, kind: str, collect) -> CollectedMetric:
+        return self.register(CollectedMetric(name, help_text, kind, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"Failed to collect metric {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+extract_seconds = metrics.histogram(
+    "avy_extract_seconds", "yt-dlp metadata extraction time (cache misses only).", ("extractor",))
+download_seconds = metrics.histogram(
+    "avy_download_seconds", "Time to fetch a download to disk, merge included, per backend.",
+    ("backend", "format", "quality"))
+merge_seconds = metrics.histogram(
+    "avy_merge_seconds", "ffmpeg merge time of adaptive video + audio, by remux mode.", ("mode",))
+transcode_seconds = metrics.histogram(
+    "avy_transcode_seconds", "Time encoders held a transcode slot, by priority.", ("priority",))
+stream_ttfb_seconds = metrics.histogram(
+    "avy_stream_ttfb_seconds", "/video/download_link time from request to first byte, by pipeline.", ("kind",))
+stream_seconds = metrics.histogram(
+    "avy_stream_seconds", "/video/download_link total transfer time, by pipeline and outcome.", ("kind", "outcome"))
+backend_results = metrics.counter(
+    "avy_backend_results_total",
+    "Download attempts per backend: success, failure, fallback (to the other backend) or cancelled (lost a hedge).",
+    ("backend", "result", "extractor"))
+router_decisions = metrics.counter(
+    "avy_router_decisions_total", "Backend a download was sent to first, and why (default, score, explore, only).",
+    ("extractor", "backend", "reason"))
+router_hedges = metrics.counter(
+    "avy_router_hedges_total", "Hedged second attempts, by primary backend and winner (none when both failed).",
+    ("extractor", "primary", "winner"))
+bytes_served = metrics.counter(
+    "avy_bytes_served_total", "Response body bytes sent to clients; rate() gives bytes per second.", ("route",))
+subprocess_stats = {"active": 0, "started": 0}  # ffmpeg / yt-dlp children we spawn ourselves
+subprocess_lock = threading.Lock()
+
+# --- Worker pools ---
+# Quick metadata lookups, long downloads and ffmpeg merges each get their own
+# pool so that a few multi-minute downloads can't block /video/info. When a
+# pool's queue is full we fail fast with 429 instead of queueing forever.
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "4"))
+EXTRACT_QUEUE = int(os.environ.get("EXTRACT_QUEUE", "32"))
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))
+DOWNLOAD_QUEUE = int(os.environ.get("DOWNLOAD_QUEUE", "16"))
+POSTPROCESS_WORKERS = int(os.environ.get("POSTPROCESS_WORKERS", "2"))
+POSTPROCESS_QUEUE = int(os.environ.get("POSTPROCESS_QUEUE", "16"))
+
+class PoolSaturated(HTTPException):
+    """A worker pool's queue is full. Rendered as 429 with a Retry-After estimate."""
+
+    def __init__(self, pool_name: str, retry_after: int):
+        super().__init__(
+            status_code=429,
+            detail=f"Server busy ({pool_name} queue full). Please retry in {retry_after}s.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+class BoundedPool:
+    """ThreadPoolExecutor with an admission limit on queued (not yet started) tasks and wait-time stats."""
+
+    def __init__(self, name: str, workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self._wait_times = deque(maxlen=512)
+        self._run_times = deque(maxlen=512)
+
+    def submit(self, fn, *args, admit: bool = True):
+        """Queues fn(*args). With admit=False the queue limit is skipped; used for follow-up
+        work (e.g. the merge after a download) that must not fail halfway through a request."""
+        with self._lock:
+            if admit and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise PoolSaturated(self.name, self.retry_after())
+            self.queued += 1
+            self.submitted += 1
+        enqueued_at = time.monotonic()
+        context = contextvars.copy_context()  # request/job id for the task's log records
+
+        def run():
+            started_at = time.monotonic()
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self._wait_times.append(started_at - enqueued_at)
+            try:
+                return context.run(fn, *args)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+                    self._run_times.append(time.monotonic() - started_at)
+
+        future = self._executor.submit(run)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        # A future can only be cancelled before run() starts (e.g. a caller that went away
+        # cancels the wrap_future), so its queue slot would otherwise never be given back.
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, fn, *args, admit: bool = True):
+        return await asyncio.wrap_future(self.submit(fn, *args, admit=admit))
+
+    def retry_after(self) -> int:
+        """Rough time until a queue slot frees up, from recent task durations."""
+        avg_run = (sum(self._run_times) / len(self._run_times)) if self._run_times else 5.0
+        return max(1, min(120, int(avg_run * (self.queued + 1) / self.workers + 0.5)))
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._wait_times)
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "active": self.active,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "wait_p50": round(waits[len(waits) // 2], 3) if waits else 0.0,
+                "wait_p95": round(waits[int(len(waits) * 0.95)], 3) if waits else 0.0,
+                "wait_max": round(waits[-1], 3) if waits else 0.0,
+            }
+
+extract_pool = BoundedPool("extract", EXTRACT_WORKERS, EXTRACT_QUEUE)
+download_pool = BoundedPool("download", DOWNLOAD_WORKERS, DOWNLOAD_QUEUE)
+postprocess_pool = BoundedPool("postprocess", POSTPROCESS_WORKERS, POSTPROCESS_QUEUE)
+
+@app.get("/debug/pools")
+async def debug_pools():
+    """Live queue depth and wait times of the worker pools."""
+    stats = {pool.name: pool.stats() for pool in (extract_pool, download_pool, postprocess_pool)}
+    stats["youtubedl"] = ydl_pool.stats()
+    stats["connections"] = segment_connections.stats()
+    return stats
+
+# --- Transcode scheduler ---
+# Every ffmpeg run that actually encodes (mp3 extraction, transcoding merges)
+# takes a slot first. Slots are derived from the core count and each encoder
+# is capped to its share of cores, so ten mp3 requests on a 4-core box queue
+# up instead of all crawling. Interactive streams go before background
+# downloads; within a class, shorter media first.
+CPU_COUNT = os.cpu_count() or 2
+TRANSCODE_SLOTS = int(os.environ.get("TRANSCODE_SLOTS", str(max(1, CPU_COUNT // 2))))
+TRANSCODE_THREADS = int(os.environ.get("TRANSCODE_THREADS", str(max(1, CPU_COUNT // TRANSCODE_SLOTS))))
+# How long an interactive stream may wait for a slot before it is turned away with 429
+TRANSCODE_ADMIT_TIMEOUT = float(os.environ.get("TRANSCODE_ADMIT_TIMEOUT", "10"))
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+TRANSCODING_POSTPROCESSORS = {"ExtractAudio", "VideoConvertor"}  # yt-dlp pp keys that encode
+
+class TranscodeWaiter:
+    def __init__(self, priority: int, wake):
+        self.priority = priority
+        self.wake = wake
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+
+class TranscodeScheduler:
+    """Counting semaphore with a priority queue, usable from threads and from the event loop."""
+
+    def __init__(self, slots: int, threads_per_job: int):
+        self.slots = slots
+        self.threads_per_job = threads_per_job
+        self._lock = threading.Lock()
+        self._heap = []  # (priority, duration, seq, waiter)
+        self._seq = itertools.count()
+        self.running = 0
+        self.granted = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.rejected = 0  # async waits that timed out
+        self._wait_times = {name: deque(maxlen=512) for name in PRIORITY_NAMES.values()}
+
+    def ffmpeg_args(self):
+        return ["-threads", str(self.threads_per_job)]
+
+    def _enqueue(self, priority: int, duration: Optional[float], wake) -> TranscodeWaiter:
+        waiter = TranscodeWaiter(priority, wake)
+        with self._lock:
+            heapq.heappush(self._heap, (priority, duration if duration else float("inf"), next(self._seq), waiter))
+            ready = self._grant()
+        for w in ready:
+            w.wake()
+        return waiter
+
+    def _grant(self):
+        """Hands free slots to the best waiters. Caller holds the lock and wakes the result."""
+        ready = []
+        while self.running < self.slots and self._heap:
+            _, _, _, waiter = heapq.heappop(self._heap)
+            if waiter.cancelled:
+                continue
+            waiter.granted = True
+            self.running += 1
+            name = PRIORITY_NAMES[waiter.priority]
+            self.granted[name] += 1
+            self._wait_times[name].append(time.monotonic() - waiter.enqueued_at)
+            ready.append(waiter)
+        return ready
+
+    def acquire(self, priority: int, duration: Optional[float] = None):
+        """Blocks the calling thread until a slot is free."""
+        event = threading.Event()
+        self._enqueue(priority, duration, event.set)
+        event.wait()
+
+    async def acquire_async(self, priority: int, duration: Optional[float] = None, timeout: Optional[float] = None) -> bool:
+        """Waits for a slot. Returns False, leaving the queue, when none is granted within timeout."""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        waiter = self._enqueue(priority, duration,
+                               lambda: loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None)))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            with self._lock:
+                waiter.cancelled = True
+                granted = waiter.granted
+            if isinstance(e, asyncio.TimeoutError):
+                if granted:
+                    return True  # granted just as the wait ran out
+                self.rejected += 1
+                return False
+            if granted:
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            self.running -= 1
+            ready = self._grant()
+        for w in ready:
+            w.wake()
+
+    @contextlib.contextmanager
+    def slot(self, priority: int, duration: Optional[float] = None):
+        self.acquire(priority, duration)
+        try:
+            with transcode_seconds.time(priority=PRIORITY_NAMES[priority]):
+                yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._lock:
+            waits = {}
+            for name, times in self._wait_times.items():
+                ordered = sorted(times)
+                waits[name] = {
+                    "granted": self.granted[name],
+                    "wait_p50": round(ordered[len(ordered) // 2], 3) if ordered else 0.0,
+                    "wait_p95": round(ordered[int(len(ordered) * 0.95)], 3) if ordered else 0.0,
+                    "wait_max": round(ordered[-1], 3) if ordered else 0.0,
+                }
+            return {
+                "slots": self.slots,
+                "threads_per_job": self.threads_per_job,
+                "running": self.running,
+                "queued": sum(1 for *_, w in self._heap if not w.cancelled),
+                "rejected": self.rejected,
+                **waits,
+            }
+
+transcoder = TranscodeScheduler(TRANSCODE_SLOTS, TRANSCODE_THREADS)
+
+class TranscodeTicket:
+    """yt-dlp postprocessor hook that holds a transcode slot while an encoding
+    postprocessor runs. release() in a finally covers postprocessors that fail."""
+
+    def __init__(self, priority: int):
+        self.priority = priority
+        self.held = False
+        self.held_since = None
+
+    def hook(self, d):
+        if d.get('postprocessor') not in TRANSCODING_POSTPROCESSORS:
+            return
+        if d['status'] == 'started' and not self.held:
+            transcoder.acquire(self.priority, (d.get('info_dict') or {}).get('duration'))
+            self.held = True
+            self.held_since = time.monotonic()
+        elif d['status'] == 'finished':
+            self.release()
+
+    def release(self):
+        if self.held:
+            self.held = False
+            transcoder.release()
+            transcode_seconds.observe(time.monotonic() - self.held_since, priority=PRIORITY_NAMES[self.priority])
+
+class ScheduledStream:
+    """Stream source wrapper holding an interactive transcode slot while source runs. The
+    slot is released when the stream is closed, or dropped without ever being iterated."""
+
+    def __init__(self, source):
+        self.source = source
+        self.held_since = time.monotonic()
+        self.held = True
+        self._loop = asyncio.get_event_loop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.source.__anext__()
+
+    def _release(self):
+        if self.held:
+            self.held = False
+            transcoder.release()
+            transcode_seconds.observe(time.monotonic() - self.held_since, priority=PRIORITY_NAMES[PRIORITY_INTERACTIVE])
+
+    async def aclose(self):
+        self._release()
+        await self.source.aclose()
+
+    def __del__(self):
+        if self.held:
+            try:
+                self._loop.call_soon_threadsafe(self._release)
+            except RuntimeError:
+                self._release()  # loop closed
+
+async def scheduled_stream(source, duration: Optional[float]) -> ScheduledStream:
+    """Takes an interactive transcode slot for source before its response starts (time spent
+    queued inside the body would count against the stream's idle timeout). Raises 429 when
+    no slot frees up within TRANSCODE_ADMIT_TIMEOUT."""
+    if not await transcoder.acquire_async(PRIORITY_INTERACTIVE, duration, timeout=TRANSCODE_ADMIT_TIMEOUT):
+        await source.aclose()
+        raise PoolSaturated("transcode", max(1, round(TRANSCODE_ADMIT_TIMEOUT)))
+    return ScheduledStream(source)
+
+@app.get("/debug/transcode")
+async def debug_transcode():
+    """Encoder slots and queue wait times per priority class."""
+    return transcoder.stats()
 
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
@@ -132,21 +817,9 @@ def is_youtube_url(url: str) -> bool:
     u = str(url).lower()
     return "youtube.com" in u or "youtu.be" in u
 
-def get_cookie_kwargs():
-    """Returns yt-dlp options for cookies (file or browser)."""
-    opts = {}
-
-    # 1. Try local cookies.txt first (Best for servers/persistent auth)
-    cookie_file = BASE_DIR / "cookies.txt"
-    if cookie_file.exists():
-        logger.info(f"Using cookie file: {cookie_file}")
-        opts['cookiefile'] = str(cookie_file)
-    else:
-        # 2. Try browser cookies (Best for local dev)
-        browser = get_browser_cookies()
-        if browser:
-            logger.info(f"Using cookies from browser: {browser}")
-            opts['cookiesfrombrowser'] = (browser,)
+def get_cookie_kwargs(jar=None):
+    """Returns yt-dlp options for cookies (a jar from cookie_pool: file or browser)."""
+    opts = jar.cookie_opts() if jar is not None else {}
 
     # 2. Add client impersonation arguments specifically for YouTube bot bypass.
     # Android and MWeb (mobile web) clients bypass bot restrictions much better than the web / tv client default right now.
@@ -184,8 +857,32 @@ def get_browser_cookies():
 
     return None  # No browser found — don't try browser cookies (e.g. on Railway server)
 
-def get_best_browser_for_cmd():
-    return get_browser_cookies()
+def cookie_jar_paths() -> List[Path]:
+    paths = [cookies_file] if cookies_file.is_file() else []
+    if COOKIES_DIR.is_dir():
+        paths.extend(sorted(path for path in COOKIES_DIR.glob("*.txt") if path.is_file()))
+    return paths
+
+def get_cookie_sources():
+    """Cookie files (best for servers/persistent auth), else browser cookies (best for local dev)."""
+    sources = []
+    for path in cookie_jar_paths():
+        try:
+            digest = hashlib.sha1(path.read_bytes()).hexdigest()
+        except OSError:
+            continue
+        sources.append({"id": str(path), "kind": "file", "path": str(path),
+                        "signature": path_signature(str(path)), "digest": digest})
+    if not sources:
+        browser = get_browser_cookies()
+        if browser:
+            sources.append({"id": f"browser:{browser}", "kind": "browser", "browser": browser,
+                            "signature": None, "digest": None})
+    return sources
+
+def cookie_sources_signature():
+    """Changes when a jar is added, removed or rewritten."""
+    return (path_signature(str(COOKIES_DIR)), *(path_signature(str(path)) for path in cookie_jar_paths()))
 
 def get_deno_path():
     """Find the deno executable path."""
@@ -193,321 +890,2948 @@ def get_deno_path():
     deno_local = Path.home() / ".deno" / "bin" / "deno.exe"
     if deno_local.exists():
         return str(deno_local)
-    if shutil.which("deno"):
-        return shutil.which("deno")
-    return None
+    return shutil.which("deno")
 
-@app.get("/")
-async def root():
-    html_path = BASE_DIR / "index.html"
-    if not html_path.exists():
-        logger.error(f"index.html not found at {html_path}")
-        return {"error": "index.html not found. Please ensure it exists in the application directory."}
-    return FileResponse(html_path)
+def get_ffmpeg_path():
+    """Find ffmpeg in the application directory or PATH."""
+    local_ffmpeg = BASE_DIR / "ffmpeg.exe"
+    if local_ffmpeg.exists():
+        return str(local_ffmpeg)
+    return shutil.which("ffmpeg")
 
-@app.get("/logo.png")
-async def get_logo():
-    path = BASE_DIR / "logo.png"
-    if path.exists():
-        return FileResponse(path)
-    return FileResponse(BASE_DIR / "assets" / "logo.png") # Fallback
+def get_ffprobe_path():
+    """Find the ffprobe executable (shipped next to ffmpeg.exe on Windows)."""
+    local_ffprobe = BASE_DIR / "ffprobe.exe"
+    if local_ffprobe.exists():
+        return str(local_ffprobe)
+    return shutil.which("ffprobe")
 
-@app.get("/favicon.ico")
-async def get_favicon():
-    path = BASE_DIR / "favicon.ico"
-    if path.exists():
-        return FileResponse(path)
-    # Check if logo.png exists and serve it as fallback? 
-    # Or just return logo.png as favicon.ico content type?
-    # Better to just return logo.png if favicon.ico missing.
-    return await get_logo()
+# --- Toolchain ---
+# ffmpeg, ffprobe, deno and the cookie source are looked up once and then
+# re-checked with a single stat every TOOLCHAIN_RECHECK seconds: a binary
+# that is replaced or removed, or a cookies.txt that appears or changes, is
+# picked up again without a restart. POST /debug/toolchain/refresh forces a
+# new lookup, e.g. after installing a missing tool.
+TOOLCHAIN_RECHECK = float(os.environ.get("TOOLCHAIN_RECHECK", "30"))
+# yt-dlp and pytubefix are imported on first use instead of at import time
+# (together about half the server's import time); the startup warm-up loads
+# them in the background so the first request normally doesn't pay for it.
+WARM_UP = os.environ.get("WARM_UP", "1") != "0"
+WARM_UP_MODULES = ("yt_dlp", "pytubefix")  # keep in step with hiddenimports in "Video Downloader.spec"
 
-@app.get("/manifest.json")
-async def get_manifest():
-    return FileResponse(BASE_DIR / "manifest.json")
+import_timings = {}  # module -> seconds its first import took
+startup_timings = {}
 
-@app.get("/robots.txt")
-async def get_robots():
-    return FileResponse(BASE_DIR / "robots.txt")
+def lazy_import(name: str):
+    """importlib.import_module that records how long the first import took."""
+    loaded = name in sys.modules
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        import_timings.setdefault(name, round(time.perf_counter() - started, 3))
+    return module
 
-@app.get("/sitemap.xml")
-async def get_sitemap():
-    return FileResponse(BASE_DIR / "sitemap.xml")
+def path_signature(path: str):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
 
-@app.post("/video/info")
-async def get_video_info(video: VideoURL):
-    url_str = str(video.url)
-    
-    def get_info_ytdlp():
-        base_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'format': None,  # Skips format selection to prevent "Requested format is not available" error
-            'nocheckcertificate': True,
-            'ignoreerrors': False,
-            'socket_timeout': 30,
+def probe_version(path: str, args: List[str]) -> Optional[str]:
+    """First line of `<tool> -version`, e.g. 'ffmpeg version 6.1.1 ...'."""
+    try:
+        result = subprocess.run([path, *args], capture_output=True, text=True, timeout=10)
+    except Exception:
+        return None
+    lines = result.stdout.strip().splitlines()
+    return lines[0].strip() if lines else None
+
+class Toolchain:
+    """Registry of external tools. get() returns the cached lookup, re-validated every `recheck` seconds."""
+
+    def __init__(self, recheck: float):
+        self.recheck = recheck
+        self._specs = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, find, version_args=None, watch=None, missing: str = "", describe=str):
+        """`find` returns the tool's path (or any value, None if missing). The path is stat'ed
+        to notice changes, unless `watch` names a different file to stat or is a callable
+        returning the signature to compare."""
+        self._specs[name] = {"find": find, "version_args": version_args, "watch": watch,
+                             "missing": missing, "describe": describe}
+
+    @staticmethod
+    def _signature(watch):
+        return watch() if callable(watch) else path_signature(watch)
+
+    def get(self, name: str):
+        entry = self._entries.get(name)
+        if entry is not None and time.monotonic() - entry["checked_at"] < self.recheck:
+            return entry["value"]
+        with self._lock:
+            entry = self._entries.get(name)
+            now = time.monotonic()
+            if entry is None:
+                entry = self._lookup(name, None)
+            elif now - entry["checked_at"] >= self.recheck:
+                if entry["watch"] and self._signature(entry["watch"]) == entry["signature"]:
+                    entry["checked_at"] = now
+                else:
+                    entry = self._lookup(name, entry)
+            return entry["value"]
+
+    def _lookup(self, name: str, previous: Optional[dict]) -> dict:
+        spec = self._specs[name]
+        value = spec["find"]()
+        watch = spec["watch"] or (value if isinstance(value, str) else None)
+        entry = {
+            "value": value,
+            "watch": watch,
+            "signature": self._signature(watch) if watch else None,
+            "checked_at": time.monotonic(),
+            "found_at": time.time(),
+            "version": None,
+            "lookups": previous["lookups"] + 1 if previous else 1,
         }
-        cookie_opts = get_cookie_kwargs()
-        
-        try:
-            with yt_dlp.YoutubeDL({**base_opts, **cookie_opts}) as ydl:
-                return ydl.extract_info(url_str, download=False)
-        except Exception as e:
-            logger.warning(f"yt-dlp info failed with cookies: {e}. Retrying anonymously.")
-            with yt_dlp.YoutubeDL(base_opts) as ydl:
-                return ydl.extract_info(url_str, download=False)
+        if previous is not None and previous["value"] == value and previous["signature"] == entry["signature"]:
+            entry["version"] = previous["version"]
+        if previous is None or previous["value"] != value:
+            if value:
+                logger.info(f"Toolchain: {name} -> {spec['describe'](value)}")
+            else:
+                logger.warning(f"Toolchain: {name} not found. {spec['missing']}".rstrip())
+        self._entries[name] = entry
+        return entry
 
-    try:
-        # Use yt-dlp for everything (more robust against bot detection for info fetching)
-        info = await asyncio.get_event_loop().run_in_executor(executor, get_info_ytdlp)
-        return {
-            "success": True,
-            "data": {
-                "title": info.get('title'),
-                "thumbnail": info.get('thumbnail'),
-                "duration": info.get('duration'),
-                "uploader": info.get('uploader'),
-                "view_count": info.get('view_count'),
+    def refresh(self):
+        """Looks every tool up again (and re-probes versions that changed)."""
+        with self._lock:
+            for name in self._specs:
+                self._lookup(name, self._entries.get(name))
+        self.probe_versions()
+
+    def probe_versions(self):
+        for name, spec in self._specs.items():
+            path = self.get(name)
+            entry = self._entries[name]
+            if spec["version_args"] and path and entry["version"] is None:
+                entry["version"] = probe_version(path, spec["version_args"])
+
+    def stats(self):
+        tools = {}
+        for name in self._specs:
+            entry = self._entries.get(name)
+            tools[name] = None if entry is None else {
+                "value": entry["value"],
+                "version": entry["version"],
+                "found_at": entry["found_at"],
+                "lookups": entry["lookups"],
             }
-        }
-            
-    except Exception as e:
-        logger.error(f"Error info: {e}")
-        raise HTTPException(status_code=400, detail=str(e))
+        return {"recheck_seconds": self.recheck, "tools": tools}
 
-def cleanup_file(path: str):
+toolchain = Toolchain(TOOLCHAIN_RECHECK)
+toolchain.register("ffmpeg", get_ffmpeg_path, version_args=["-version"],
+                   missing="Merging, mp3 and piped muxing are disabled.")
+toolchain.register("ffprobe", get_ffprobe_path, version_args=["-version"])
+toolchain.register("deno", get_deno_path, version_args=["--version"],
+                   missing="YouTube may fail. Install from https://deno.land")
+toolchain.register("cookies", get_cookie_sources, watch=cookie_sources_signature,
+                   describe=lambda sources: ", ".join(Path(s["id"]).name for s in sources))
+
+def warm_up():
+    """Imports yt-dlp/pytubefix and looks up the toolchain off the request path."""
+    started = time.perf_counter()
+    for name in WARM_UP_MODULES:
+        try:
+            lazy_import(name)
+        except ImportError as e:
+            logger.warning(f"Warm-up import of {name} failed: {e}")
     try:
-        if os.path.exists(path):
-            os.remove(path)
-            logger.info(f"Cleaned up file: {path}")
+        canonical_video_key("https://example.com/warm-up")  # loads every extractor and compiles its URL pattern
     except Exception as e:
-        logger.warning(f"Failed to cleanup file {path}: {e}")
+        logger.warning(f"Warm-up of the extractor list failed: {e}")
+    toolchain.probe_versions()
+    startup_timings["warm_up_seconds"] = round(time.perf_counter() - started, 3)
 
-from fastapi.responses import StreamingResponse
+@app.on_event("startup")
+async def start_warm_up():
+    if WARM_UP:
+        asyncio.get_event_loop().run_in_executor(None, warm_up)
 
-@app.get("/video/download_link")
-async def download_link_get(url: str, background_tasks: BackgroundTasks, format: str = "best", quality: str = None):
-    url_str = url
-    
-    # Check for FFmpeg
-    ffmpeg_exe = "ffmpeg"
-    local_ffmpeg = BASE_DIR / "ffmpeg.exe"
-    if local_ffmpeg.exists():
-        ffmpeg_exe = str(local_ffmpeg)
-    elif shutil.which("ffmpeg"):
-         ffmpeg_exe = "ffmpeg"
-    else:
-         ffmpeg_exe = None
+@app.get("/debug/logging")
+async def debug_logging():
+    return {
+        "level": LOG_LEVEL,
+        "file": str(log_file_path),
+        "max_bytes": LOG_MAX_BYTES,
+        "backups": LOG_BACKUPS,
+        "queued": log_queue.qsize(),
+        "dropped": log_queue_handler.dropped,
+        "sampled_out": log_sampler.suppressed,
+    }
 
-    try:
+@app.get("/debug/toolchain")
+async def debug_toolchain():
+    await asyncio.get_event_loop().run_in_executor(None, toolchain.probe_versions)
+    return {**toolchain.stats(), "imports": import_timings, "startup": startup_timings}
 
-        # 1. Get Metadata (Title/Filename/Size) quickly
-        def get_meta():
-            base_opts = {
-                'quiet': True, 
-                'no_warnings': True,
-                'nocheckcertificate': True,
-            }
-            cookie_opts = get_cookie_kwargs()
+@app.post("/debug/toolchain/refresh")
+async def refresh_toolchain():
+    await asyncio.get_event_loop().run_in_executor(None, toolchain.refresh)
+    return {**toolchain.stats(), "imports": import_timings, "startup": startup_timings}
+
+# --- Cookie pool ---
+# Every cookie jar (account) gets its own circuit breaker. A jar whose
+# requests keep failing with auth/bot-check errors is taken out of rotation
+# for COOKIE_COOLDOWN seconds (doubling up to COOKIE_MAX_COOLDOWN while it
+# keeps failing), then gets a single trial request. While no jar is usable,
+# requests go straight to the anonymous attempt instead of paying for a
+# failed cookie attempt first. Requests are spread over the healthy jars,
+# least used first; COOKIE_JAR_MAX_PER_MINUTE caps the rate per account.
+# Jars are hot-reloaded through the toolchain's "cookies" entry.
+COOKIE_FAILURE_THRESHOLD = int(os.environ.get("COOKIE_FAILURE_THRESHOLD", "2"))
+COOKIE_COOLDOWN = float(os.environ.get("COOKIE_COOLDOWN", "300"))
+COOKIE_MAX_COOLDOWN = float(os.environ.get("COOKIE_MAX_COOLDOWN", "3600"))
+COOKIE_JAR_MAX_PER_MINUTE = int(os.environ.get("COOKIE_JAR_MAX_PER_MINUTE", "0"))  # 0 = no cap
+
+# Errors that say the session/account is the problem, not the video
+AUTH_ERROR_RE = re.compile(
+    r"sign in to confirm|not a bot|login required|log in to|cookies|"
+    r"http error 403|http error 429|too many requests|rate.?limit",
+    re.IGNORECASE,
+)
+
+class CookieJar:
+    def __init__(self, source: dict, cooldown: float):
+        self.source = source
+        self.id = source["id"]
+        self.state = "closed"  # closed -> open -> half_open -> closed (or back to open)
+        self.consecutive_failures = 0
+        self.cooldown = cooldown
+        self.opened_until = 0.0
+        self.trial_in_flight = False
+        self.uses = deque()  # monotonic times of the uses in the last minute
+        self.last_used = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.last_error = None
+
+    @property
+    def name(self) -> str:
+        return Path(self.id).name if self.source["kind"] == "file" else self.id
+
+    def snapshot(self) -> str:
+        """Copy of the jar's file named after its contents, for yt-dlp to read and save into.
+        A new name per version also keeps pooled YoutubeDL instances (keyed by their options)
+        from serving cookies that were replaced since."""
+        source = self.source
+        prefix = hashlib.sha1(self.id.encode()).hexdigest()[:8]
+        path = COOKIE_SNAPSHOT_DIR / f"{prefix}-{source['digest'][:16]}.txt"
+        if not path.exists():
             try:
-                with yt_dlp.YoutubeDL({**base_opts, **cookie_opts}) as ydl:
-                    info = ydl.extract_info(url_str, download=False)
-                    return ydl.prepare_filename(info), (info.get('filesize') or info.get('filesize_approx')), True
-            except Exception as e:
-                logger.warning(f"get_meta failed with cookies: {e}. Retrying without.")
-                with yt_dlp.YoutubeDL(base_opts) as ydl:
-                    info = ydl.extract_info(url_str, download=False)
-                    return ydl.prepare_filename(info), (info.get('filesize') or info.get('filesize_approx')), False
-        
-        filesize = None
-        use_cookies = True
-        try:
-            suggested_filename, filesize, use_cookies = await asyncio.get_event_loop().run_in_executor(executor, get_meta)
-            filename = os.path.basename(suggested_filename)
-        except:
-             filename = f"video_{uuid.uuid4()}.mp4"
+                COOKIE_SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_name(f".{uuid.uuid4().hex}.tmp")
+                shutil.copyfile(source["path"], tmp)
+                os.replace(tmp, path)
+            except OSError as e:
+                logger.warning(f"Failed to snapshot cookie jar {self.name}: {e}")
+                return source["path"]
+            for stale in COOKIE_SNAPSHOT_DIR.glob(f"{prefix}-*.txt"):
+                if stale != path:
+                    cleanup_file(str(stale))
+        return str(path)
 
-        # Ensure correct extension
-        if format == "mp3":
-            if not filename.endswith(".mp3"):
-                filename = os.path.splitext(filename)[0] + ".mp3"
-            # Filesize is likely invalid for mp3 conversion if original was video
-            filesize = None 
-        elif not filename.endswith(".mp4"):
-             filename = os.path.splitext(filename)[0] + ".mp4"
+    def cookie_opts(self) -> dict:
+        if self.source["kind"] == "file":
+            return {'cookiefile': self.snapshot()}
+        return {'cookiesfrombrowser': (self.source["browser"],)}
 
-        # 2. Construct yt-dlp command for streaming to stdout
-        # -o - : Output to stdout
-        cmd = ["yt-dlp", "--no-part", "--no-colors", "--no-check-certificate", "--quiet"]
+    def cli_args(self) -> List[str]:
+        if self.source["kind"] == "file":
+            return ["--cookies", self.snapshot()]
+        return ["--cookies-from-browser", self.source["browser"]]
 
-        # Add deno JS runtime if available (required for modern YouTube extraction)
-        deno_path = get_deno_path()
-        if deno_path:
-            cmd.extend(["--js-runtimes", f"deno:{deno_path}"])
-            logger.info(f"Using deno JS runtime: {deno_path}")
-        else:
-            logger.warning("Deno JS runtime not found. YouTube may fail. Install from https://deno.land")
+class CookiePool:
+    def __init__(self, threshold: int, cooldown: float, max_cooldown: float, max_per_minute: int):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_per_minute = max_per_minute
+        self._jars = OrderedDict()  # id -> CookieJar
+        self._lock = threading.Lock()
+        self.skipped = 0  # requests sent straight to the anonymous attempt
+        self.rate_limited = 0
 
-        # Anti-bot: pass cookies
-        if use_cookies:
-            cookie_file = BASE_DIR / "cookies.txt"
-            if cookie_file.exists():
-                 cmd.extend(["--cookies", str(cookie_file)])
-            else:
-                browser_name = get_best_browser_for_cmd()
-                if browser_name:
-                    cmd.extend(["--cookies-from-browser", f"{browser_name}"])
-        
-        cmd.extend([
-            "--socket-timeout", "30",
-            "--geo-bypass"
-        ])
-        
-        if ffmpeg_exe:
-             cmd.extend(["--ffmpeg-location", ffmpeg_exe])
-        
-        if format == "mp3":
-             # Audio only, convert to mp3 on the fly
-             # For mp3 conversion, we cannot know final size easily, so we omit Content-Length
-             cmd.extend(["-f", "bestaudio/best", "-x", "--audio-format", "mp3", "--audio-quality", "0"])
-        else:
-             # Video
-             target_res = quality
-             if target_res:
-                 if target_res == "1080p":
-                      cmd.extend(["-f", "bestvideo[height<=1080]+bestaudio/best"])
-                 elif target_res == "720p":
-                      cmd.extend(["-f", "bestvideo[height<=720]+bestaudio/best"])
-                 elif target_res == "480p":
-                      cmd.extend(["-f", "bestvideo[height<=480]+bestaudio/best"])
-                 elif target_res == "360p":
-                      cmd.extend(["-f", "bestvideo[height<=360]+bestaudio/best"])
-                 else:
-                      cmd.extend(["-f", "best"])
-             else:
-                 cmd.extend(["-f", "best"])
+    def _sync(self):
+        """Picks up added, removed and rewritten jars. Health survives a resync, except that
+        an open jar whose cookies were replaced (compared by content, so a touch or an
+        identical rewrite doesn't count) gets a fresh start."""
+        sources = toolchain.get("cookies") or []
+        jars = OrderedDict()
+        for source in sources:
+            jar = self._jars.get(source["id"])
+            if jar is None or (jar.state != "closed" and jar.source["digest"] != source["digest"]):
+                if jar is not None:
+                    logger.info(f"Cookie jar {jar.name} changed; back in rotation")
+                jar = CookieJar(source, self.cooldown)
+            jar.source = source
+            jars[source["id"]] = jar
+        self._jars = jars
 
-        cmd.extend(["-o", "-", url_str])
-        
-        # Log command
-        logger.info(f"Streaming command: {' '.join(cmd)}")
+    def has_jars(self) -> bool:
+        with self._lock:
+            self._sync()
+            return bool(self._jars)
 
-        # 3. Create Generator
-        async def iter_stream():
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            # Read stdout
-            while True:
-                chunk = await process.stdout.read(64 * 1024) # 64KB chunks
-                if not chunk:
+    def _usable(self, jar: CookieJar, now: float, trial: bool) -> bool:
+        if jar.state == "closed":
+            return True
+        if not trial or jar.trial_in_flight or now < jar.opened_until:
+            return False
+        return True
+
+    def acquire(self, prefer: Optional[str] = None, trial: bool = True) -> Optional[CookieJar]:
+        """A jar to use for one request, or None when none is usable. With trial=True an open
+        jar past its cooldown may be returned as its single trial; the caller must then
+        report the outcome (success/failure/release)."""
+        now = time.monotonic()
+        with self._lock:
+            self._sync()
+            candidates = []
+            for jar in self._jars.values():
+                while jar.uses and jar.uses[0] <= now - 60:
+                    jar.uses.popleft()
+                if self._usable(jar, now, trial):
+                    candidates.append(jar)
+            if not candidates:
+                if self._jars:
+                    self.skipped += 1
+                return None
+            under_cap = [jar for jar in candidates
+                         if not self.max_per_minute or len(jar.uses) < self.max_per_minute]
+            if not under_cap:
+                self.rate_limited += 1
+                return None
+            preferred = self._jars.get(prefer) if prefer else None
+            if preferred not in under_cap:
+                preferred = min(under_cap, key=lambda jar: (len(jar.uses), jar.last_used))
+            jar = preferred
+            if jar.state != "closed":
+                jar.state = "half_open"
+                jar.trial_in_flight = True
+            jar.uses.append(now)
+            jar.last_used = now
+            return jar
+
+    def get(self, jar_id: Optional[str]) -> Optional[CookieJar]:
+        """The jar with this id if it is still configured and in rotation."""
+        with self._lock:
+            jar = self._jars.get(jar_id) if jar_id else None
+            return jar if jar is not None and jar.state == "closed" else None
+
+    def success(self, jar: CookieJar):
+        with self._lock:
+            if jar.state != "closed":
+                logger.info(f"Cookie jar {jar.name} recovered")
+            jar.state = "closed"
+            jar.trial_in_flight = False
+            jar.consecutive_failures = 0
+            jar.cooldown = self.cooldown
+            jar.successes += 1
+
+    def failure(self, jar: CookieJar, error: Exception):
+        with self._lock:
+            jar.failures += 1
+            jar.consecutive_failures += 1
+            jar.last_error = str(error)[:300]
+            if jar.state == "half_open" or jar.consecutive_failures >= self.threshold:
+                if jar.state == "half_open":
+                    jar.cooldown = min(jar.cooldown * 2, self.max_cooldown)
+                jar.state = "open"
+                jar.opened_until = time.monotonic() + jar.cooldown
+                logger.warning(f"Cookie jar {jar.name} taken out of rotation for {jar.cooldown:.0f}s: {jar.last_error}")
+            jar.trial_in_flight = False
+
+    def release(self, jar: CookieJar):
+        """The request failed for reasons unrelated to the jar."""
+        with self._lock:
+            if jar.trial_in_flight:
+                jar.trial_in_flight = False
+                jar.state = "open"  # no verdict; the next request gets the trial instead
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            self._sync()
+            return {
+                "jars": [{
+                    "name": jar.name,
+                    "kind": jar.source["kind"],
+                    "state": jar.state,
+                    "consecutive_failures": jar.consecutive_failures,
+                    "successes": jar.successes,
+                    "failures": jar.failures,
+                    "uses_last_minute": sum(1 for t in jar.uses if t > now - 60),
+                    "retry_in": round(max(0.0, jar.opened_until - now), 1) if jar.state == "open" else 0,
+                    "last_error": jar.last_error,
+                } for jar in self._jars.values()],
+                "skipped_to_anonymous": self.skipped,
+                "rate_limited": self.rate_limited,
+                "failure_threshold": self.threshold,
+                "cooldown": self.cooldown,
+                "max_per_minute": self.max_per_minute,
+            }
+
+cookie_pool = CookiePool(COOKIE_FAILURE_THRESHOLD, COOKIE_COOLDOWN, COOKIE_MAX_COOLDOWN, COOKIE_JAR_MAX_PER_MINUTE)
+
+def run_with_cookies(fn, prefer: Optional[str] = None):
+    """Runs fn(cookie_opts) with a jar from the cookie pool and retries it anonymously (fn({}))
+    if that fails. Returns (result, jar id or None). A jar is only blamed for auth errors or
+    when the anonymous retry then works."""
+    jar = cookie_pool.acquire(prefer)
+    if jar is None and cookie_pool.has_jars():
+        # Every jar is out of rotation or at its rate cap
+        return fn({}), None
+    try:
+        result = fn(get_cookie_kwargs(jar))
+    except Exception as e:
+        if UNAVAILABLE_ERROR_RE.search(str(e)):
+            # Private/removed: an anonymous session can't see more than a logged-in one
+            if jar is not None:
+                cookie_pool.release(jar)
+            raise
+        logger.warning(f"yt-dlp failed with cookies{f' ({jar.name})' if jar else ''}: {e}. Retrying anonymously.")
+        try:
+            result = fn({})
+        except Exception:
+            if jar is not None:
+                if AUTH_ERROR_RE.search(str(e)):
+                    cookie_pool.failure(jar, e)
+                else:
+                    cookie_pool.release(jar)
+            raise
+        if jar is not None:
+            cookie_pool.failure(jar, e)
+        return result, None
+    if jar is not None:
+        cookie_pool.success(jar)
+    return result, jar.id if jar is not None else None
+
+# --- YoutubeDL pool ---
+# Building a YoutubeDL re-initialises extractors, the cookie jar and the HTTP
+# opener every time. Instances are kept warm per option profile instead.
+YDL_POOL_IDLE = int(os.environ.get("YDL_POOL_IDLE", "4"))  # idle instances kept per profile
+YDL_POOL_MAX_USES = int(os.environ.get("YDL_POOL_MAX_USES", "50"))
+
+# Options that change per request; applied on checkout and removed again on return
+YDL_REQUEST_PARAMS = ('outtmpl', 'progress_hooks', 'postprocessor_hooks', 'format')
+
+class YoutubeDLPool:
+    """Pool of pre-built yt_dlp.YoutubeDL objects keyed by their (static) options."""
+
+    def __init__(self, max_idle: int, max_uses: int):
+        self.max_idle = max_idle
+        self.max_uses = max_uses
+        self._idle = {}  # profile key -> [(ydl, uses), ...]
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+        self.reset_failures = 0
+
+    @staticmethod
+    def _profile_key(profile: dict) -> str:
+        return json.dumps(profile, sort_keys=True, default=repr)
+
+    @contextlib.contextmanager
+    def checkout(self, params: dict):
+        """Use like yt_dlp.YoutubeDL(params). The instance goes back to the pool unless it raised."""
+        profile = {k: v for k, v in params.items() if k not in YDL_REQUEST_PARAMS}
+        key = self._profile_key(profile)
+        with self._lock:
+            idle = self._idle.get(key)
+            ydl, uses = idle.pop() if idle else (None, 0)
+        if ydl is None:
+            ydl = lazy_import("yt_dlp").YoutubeDL(copy.deepcopy(profile))
+            self.created += 1
+        else:
+            self.reused += 1
+
+        saved_outtmpl = ydl.params.get('outtmpl')
+        if 'outtmpl' in params:
+            ydl.params['outtmpl'] = {**saved_outtmpl, 'default': params['outtmpl']}
+        if 'format' in params:
+            # Pinned format ids differ per video; rebuilding the selector beats a profile per id
+            ydl.params['format'] = params['format']
+            ydl.format_selector = params['format'] if params['format'] in (None, '-') else ydl.build_format_selector(params['format'])
+        for hook in params.get('progress_hooks', ()):
+            ydl.add_progress_hook(hook)
+        for hook in params.get('postprocessor_hooks', ()):
+            ydl.add_postprocessor_hook(hook)
+
+        ok = False
+        try:
+            yield ydl
+            ok = True
+        finally:
+            uses += 1
+            try:
+                self._reset(ydl, saved_outtmpl, params)
+            except Exception as e:
+                # _reset works on yt-dlp internals; if an upgrade moved them, recycle the
+                # instance rather than failing a request that already succeeded
+                logger.warning(f"Failed to reset YoutubeDL, recycling it: {e}")
+                self.reset_failures += 1
+                ok = False
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                keep = ok and uses < self.max_uses and len(idle) < self.max_idle
+                if keep:
+                    idle.append((ydl, uses))
+            if not keep:
+                self.recycled += 1
+                try:
+                    ydl.close()
+                except Exception as e:
+                    logger.warning(f"Failed to close YoutubeDL: {e}")
+
+    @staticmethod
+    def _reset(ydl, saved_outtmpl, params):
+        """Drops per-request state so the next user sees a clean instance."""
+        ydl.params['outtmpl'] = saved_outtmpl
+        if 'format' in params:
+            ydl.params.pop('format', None)
+            ydl.format_selector = None
+        request_hooks = list(params.get('progress_hooks', ())) + list(params.get('postprocessor_hooks', ()))
+        if request_hooks:
+            ydl._progress_hooks = [h for h in ydl._progress_hooks if h not in request_hooks]
+            ydl._postprocessor_hooks = [h for h in ydl._postprocessor_hooks if h not in request_hooks]
+            for pps in ydl._pps.values():
+                for pp in pps:
+                    pp._progress_hooks = [h for h in pp._progress_hooks if h not in request_hooks]
+        ydl._download_retcode = 0
+        ydl._printed_messages.clear()
+        ydl._playlist_level = 0
+        ydl._playlist_urls.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "profiles": len(self._idle),
+                "idle": sum(len(v) for v in self._idle.values()),
+                "created": self.created,
+                "reused": self.reused,
+                "recycled": self.recycled,
+                "reset_failures": self.reset_failures,
+                "max_uses": self.max_uses,
+            }
+
+ydl_pool = YoutubeDLPool(YDL_POOL_IDLE, YDL_POOL_MAX_USES)
+
+# --- Metadata cache ---
+# extract_info is the slowest and most rate-limited step, and /video/info is
+# usually followed by /video/download_link for the same video seconds later.
+META_CACHE_TTL = float(os.environ.get("META_CACHE_TTL", "600"))
+META_CACHE_NEGATIVE_TTL = float(os.environ.get("META_CACHE_NEGATIVE_TTL", "60"))
+META_CACHE_MAX_BYTES = int(os.environ.get("META_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Errors that will not go away by retrying in the next minute
+UNAVAILABLE_ERROR_RE = re.compile(
+    r"private video|video is private|video unavailable|video is unavailable|"
+    r"has been removed|members-only|account associated with this video has been terminated|"
+    r"not available in your country",
+    re.IGNORECASE,
+)
+
+# Query parameters that never change which video a URL points to
+TRACKING_PARAMS = {"si", "feature", "fbclid", "gclid", "igshid", "pp", "ref", "ref_src"}
+
+class VideoUnavailableError(Exception):
+    """Raised from the negative cache for videos that recently failed as private/unavailable."""
+
+class MetadataCache:
+    """Thread-safe TTL + LRU cache of sanitized yt-dlp info dicts, bounded by an approximate memory budget."""
+
+    def __init__(self, ttl, negative_ttl, max_bytes):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, info, cookie jar id)
+        self._refs = {}  # id(info) -> number of keys it is stored under; its size counts once
+        self._errors = OrderedDict()  # key -> (expires_at, message), oldest first
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns (info, cookie jar id) or None. Raises VideoUnavailableError for negative entries."""
+        now = time.monotonic()
+        with self._lock:
+            error = self._errors.get(key)
+            if error:
+                if error[0] > now:
+                    self.negative_hits += 1
+                    raise VideoUnavailableError(error[1])
+                del self._errors[key]
+
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= now:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2], entry[3]
+
+    def put(self, keys, info, jar_id):
+        try:
+            size = len(json.dumps(info, default=str))
+        except Exception:
+            size = 0
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+                self._errors.pop(key, None)
+                self._entries[key] = (expires_at, size, info, jar_id)
+                refs = self._refs.get(id(info), 0)
+                if not refs:
+                    self.total_bytes += size
+                self._refs[id(info)] = refs + 1
+            self._sweep_errors()
+            while self.total_bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def peek(self, key):
+        """The cached info dict, if any, without counting a lookup or refreshing its LRU position."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[2] if entry is not None and entry[0] > time.monotonic() else None
+
+    def put_error(self, key, message):
+        with self._lock:
+            self._errors.pop(key, None)
+            self._errors[key] = (time.monotonic() + self.negative_ttl, message)
+            self._sweep_errors()
+
+    def _sweep_errors(self):
+        # All negative entries share one TTL, so insertion order is expiry order
+        now = time.monotonic()
+        while self._errors:
+            key, (expires_at, _) = next(iter(self._errors.items()))
+            if expires_at > now:
+                break
+            del self._errors[key]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            refs = self._refs.pop(id(entry[2])) - 1
+            if refs:
+                self._refs[id(entry[2])] = refs
+            else:
+                self.total_bytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "negative_entries": len(self._errors),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+metadata_cache = MetadataCache(META_CACHE_TTL, META_CACHE_NEGATIVE_TTL, META_CACHE_MAX_BYTES)
+
+def normalize_url(url: str) -> str:
+    """Lowercases scheme/host and drops fragments and tracking parameters."""
+    parts = urlsplit(url.strip())
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(sorted(query)), ""))
+
+# Plain YouTube video links, keyed without scanning yt-dlp's extractors (the scan imports
+# all of them on first use and then still costs milliseconds per new URL).
+# Links with a list= parameter are playlists to yt-dlp, so they take the slow path.
+YOUTUBE_VIDEO_URL_RE = re.compile(
+    r"^https?://(?:(?:www|m|music)\.)?(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)"
+    r"|youtube-nocookie\.com/embed/|youtu\.be/)([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])")
+
+def youtube_video_key(url: str) -> Optional[str]:
+    match = YOUTUBE_VIDEO_URL_RE.match(url)
+    if not match or any(k == "list" for k, _ in parse_qsl(urlsplit(url).query)):
+        return None
+    return f"Youtube:{match.group(1)}"
+
+@functools.lru_cache(maxsize=4096)
+def canonical_video_key(url: str) -> str:
+    """Returns 'ExtractorKey:video_id' for a URL without any network access.
+    youtu.be/X?si=... and youtube.com/watch?v=X map to the same key.
+    Falls back to the normalized URL for sites whose ids can't be read from the URL."""
+    key = youtube_video_key(url)
+    if key:
+        return key
+    for ie in lazy_import("yt_dlp.extractor").gen_extractor_classes():
+        if ie.ie_key() == "Generic":
+            continue
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            if video_id:
+                return f"{ie.ie_key()}:{video_id}"
+            break
+    return f"url:{normalize_url(url)}"
+
+async def resolve_video_key(url: str) -> str:
+    """canonical_video_key for request handlers: the extractor scan runs off the event loop."""
+    return youtube_video_key(url) or await asyncio.get_running_loop().run_in_executor(None, canonical_video_key, url)
+
+def extract_info_cached(url_str: str):
+    """Runs yt-dlp extraction (cookies first, then anonymous) through the metadata cache.
+    Returns (info, id of the cookie jar that worked or None). The info dict is shared
+    between callers: deepcopy before mutating."""
+    key = canonical_video_key(url_str)
+    cached = metadata_cache.get(key)
+    if cached is not None:
+        logger.info(f"Metadata cache hit: {key}", extra={"sample_key": "metadata cache hit"})
+        return cached
+
+    base_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+        'format': None,  # Skips format selection to prevent "Requested format is not available" error
+        'nocheckcertificate': True,
+        'ignoreerrors': False,
+        'socket_timeout': 30,
+    }
+
+    def extract(cookie_opts):
+        with ydl_pool.checkout({**base_opts, **cookie_opts}) as ydl:
+            return ydl.extract_info(url_str, download=False)
+
+    started = time.monotonic()
+    try:
+        info, jar_id = run_with_cookies(extract)
+    except Exception as e:
+        if UNAVAILABLE_ERROR_RE.search(str(e)):
+            metadata_cache.put_error(key, str(e))
+        raise
+    extract_seconds.observe(time.monotonic() - started, extractor=extractor_label(url_str))
+    record_phase("extract", time.monotonic() - started)
+
+    # Same form as --load-info-json, so it can be fed back into process_ie_result
+    info = lazy_import("yt_dlp").YoutubeDL.sanitize_info(info, remove_private_keys=True)
+    keys = [key]
+    if info.get('extractor_key') and info.get('id'):
+        resolved_key = f"{info['extractor_key']}:{info['id']}"
+        if resolved_key != key:
+            keys.append(resolved_key)
+    metadata_cache.put(keys, info, jar_id)
+    return info, jar_id
+
+# --- Format resolution ---
+# One place that turns (format, quality) into yt-dlp formats. yt-dlp's own
+# selector runs over the formats list of the cached info, so downloads pin the
+# exact format ids instead of resolving again, /video/info can list only the
+# qualities a video really has, and merged selections get summed sizes.
+QUALITY_HEIGHTS = {"360p": 360, "480p": 480, "720p": 720, "1080p": 1080}  # what the UI offers
+
+def format_spec_for(fmt: str, quality: Optional[str]) -> str:
+    """The selector string for a request, also used when no info is available."""
+    if fmt == "mp3":
+        return "bestaudio/best"
+    height = QUALITY_HEIGHTS.get(quality)
+    if height:
+        return f"bestvideo[height<={height}]+bestaudio/best"
+    return "best"
+
+def select_formats(ydl, info: dict, spec: str) -> Optional[dict]:
+    """Runs spec over info['formats']. Returns the chosen format ids, their format
+    dicts, and the size: exact if every part has a filesize, else approximate."""
+    formats = info.get('formats') or []
+    if not formats:
+        return None
+    chosen = next(iter(ydl.build_format_selector(spec)({
+        'formats': formats,
+        'has_merged_format': any('none' not in (f.get('acodec'), f.get('vcodec')) for f in formats),
+        'incomplete_formats': (all(f.get('vcodec') == 'none' for f in formats)
+                               or all(f.get('acodec') == 'none' for f in formats)),
+    })), None)
+    if chosen is None:
+        return None
+    parts = chosen.get('requested_formats') or [chosen]
+    sizes = [f.get('filesize') for f in parts]
+    estimates = [f.get('filesize') or f.get('filesize_approx') for f in parts]
+    return {
+        "format_id": chosen['format_id'],
+        "formats": list(parts),
+        "height": chosen.get('height'),
+        "ext": chosen.get('ext'),
+        "merged": len(parts) > 1,
+        "filesize": sum(sizes) if all(sizes) else None,
+        "filesize_approx": sum(estimates) if all(estimates) else None,
+    }
+
+def resolve_formats(info: dict, fmt: str, quality: Optional[str]) -> Optional[dict]:
+    with ydl_pool.checkout({'quiet': True, 'no_warnings': True}) as ydl:
+        return select_formats(ydl, info, format_spec_for(fmt, quality))
+
+def pinned_format_spec(selection: Optional[dict], fmt: str, quality: Optional[str]) -> str:
+    """Exact format ids, with the selector as fallback in case a fresh extraction
+    (expired URLs) returns different ids."""
+    spec = format_spec_for(fmt, quality)
+    return f"{selection['format_id']}/{spec}" if selection else spec
+
+def quality_ladder(info: dict):
+    """Qualities worth offering for this video, best first. Each entry is labelled with the
+    lowest quality that reaches its formats, so a 720p video doesn't offer 1080p."""
+    ladder = []
+    seen = set()
+    with ydl_pool.checkout({'quiet': True, 'no_warnings': True}) as ydl:
+        for quality in QUALITY_HEIGHTS:
+            selection = select_formats(ydl, info, format_spec_for("best", quality))
+            if selection is None or not selection["height"] or selection["format_id"] in seen:
+                continue
+            seen.add(selection["format_id"])
+            ladder.append({
+                "quality": quality,
+                "height": selection["height"],
+                "format_id": selection["format_id"],
+                "merged": selection["merged"],
+                "filesize": selection["filesize"],
+                "filesize_approx": selection["filesize_approx"],
+            })
+        audio = select_formats(ydl, info, format_spec_for("mp3", None))
+    ladder.reverse()
+    audio_entry = None
+    if audio:
+        audio_entry = {
+            "format_id": audio["format_id"],
+            "abr": audio["formats"][0].get('abr'),
+            "filesize": audio["filesize"],
+            "filesize_approx": audio["filesize_approx"],
+        }
+    return ladder, audio_entry
+
+# --- Single-flight ---
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one asyncio task.
+    Callers share its result or error. The task is only cancelled once every
+    caller waiting on it has been cancelled (e.g. all clients disconnected)."""
+
+    def __init__(self):
+        self._flights = {}  # key -> [task, waiter_count]
+        self.started = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def do(self, key, factory):
+        flight = self._flights.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(factory())
+            flight = [task, 0]
+            self._flights[key] = flight
+            task.add_done_callback(functools.partial(self._finished, key))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"Joining in-flight request: {key}", extra={"sample_key": "singleflight join"})
+
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if flight[1] == 0 and not flight[0].done():
+                # Last interested caller is gone. Forget the flight right away: the task
+                # isn't done() until it has unwound, and a caller joining it in the
+                # meantime would get its CancelledError
+                flight[0].cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                self.cancelled += 1
+
+    def _finished(self, key, task):
+        flight = self._flights.get(key)
+        if flight is not None and flight[0] is task:
+            del self._flights[key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self._flights),
+            "waiters": sum(f[1] for f in self._flights.values()),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
+
+flights = SingleFlight()
+
+# --- File leases ---
+# Files that must not be deleted from under a reader or writer: finished files
+# while they are being sent, tee files while a stream is written to them, and
+# everything a running download writes, which is named after its download id.
+PARTIAL_NAME_RE = re.compile(r"^(?:[va]_)?([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})[._]")
+TEE_NAME_PREFIX = ".tee-"
+
+def is_partial_name(filename: str) -> bool:
+    """Whether a file in the Downloads dir is a download/merge part or a tee file."""
+    return filename.startswith(TEE_NAME_PREFIX) or PARTIAL_NAME_RE.match(filename) is not None
+
+class FileLeases:
+    def __init__(self):
+        self._held = {}  # filename or download id -> count
+        self._lock = threading.Lock()
+
+    def acquire(self, name: str):
+        with self._lock:
+            self._held[name] = self._held.get(name, 0) + 1
+
+    def release(self, name: str):
+        with self._lock:
+            count = self._held.pop(name, 0) - 1
+            if count > 0:
+                self._held[name] = count
+
+    @contextlib.contextmanager
+    def hold(self, name: str):
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def is_held(self, filename: str) -> bool:
+        with self._lock:
+            if filename in self._held:
+                return True
+            match = PARTIAL_NAME_RE.match(filename)
+            return match is not None and match.group(1) in self._held
+
+    def stats(self):
+        with self._lock:
+            return {"held": len(self._held), "leases": sum(self._held.values())}
+
+file_leases = FileLeases()
+
+# --- Download store ---
+# Finished downloads are kept under a name derived from (video, format, quality)
+# and indexed in a small JSON manifest next to them. 0 = no disk budget; the
+# desktop app saves into the user's Downloads folder, so nothing is evicted there.
+STORE_MAX_BYTES = int(os.environ.get("STORE_MAX_BYTES", str(2 * 1024 ** 3) if IS_SERVER else "0"))
+STORE_MANIFEST_NAME = ".avy_store.json"
+# Manifest writes are batched: changes made within STORE_FLUSH_DELAY seconds of
+# each other are written once, on a timer thread instead of the event loop
+STORE_FLUSH_DELAY = float(os.environ.get("STORE_FLUSH_DELAY", "2"))
+
+def sniff_container(path: Path) -> Optional[str]:
+    """'mp3', 'mp4' (any ISO BMFF, m4a included) or 'webm' (Matroska) from a file's first
+    bytes; the extension can't be trusted (pytubefix mp3 downloads are renamed m4a)."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(12)
+    except OSError:
+        return None
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    # ID3 tag, or an MPEG audio frame sync with a layer set (ADTS AAC has layer 0)
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0 and head[1] & 0x06):
+        return "mp3"
+    return None
+
+def default_filename(info: dict, ext: str) -> str:
+    """yt-dlp's default output name ('%(title)s [%(id)s].%(ext)s') without a YoutubeDL instance."""
+    sanitize = lazy_import("yt_dlp.utils").sanitize_filename
+    return f"{sanitize(info.get('title') or 'video')} [{sanitize(str(info.get('id')))}]{ext}"
+
+class DownloadStore:
+    """Persistent index of finished downloads keyed by (video key, format, quality)."""
+
+    def __init__(self, directory: Path, max_bytes: int, flush_delay: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.flush_delay = flush_delay
+        self.manifest_path = directory / STORE_MANIFEST_NAME
+        self._entries = {}  # filename -> {"keys", "size", "quality", "container", "filename", "created", "last_access", "hits"}
+        self._index = {}  # key -> filename
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # keeps flushes in order
+        self._flush_timer = None
+        self._dirty = False
+        self.flushes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._load()
+
+    @staticmethod
+    def make_key(video_key: str, fmt: str, quality: Optional[str]) -> str:
+        return f"{video_key}|{fmt or 'best'}|{quality or 'best'}"
+
+    def _load(self):
+        try:
+            data = json.loads(self.manifest_path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable store manifest {self.manifest_path}: {e}")
+            return
+        for filename, entry in data.get("entries", {}).items():
+            if (self.directory / filename).exists():
+                if "container" not in entry:  # manifests written before entries were tagged
+                    entry["container"] = sniff_container(self.directory / filename)
+                self._entries[filename] = entry
+                for key in entry["keys"]:
+                    self._index[key] = filename
+
+    def _save(self):
+        """Schedules a manifest write. Caller holds the lock."""
+        self._dirty = True
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """Writes the manifest now if anything changed since the last write."""
+        with self._write_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                data = json.dumps({"version": 1, "entries": self._entries})
+            tmp_path = self.manifest_path.with_suffix(".tmp")
+            try:
+                tmp_path.write_text(data, encoding='utf-8')
+                os.replace(tmp_path, self.manifest_path)
+                self.flushes += 1
+            except Exception as e:
+                logger.warning(f"Failed to write store manifest: {e}")
+
+    def lookup(self, key: str, container: Optional[str] = None):
+        """Returns (path, resolved quality, download filename or None) of a finished download,
+        or None. With container set, only a file of that container (see sniff_container) counts."""
+        with self._lock:
+            filename = self._index.get(key)
+            entry = self._entries.get(filename) if filename else None
+            if entry is None or (container and entry.get("container") != container):
+                self.misses += 1
+                return None
+            path = self.directory / filename
+            if not path.exists():
+                # Removed behind our back (user deleted it, tmp cleaner, ...)
+                self._drop(filename)
+                self._save()
+                self.misses += 1
+                return None
+            entry["last_access"] = time.time()
+            entry["hits"] += 1
+            self.hits += 1
+            self.bytes_saved += entry["size"]
+            self._save()
+            return path, entry.get("quality"), entry.get("filename")
+
+    def resolve(self, filename: str) -> Optional[Path]:
+        """Path of a stored file by name (for /video/file), or None if it isn't in the store."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return None
+            entry["last_access"] = time.time()
+            return self.directory / filename
+
+    def put(self, path: Path, keys: List[str], quality: Optional[str] = None, download_name: Optional[str] = None) -> Path:
+        """Moves a finished download into the store under its content-addressed name.
+        download_name is the name to offer clients (Content-Disposition) on a later hit."""
+        digest = hashlib.sha1(keys[0].encode('utf-8')).hexdigest()[:20]
+        filename = f"{digest}{path.suffix}"
+        dest = self.directory / filename
+        os.replace(path, dest)
+        now = time.time()
+        with self._lock:
+            self._drop(filename, unlink=False)
+            for key in keys:
+                old = self._index.get(key)
+                if old and old != filename:
+                    self._entries[old]["keys"].remove(key)
+                self._index[key] = filename
+            self._entries[filename] = {
+                "keys": list(keys),
+                "size": dest.stat().st_size,
+                "quality": quality,
+                "container": sniff_container(dest),
+                "filename": download_name,
+                "created": now,
+                "last_access": now,
+                "hits": 0,
+            }
+            self._evict(protect=filename)
+            self._save()
+        return dest
+
+    def snapshot(self) -> dict:
+        """Copy of the manifest entries, for the janitor to plan on without holding the lock."""
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._entries.items()}
+
+    def discard(self, filename: str) -> int:
+        """Removes an entry and its file unless it is being sent. Returns the bytes freed."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None or file_leases.is_held(filename):
+                return 0
+            self._drop(filename)
+            self._save()
+            return entry["size"]
+
+    def _drop(self, filename: str, unlink: bool = True):
+        entry = self._entries.pop(filename, None)
+        if entry is None:
+            return
+        for key in entry["keys"]:
+            if self._index.get(key) == filename:
+                del self._index[key]
+        if unlink:
+            cleanup_file(str(self.directory / filename))
+
+    @staticmethod
+    def eviction_order(entries: dict, now: float) -> List[str]:
+        """Filenames, most evictable first: large files that haven't been touched in a while."""
+        return sorted(entries, key=lambda name: (now - entries[name]["last_access"]) * entries[name]["size"], reverse=True)
+
+    def _evict(self, protect: Optional[str] = None):
+        """Evicts entries until under budget, skipping files that are being sent."""
+        if not self.max_bytes:
+            return
+        total = sum(e["size"] for e in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        for name in self.eviction_order(self._entries, time.time()):
+            if total <= self.max_bytes:
+                break
+            if name == protect or file_leases.is_held(name):
+                continue
+            size = self._entries[name]["size"]
+            logger.info(f"Evicting {name} from download store ({size} bytes)")
+            self._drop(name)
+            total -= size
+            self.evictions += 1
+            self.evicted_bytes += size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e["size"] for e in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "evictions": self.evictions,
+                "evicted_bytes": self.evicted_bytes,
+                "manifest_writes": self.flushes,
+            }
+
+download_store = DownloadStore(DOWNLOADS_DIR, STORE_MAX_BYTES, STORE_FLUSH_DELAY)
+
+@app.on_event("shutdown")
+async def flush_download_store():
+    await asyncio.get_event_loop().run_in_executor(None, download_store.flush)
+
+# --- Janitor ---
+# Keeps the server's Downloads dir bounded. Each sweep removes partial files
+# (download/merge parts, tee files) whose download is gone, stored downloads
+# nobody has asked for in JANITOR_MAX_AGE seconds, and then the least valuable
+# stored downloads until the whole directory fits in JANITOR_MAX_BYTES. Files
+# that are being sent or written are always skipped. Off on the desktop app,
+# where the Downloads dir is the user's own folder.
+JANITOR_INTERVAL = float(os.environ.get("JANITOR_INTERVAL", "300" if IS_SERVER else "0"))
+JANITOR_MAX_AGE = float(os.environ.get("JANITOR_MAX_AGE", str(24 * 3600)))
+JANITOR_MAX_BYTES = int(os.environ.get("JANITOR_MAX_BYTES", str(STORE_MAX_BYTES)))
+JANITOR_ORPHAN_GRACE = float(os.environ.get("JANITOR_ORPHAN_GRACE", "600"))  # seconds since last write
+JANITOR_DRY_RUN = os.environ.get("JANITOR_DRY_RUN", "0") == "1"
+JANITOR_REPORT_FILES = 50  # filenames listed per sweep report
+
+class Janitor:
+    def __init__(self, directory: Path, store: DownloadStore, max_age: float, max_bytes: int,
+                 orphan_grace: float, dry_run: bool):
+        self.directory = directory
+        self.store = store
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.orphan_grace = orphan_grace
+        self.dry_run = dry_run
+        self.task = None
+        self.runs = 0
+        self.failures = 0
+        self.files_removed = 0
+        self.bytes_reclaimed = 0
+        self.reclaimed_by_reason = {"orphan": 0, "expired": 0, "quota": 0}
+        self.last_report = None
+        self._sweep_lock = threading.Lock()
+
+    def plan(self) -> List[tuple]:
+        """(filename, size, reason) of everything the next sweep would remove, in order."""
+        now = time.time()
+        entries = self.store.snapshot()
+        removals = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for item in it:
+                try:
+                    if not item.is_file(follow_symlinks=False):
+                        continue
+                    st = item.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                total += st.st_size
+                if item.name in entries or not is_partial_name(item.name):
+                    continue
+                # The grace period covers files created just before their lease was taken
+                if now - st.st_mtime >= self.orphan_grace and not file_leases.is_held(item.name):
+                    removals.append((item.name, st.st_size, "orphan"))
+
+        if self.max_age:
+            for name, entry in entries.items():
+                if now - entry["last_access"] >= self.max_age and not file_leases.is_held(name):
+                    removals.append((name, entry["size"], "expired"))
+
+        if self.max_bytes:
+            remaining = total - sum(size for _, size, _ in removals)
+            planned = {name for name, _, _ in removals}
+            for name in DownloadStore.eviction_order(entries, now):
+                if remaining <= self.max_bytes:
+                    break
+                if name in planned or file_leases.is_held(name):
+                    continue
+                removals.append((name, entries[name]["size"], "quota"))
+                remaining -= entries[name]["size"]
+        return removals
+
+    def sweep(self, dry_run: Optional[bool] = None) -> dict:
+        """Runs one pass (blocking) and returns its report."""
+        dry_run = self.dry_run if dry_run is None else dry_run
+        with self._sweep_lock:
+            started = time.monotonic()
+            removed = []
+            by_reason = {reason: 0 for reason in self.reclaimed_by_reason}
+            for name, size, reason in self.plan():
+                if not dry_run:
+                    if reason == "orphan":
+                        # Re-check: a download may have picked the file up since planning
+                        if file_leases.is_held(name) or not cleanup_file(str(self.directory / name)):
+                            continue
+                    else:
+                        size = self.store.discard(name)
+                        if not size:
+                            continue
+                removed.append(name)
+                by_reason[reason] += size
+
+            reclaimed = sum(by_reason.values())
+            report = {
+                "dry_run": dry_run,
+                "at": time.time(),
+                "duration_ms": round((time.monotonic() - started) * 1000, 1),
+                "files": len(removed),
+                "bytes": reclaimed,
+                "by_reason": by_reason,
+                "removed": removed[:JANITOR_REPORT_FILES],
+            }
+            if not dry_run:
+                self.runs += 1
+                self.files_removed += len(removed)
+                self.bytes_reclaimed += reclaimed
+                for reason, size in by_reason.items():
+                    self.reclaimed_by_reason[reason] += size
+            if removed:
+                verb = "Would reclaim" if dry_run else "Reclaimed"
+                logger.info(f"Janitor: {verb} {reclaimed} bytes in {len(removed)} files ({by_reason})")
+            self.last_report = report
+            return report
+
+    async def run_forever(self, interval: float):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.sweep)
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"Janitor sweep failed: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return {
+            "enabled": self.task is not None,
+            "interval_seconds": JANITOR_INTERVAL,
+            "dry_run": self.dry_run,
+            "max_age_seconds": self.max_age,
+            "max_bytes": self.max_bytes,
+            "orphan_grace_seconds": self.orphan_grace,
+            "runs": self.runs,
+            "failures": self.failures,
+            "files_removed": self.files_removed,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "reclaimed_by_reason": dict(self.reclaimed_by_reason),
+            "leases": file_leases.stats(),
+            "last_sweep": self.last_report,
+        }
+
+janitor = Janitor(DOWNLOADS_DIR, download_store, JANITOR_MAX_AGE, JANITOR_MAX_BYTES,
+                  JANITOR_ORPHAN_GRACE, JANITOR_DRY_RUN)
+
+@app.on_event("startup")
+async def start_janitor():
+    if JANITOR_INTERVAL > 0:
+        janitor.task = asyncio.ensure_future(janitor.run_forever(JANITOR_INTERVAL))
+
+@app.on_event("shutdown")
+async def stop_janitor():
+    if janitor.task:
+        janitor.task.cancel()
+
+@app.get("/debug/janitor")
+async def debug_janitor():
+    return janitor.stats()
+
+@app.post("/debug/janitor/sweep")
+async def janitor_sweep(dry_run: bool = True):
+    """Runs a sweep now. Only reports what it would remove unless dry_run=false."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, janitor.sweep, dry_run)
+
+# --- Download progress ---
+PROGRESS_MAX_HZ = float(os.environ.get("PROGRESS_MAX_HZ", "4"))
+
+class ProgressReporter:
+    """Aggregates byte progress reported by download threads (yt-dlp hooks,
+    pytubefix callbacks) and publishes at most PROGRESS_MAX_HZ snapshots per second."""
+
+    def __init__(self, publish, max_hz: float):
+        self._publish = publish
+        self._interval = 1.0 / max_hz if max_hz > 0 else 0.0
+        self._parts = {}  # stream/format id -> (downloaded, total)
+        self._phase = "downloading"
+        self._last_emit = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, part, downloaded, total, force=False):
+        with self._lock:
+            self._parts[part] = (downloaded or 0, total or 0)
+            now = time.monotonic()
+            if not force and now - self._last_emit < self._interval:
+                return
+            self._last_emit = now
+            snapshot = self._snapshot()
+        self._publish(snapshot)
+
+    def set_phase(self, phase: str):
+        with self._lock:
+            self._phase = phase
+            self._last_emit = time.monotonic()
+            snapshot = self._snapshot()
+        self._publish(snapshot)
+
+    def _snapshot(self):
+        downloaded = sum(d for d, _ in self._parts.values())
+        total = sum(t for _, t in self._parts.values())
+        return {
+            "phase": self._phase,
+            "downloaded_bytes": downloaded,
+            "total_bytes": total or None,
+            "percent": round(min(100.0, downloaded * 100.0 / total), 1) if total else None,
+        }
+
+    def pytube_callback(self, stream, chunk, bytes_remaining):
+        total = stream.filesize
+        self.update(f"itag{stream.itag}", total - bytes_remaining, total, force=bytes_remaining == 0)
+
+    def ytdlp_hook(self, d):
+        part = (d.get('info_dict') or {}).get('format_id') or d.get('filename')
+        if d['status'] == 'downloading':
+            self.update(part, d.get('downloaded_bytes'), d.get('total_bytes') or d.get('total_bytes_estimate'))
+        elif d['status'] == 'finished':
+            total = d.get('total_bytes') or d.get('downloaded_bytes')
+            self.update(part, total, total, force=True)
+
+    def ytdlp_postprocessor_hook(self, d):
+        if d['status'] == 'started':
+            self.set_phase("processing")
+
+class ProgressHub:
+    """Routes progress of a (possibly shared) download to every job watching its flight key."""
+
+    def __init__(self):
+        self._listeners = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key, listener):
+        with self._lock:
+            self._listeners.setdefault(key, []).append(listener)
+
+    def unsubscribe(self, key, listener):
+        with self._lock:
+            listeners = self._listeners.get(key, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                self._listeners.pop(key, None)
+
+    def publisher(self, key):
+        """publish(snapshot) for the jobs watching key."""
+        return functools.partial(self._publish, key)
+
+    def reporter(self, key) -> ProgressReporter:
+        return ProgressReporter(self.publisher(key), PROGRESS_MAX_HZ)
+
+    def _publish(self, key, snapshot):
+        with self._lock:
+            listeners = list(self._listeners.get(key, ()))
+        for listener in listeners:
+            listener(snapshot)
+
+progress_hub = ProgressHub()
+
+# --- Segmented fetch ---
+# pytubefix downloads a stream over one connection, and the DASH video and
+# audio one after the other. Here all parts of a download are split into byte
+# ranges that are fetched over several connections at once and written in
+# place into preallocated files. SEGMENT_CONNECTIONS caps one download,
+# SEGMENT_GLOBAL_CONNECTIONS caps the whole server: segment workers and the
+# pipe-mux feeders both hold a slot of segment_connections while connected.
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", str(8 * 1024 * 1024)))
+SEGMENT_CONNECTIONS = int(os.environ.get("SEGMENT_CONNECTIONS", "4"))
+SEGMENT_GLOBAL_CONNECTIONS = int(os.environ.get("SEGMENT_GLOBAL_CONNECTIONS", "16"))
+SEGMENT_RETRIES = 3
+SEGMENT_READ_SIZE = 256 * 1024
+SEGMENT_HEADERS = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}  # same as pytubefix
+
+class ConnectionLimiter:
+    """Process-wide cap on upstream media connections, shared by threads. A group of
+    connections that only make progress together (the inputs of one ffmpeg mux) takes
+    its slots at once, so it never sits on some of them waiting for the rest."""
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.in_use = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def hold(self, count: int = 1):
+        count = min(count, self.limit)
+        with self._cond:
+            self.waiting += 1
+            try:
+                self._cond.wait_for(lambda: self.in_use + count <= self.limit)
+            finally:
+                self.waiting -= 1
+            self.in_use += count
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= count
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"limit": self.limit, "in_use": self.in_use, "waiting": self.waiting}
+
+segment_connections = ConnectionLimiter(SEGMENT_GLOBAL_CONNECTIONS)
+segment_executor = ThreadPoolExecutor(max_workers=SEGMENT_GLOBAL_CONNECTIONS, thread_name_prefix="segment")
+
+class RangeNotSupported(Exception):
+    """The server ignored our Range header; the part has to be fetched in one go."""
+
+def fetch_segment(url: str, start: int, end: int, size: int, abort: threading.Event, on_data, headers: Optional[dict] = None):
+    """Fetches bytes start..end (inclusive), calling on_data(offset, data) in order and
+    resuming after dropped connections."""
+    pos = start
+    attempt = 0
+    while pos <= end:
+        if abort.is_set():
+            return
+        req = urllib.request.Request(url, headers={**SEGMENT_HEADERS, **(headers or {}), "Range": f"bytes={pos}-{end}"})
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                if resp.status != 206 and not (resp.status == 200 and pos == 0 and end == size - 1):
+                    raise RangeNotSupported(f"HTTP {resp.status} for a range request")
+                while pos <= end:
+                    # read1: hand over whatever has arrived instead of waiting for a full buffer
+                    data = resp.read1(min(SEGMENT_READ_SIZE, end - pos + 1))
+                    if not data:
+                        break
+                    on_data(pos, data)
+                    pos += len(data)
+                    if abort.is_set():
+                        return
+        except (RangeNotSupported, BrokenPipeError):
+            raise
+        except Exception as e:
+            attempt += 1
+            if attempt > SEGMENT_RETRIES:
+                raise
+            logger.warning(f"Segment {start}-{end} failed at {pos} ({e}), retrying")
+            time.sleep(0.5 * attempt)
+
+def fetch_parts(parts, connections: int = SEGMENT_CONNECTIONS, on_progress=None):
+    """Downloads parts [(url, size, path)] concurrently over at most `connections`
+    connections. on_progress(index, downloaded, total) is called from worker threads."""
+    segments = []
+    for index, (url, size, path) in enumerate(parts):
+        if not size:
+            raise ValueError(f"Unknown size for part {index}")
+        with open(path, "wb") as f:
+            f.truncate(size)  # preallocate; segments are written in place
+        segments.append([(index, start, min(start + SEGMENT_SIZE, size) - 1)
+                         for start in range(0, size, SEGMENT_SIZE)])
+    # Interleave so every part (e.g. the small audio stream) starts right away
+    queue = deque(seg for group in itertools.zip_longest(*segments) for seg in group if seg)
+
+    lock = threading.Lock()
+    downloaded = [0] * len(parts)
+    abort = threading.Event()
+
+    def worker():
+        handles = {}
+        try:
+            while not abort.is_set():
+                with lock:
+                    if not queue:
+                        return
+                    index, start, end = queue.popleft()
+                url, size, path = parts[index]
+                fh = handles.get(index)
+                if fh is None:
+                    fh = handles[index] = open(path, "r+b")
+
+                def on_data(pos, data, fh=fh, index=index, size=size):
+                    fh.seek(pos)
+                    fh.write(data)
+                    with lock:
+                        downloaded[index] += len(data)
+                        done = downloaded[index]
+                    if on_progress:
+                        on_progress(index, done, size)
+
+                with segment_connections.hold():
+                    fetch_segment(url, start, end, size, abort, on_data)
+        except Exception:
+            abort.set()
+            raise
+        finally:
+            for fh in handles.values():
+                fh.close()
+
+    futures = [segment_executor.submit(worker) for _ in range(max(1, min(connections, len(queue))))]
+    errors = [f.exception() for f in futures]
+    errors = [e for e in errors if e is not None]
+    if errors:
+        raise errors[0]
+
+def download_streams(streams, filenames, progress: ProgressReporter):
+    """Downloads pytubefix streams into DOWNLOADS_DIR with fetch_parts, falling back to
+    pytubefix's own sequential download if that fails. Returns the file paths."""
+    paths = [str(DOWNLOADS_DIR / name) for name in filenames]
+    try:
+        parts = [(stream.url, stream.filesize, path) for stream, path in zip(streams, paths)]
+        fetch_parts(parts, on_progress=lambda index, done, total: progress.update(
+            f"itag{streams[index].itag}", done, total, force=done == total))
+        return paths
+    except DownloadCancelled:
+        raise
+    except Exception as e:
+        logger.warning(f"Segmented download failed ({e}), falling back to sequential download")
+        for path in paths:
+            cleanup_file(path)
+    return [stream.download(output_path=str(DOWNLOADS_DIR), filename=name) for stream, name in zip(streams, filenames)]
+
+# --- Streaming workers ---
+# /video/download_link streams through pre-forked workers that already have
+# yt-dlp imported, instead of starting the yt-dlp CLI for every request.
+# 0 disables the pool (the default on the desktop app and on Windows).
+STREAM_WORKERS = int(os.environ.get("STREAM_WORKERS", "2" if IS_SERVER else "0"))
+STREAM_WORKER_MAX_JOBS = int(os.environ.get("STREAM_WORKER_MAX_JOBS", "20"))
+# How long a stream waits for a free worker before it starts the yt-dlp CLI instead
+STREAM_WORKER_WAIT = float(os.environ.get("STREAM_WORKER_WAIT", "2"))
+
+stream_workers = None
+if STREAM_WORKERS > 0 and StreamWorkerPool.supported():
+    stream_workers = StreamWorkerPool(STREAM_WORKERS, STREAM_WORKER_MAX_JOBS)
+
+@app.on_event("startup")
+async def start_stream_workers():
+    if stream_workers:
+        await stream_workers.start()
+
+@app.on_event("shutdown")
+async def stop_stream_workers():
+    if stream_workers:
+        await stream_workers.stop()
+
+@app.get("/debug/stream_workers")
+async def debug_stream_workers():
+    if not stream_workers:
+        return {"enabled": False}
+    return {"enabled": True, **stream_workers.stats()}
+
+# --- Stream supervision ---
+# Every /video/download_link stream gets an idle and a wall-clock timeout, and
+# its yt-dlp/ffmpeg child is terminated (then killed) when the client goes away
+# so aborted downloads don't keep eating bandwidth in the background.
+STREAM_IDLE_TIMEOUT = float(os.environ.get("STREAM_IDLE_TIMEOUT", "60"))
+STREAM_MAX_SECONDS = float(os.environ.get("STREAM_MAX_SECONDS", "7200"))
+STREAM_KILL_GRACE = float(os.environ.get("STREAM_KILL_GRACE", "5"))
+STDERR_TAIL_LINES = 50
+
+class StreamFailed(Exception):
+    """The streaming subprocess exited with an error. Carries the tail of its stderr."""
+
+stream_stats = {"active": 0, "started": 0, "completed": 0, "failed": 0, "aborted": 0, "timed_out": 0}
+stream_ttfb = {}  # pipeline kind -> recent seconds from request to first byte
+
+async def terminate_process(process):
+    """SIGTERM, then SIGKILL after STREAM_KILL_GRACE seconds, and always reap the child."""
+    if process.returncode is not None:
+        return
+    try:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), STREAM_KILL_GRACE)
+        except asyncio.TimeoutError:
+            logger.warning(f"Process {process.pid} ignored SIGTERM, killing it")
+            process.kill()
+            await process.wait()
+    except ProcessLookupError:
+        pass
+
+@contextlib.contextmanager
+def track_subprocess():
+    """Counts a child process we spawned for as long as the block runs (threads or event loop)."""
+    with subprocess_lock:
+        subprocess_stats["active"] += 1
+        subprocess_stats["started"] += 1
+    try:
+        yield
+    finally:
+        with subprocess_lock:
+            subprocess_stats["active"] -= 1
+
+async def discard_stream(reader):
+    while await reader.read(64 * 1024):
+        pass
+
+async def subprocess_stream(cmd, pass_fds=(), on_spawn=None):
+    """Yields a subprocess's stdout. stderr is drained concurrently into a bounded
+    ring buffer so a chatty child can't block on a full pipe."""
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL if pass_fds else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        pass_fds=pass_fds
+    )
+    if on_spawn is not None:
+        on_spawn(process)
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+
+    async def drain_stderr():
+        async for line in process.stderr:
+            stderr_tail.append(line.decode('utf-8', errors='replace').rstrip())
+
+    drain_task = asyncio.ensure_future(drain_stderr())
+    with track_subprocess():
+        try:
+            while True:
+                chunk = await process.stdout.read(64 * 1024) # 64KB chunks
+                if not chunk:
                     break
                 yield chunk
-            
+
             await process.wait()
+            await drain_task
             if process.returncode != 0:
-                 err = await process.stderr.read()
-                 logger.error(f"Stream error: {err.decode()}")
+                raise StreamFailed("\n".join(stderr_tail) or f"exit code {process.returncode}")
+        finally:
+            # Keep reading stdout while the child goes down: a child blocked on a full pipe
+            # can't act on SIGTERM, and asyncio only reports the exit once the pipe hits EOF
+            discard_task = asyncio.ensure_future(discard_stream(process.stdout))
+            await terminate_process(process)
+            discard_task.cancel()
+            drain_task.cancel()
 
-        # 4. Return Response
-        media_type = "audio/mpeg" if format == "mp3" else "video/mp4"
+async def close_stream_source(source, pending):
+    """Stops a stream source. Runs as its own task: when the client disconnects, the
+    request's cancel scope would cancel any await made in the response generator."""
+    if pending is not None and not pending.done():
+        pending.cancel()
+        await asyncio.wait({pending})
+    try:
+        await source.aclose()
+    except Exception as e:
+        logger.warning(f"Error while closing stream: {e}")
+
+background_tasks_refs = set()
+
+def spawn_background(coro):
+    """ensure_future() that keeps a reference until the task is done."""
+    task = asyncio.ensure_future(coro)
+    background_tasks_refs.add(task)
+    task.add_done_callback(background_tasks_refs.discard)
+    return task
+
+async def supervise_stream(source, label: str, on_outcome=None, kind: str = "ytdlp", started_at: Optional[float] = None,
+                           served: bool = True):
+    """Relays chunks from source, enforcing idle/wall-clock timeouts and counting outcomes.
+    on_outcome(outcome) is called when the stream ends, whatever the reason. Time to
+    first byte is measured from started_at (loop time of the request) per kind.
+    served=False when the chunks go to a tee file rather than to the client."""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + STREAM_MAX_SECONDS
+    started_at = started_at if started_at is not None else loop.time()
+    first_byte = True
+    outcome = "aborted"  # unless we get to the end: the client went away
+    pending = None
+    stream_stats["active"] += 1
+    stream_stats["started"] += 1
+    try:
+        while True:
+            timeout = min(STREAM_IDLE_TIMEOUT, deadline - loop.time())
+            pending = asyncio.ensure_future(source.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=max(timeout, 0.001))
+            if not done:
+                outcome = "timed_out"
+                logger.warning(f"Stream timed out ({'idle' if timeout == STREAM_IDLE_TIMEOUT else 'wall clock'}): {label}")
+                break
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                outcome = "completed"
+                break
+            except (StreamFailed, StreamWorkerError) as e:
+                outcome = "failed"
+                logger.error(f"Stream error: {e}")
+                break
+            pending = None
+            if first_byte:
+                first_byte = False
+                stream_ttfb.setdefault(kind, deque(maxlen=512)).append(loop.time() - started_at)
+                stream_ttfb_seconds.observe(loop.time() - started_at, kind=kind)
+                record_phase("first_byte", loop.time() - started_at)
+            if served:
+                bytes_served.inc(len(chunk), route="stream")
+            yield chunk
+    finally:
+        spawn_background(close_stream_source(source, pending))
+        stream_stats["active"] -= 1
+        stream_stats[outcome] += 1
+        stream_seconds.observe(loop.time() - started_at, kind=kind, outcome=outcome)
+        if outcome == "aborted":
+            logger.info(f"Client disconnected, stream stopped: {label}", extra={"sample_key": "stream disconnect"})
+        if on_outcome is not None:
+            on_outcome(outcome)
+
+@app.get("/debug/streams")
+async def debug_streams():
+    """Counters for /video/download_link streams, and time to first byte per pipeline."""
+    ttfb = {}
+    for kind, samples in stream_ttfb.items():
+        ordered = sorted(samples)
+        ttfb[kind] = {
+            "count": len(ordered),
+            "p50": round(ordered[len(ordered) // 2], 3),
+            "p95": round(ordered[int(len(ordered) * 0.95)], 3),
+            "max": round(ordered[-1], 3),
+        }
+    return {**stream_stats, "ttfb": ttfb}
+
+# --- Pipe mux ---
+# Adaptive (separate video + audio) formats are merged by an ffmpeg that reads
+# both streams from pipes fed by our own HTTP fetchers, instead of downloading
+# two part files and merging them afterwards. Streams get fragmented MP4 so
+# the first bytes go out within seconds; materialised files get faststart MP4.
+# Needs inheritable pipe fds, so POSIX only; Windows keeps the part files.
+PIPE_MUX = os.environ.get("PIPE_MUX", "1") != "0" and os.name == "posix"
+FRAGMENTED_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+# DASH/m4a/webm carry their headers up front; ffmpeg's default 5 MB probe would delay the first output byte
+PIPE_PROBE_ARGS = ["-probesize", "256k", "-analyzeduration", "1000000"]
+
+def feed_pipe(fd: int, url: str, headers: Optional[dict], size: Optional[int], on_progress=None):
+    """Thread target: writes a remote stream into a pipe in SEGMENT_SIZE range requests.
+    Pipe writes block while ffmpeg is busy, which bounds memory to the pipe buffer."""
+    sent = 0
+    try:
+        with os.fdopen(fd, "wb") as pipe:
+            def on_data(pos, data):
+                nonlocal sent
+                pipe.write(data)
+                sent += len(data)
+                if on_progress:
+                    on_progress(sent, size)
+
+            if size:
+                never = threading.Event()
+                for start in range(0, size, SEGMENT_SIZE):
+                    fetch_segment(url, start, min(start + SEGMENT_SIZE, size) - 1, size, never, on_data, headers)
+            else:
+                req = urllib.request.Request(url, headers={**SEGMENT_HEADERS, **(headers or {})})
+                with urllib.request.urlopen(req, timeout=30) as resp:
+                    while True:
+                        data = resp.read1(SEGMENT_READ_SIZE)
+                        if not data:
+                            break
+                        on_data(sent, data)
+    except BrokenPipeError:
+        pass  # ffmpeg exited (client went away, or it failed and says why on stderr)
+    except Exception as e:
+        # Closing the pipe early makes ffmpeg fail with a truncated-input error
+        logger.error(f"Feeding {url[:80]} to ffmpeg failed after {sent} bytes: {e}")
+
+def mux_cmd(ffmpeg_exe: str, read_fds, codec_args, output: str, fragmented: bool):
+    cmd = [ffmpeg_exe, "-hide_banner", "-loglevel", "error", "-y"]
+    for fd in read_fds:
+        cmd.extend([*PIPE_PROBE_ARGS, "-i", f"pipe:{fd}"])
+    cmd.extend(["-map", "0:v:0", "-map", "1:a:0", *codec_args])
+    if fragmented:
+        cmd.extend(["-movflags", FRAGMENTED_MOVFLAGS, "-f", "mp4"])
+    else:
+        cmd.extend(["-movflags", "+faststart"])
+    cmd.append(output)
+    return cmd
+
+def start_feeders(pipes, inputs, on_progress=None):
+    """Closes our copies of the read ends (ffmpeg has its own) and starts one feeder per input
+    once there are segment_connections slots for all of them; ffmpeg waits on its pipes until then."""
+    for read_fd, _ in pipes:
+        os.close(read_fd)
+
+    def run():
+        with segment_connections.hold(len(inputs)):
+            feeders = []
+            for index, ((_, write_fd), (url, headers, size)) in enumerate(zip(pipes, inputs)):
+                callback = functools.partial(on_progress, index) if on_progress else None
+                feeders.append(threading.Thread(target=feed_pipe, args=(write_fd, url, headers, size, callback),
+                                                name="mux-feeder", daemon=True))
+            for feeder in feeders:
+                feeder.start()
+            for feeder in feeders:
+                feeder.join()
+
+    threading.Thread(target=run, name="mux-feeders", daemon=True).start()
+
+def mp3_cmd(ffmpeg_exe: str, read_fd: int, codec_args):
+    return [ffmpeg_exe, "-hide_banner", "-loglevel", "error", *PIPE_PROBE_ARGS, "-i", f"pipe:{read_fd}",
+            "-vn", "-map", "0:a:0", *codec_args, "-f", "mp3", "pipe:1"]
+
+def mux_stream(ffmpeg_exe: str, inputs, codec_args):
+    """Stream source: fragmented MP4 merged from inputs [(url, headers, size)], video first."""
+    return pipe_stream(inputs, lambda read_fds: mux_cmd(ffmpeg_exe, read_fds, codec_args, "pipe:1", fragmented=True))
+
+def mp3_stream(ffmpeg_exe: str, audio_input, codec_args):
+    """Stream source: mp3 frames as ffmpeg produces them from one (url, headers, size) input."""
+    return pipe_stream([audio_input], lambda read_fds: mp3_cmd(ffmpeg_exe, read_fds[0], codec_args))
+
+async def pipe_stream(inputs, build_cmd):
+    """Stream source: stdout of the ffmpeg command build_cmd(read_fds), fed inputs
+    [(url, headers, size)] over pipes. Memory stays at a few pipe buffers per stream."""
+    pipes = [os.pipe() for _ in inputs]
+    spawned = False
+
+    def on_spawn(process):
+        nonlocal spawned
+        spawned = True
+        start_feeders(pipes, inputs)
+
+    inner = subprocess_stream(build_cmd([r for r, _ in pipes]), pass_fds=[r for r, _ in pipes], on_spawn=on_spawn)
+    try:
+        async for chunk in inner:
+            yield chunk
+    finally:
+        await inner.aclose()
+        if not spawned:
+            for read_fd, write_fd in pipes:
+                os.close(read_fd)
+                os.close(write_fd)
+
+def mux_to_file(ffmpeg_exe: str, inputs, output: str, codec_args, on_progress=None):
+    """Blocking: merges inputs [(url, headers, size)] straight into a faststart MP4 file."""
+    pipes = [os.pipe() for _ in inputs]
+    try:
+        process = subprocess.Popen(
+            mux_cmd(ffmpeg_exe, [r for r, _ in pipes], codec_args, output, fragmented=False),
+            stdin=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            pass_fds=[r for r, _ in pipes],
+        )
+    except Exception:
+        for read_fd, write_fd in pipes:
+            os.close(read_fd)
+            os.close(write_fd)
+        raise
+    start_feeders(pipes, inputs, on_progress)
+    with track_subprocess():
+        _, stderr = process.communicate()
+    if process.returncode != 0:
+        cleanup_file(output)
+        raise Exception(f"ffmpeg mux failed: {stderr.decode('utf-8', errors='replace').strip()[-500:]}")
+
+def pipe_mux_inputs(info: dict, selection: dict):
+    """For a merged selection (see select_formats), returns ([(url, headers, size)], RemuxPlan)
+    if video + audio can be fed to ffmpeg over plain HTTP, else None (HLS/DASH fragments, ...)."""
+    formats = selection["formats"]
+    if len(formats) != 2:
+        return None
+    if any(f.get('protocol') not in ('http', 'https') or f.get('fragments') for f in formats):
+        return None
+    video, audio = sorted(formats, key=lambda f: f.get('vcodec') in (None, 'none'))
+    inputs = [(f['url'], f.get('http_headers'), f.get('filesize')) for f in (video, audio)]
+
+    def probe_key(f):
+        # YouTube itags always map to the same codec; elsewhere format ids are per video
+        if info.get('extractor_key') == 'Youtube':
+            return f"Youtube:{f['format_id']}"
+        return f"{info.get('extractor_key')}:{info.get('id')}:{f['format_id']}"
+
+    video_codec = probe_cache.probe(probe_key(video), video['url'], video.get('http_headers')).get("video")
+    audio_codec = probe_cache.probe(probe_key(audio), audio['url'], audio.get('http_headers')).get("audio")
+    return inputs, plan_remux(video_codec or normalize_codec(video.get('vcodec')),
+                              audio_codec or normalize_codec(audio.get('acodec')))
+
+def pipe_audio_input(info: dict, selection: dict):
+    """Like pipe_mux_inputs for an audio selection: ((url, headers, size), codec) or None."""
+    if selection["merged"]:
+        return None
+    audio = selection["formats"][0]
+    if audio.get('protocol') not in ('http', 'https') or audio.get('fragments') or not audio.get('url'):
+        return None
+    if info.get('extractor_key') == 'Youtube':
+        key = f"Youtube:{audio['format_id']}"
+    else:
+        key = f"{info.get('extractor_key')}:{info.get('id')}:{audio.get('format_id')}"
+    codec = probe_cache.probe(key, audio['url'], audio.get('http_headers')).get("audio")
+    return (audio['url'], audio.get('http_headers'), audio.get('filesize')), codec or normalize_codec(audio.get('acodec'))
+
+# --- Remux planner ---
+# Merges used to re-encode audio to AAC every time. The source codecs are now
+# probed with ffprobe (cached per format id) and each stream is copied when
+# MP4 can hold it as is, transcoded only when it can't.
+PROBE_CACHE_MAX = 1024
+PROBE_TIMEOUT = 15
+MP4_VIDEO_CODECS = {"h264", "hevc", "av1", "vp9", "mpeg4"}
+MP4_AUDIO_CODECS = {"aac", "mp3", "alac", "ac3", "eac3"}  # no Opus/Vorbis: Apple players won't play them
+CODEC_ALIASES = {
+    "avc1": "h264", "avc3": "h264", "hev1": "hevc", "hvc1": "hevc", "av01": "av1",
+    "vp09": "vp9", "vp9": "vp9", "vp8": "vp8", "mp4a": "aac", "opus": "opus",
+    "vorbis": "vorbis", "mp3": "mp3", "ac-3": "ac3", "ec-3": "eac3", "flac": "flac",
+}
+
+def normalize_codec(codec: Optional[str]) -> Optional[str]:
+    """Maps RFC 6381 / yt-dlp codec strings ("avc1.64001F", "mp4a.40.2") to ffmpeg codec names."""
+    if not codec or codec == "none":
+        return None
+    codec = codec.lower()
+    return CODEC_ALIASES.get(codec.split(".")[0], codec)
+
+class ProbeCache:
+    """ffprobe results keyed by format id, in LRU order."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def probe(self, key: str, source: str, headers: Optional[dict] = None) -> dict:
+        """Returns {"video": codec, "audio": codec} (either may be None). Empty dict
+        if ffprobe isn't available or fails; callers then fall back to metadata."""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        result = self._run_ffprobe(source, headers)
+        if result is None:
+            return {}
+        with self._lock:
+            self._entries[key] = result
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
+
+    def _run_ffprobe(self, source: str, headers: Optional[dict]):
+        ffprobe = toolchain.get("ffprobe")
+        if not ffprobe:
+            return None
+        cmd = [ffprobe, "-v", "error", "-show_entries", "stream=codec_type,codec_name", "-of", "json"]
+        if headers and source.startswith("http"):
+            cmd.extend(["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())])
+        cmd.append(source)
+        try:
+            out = subprocess.run(cmd, capture_output=True, timeout=PROBE_TIMEOUT, check=True).stdout
+            streams = json.loads(out).get("streams", [])
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"ffprobe failed for {source[:80]}: {e}")
+            return None
+        result = {"video": None, "audio": None}
+        for stream in streams:
+            kind = stream.get("codec_type")
+            if kind in result and result[kind] is None:
+                result[kind] = stream.get("codec_name")
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses, "failures": self.failures}
+
+probe_cache = ProbeCache(PROBE_CACHE_MAX)
+
+class RemuxPlan:
+    """How each stream of a video + audio merge into MP4 is handled."""
+
+    def __init__(self, video_codec: Optional[str], audio_codec: Optional[str]):
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        # Unknown video was always copied before; keep doing that
+        self.video = "transcode" if video_codec and video_codec not in MP4_VIDEO_CODECS else "copy"
+        self.audio = "copy" if audio_codec in MP4_AUDIO_CODECS else "transcode"
+
+    @property
+    def args(self):
+        args = ["-c:v", "copy"] if self.video == "copy" else ["-c:v", "libx264", "-preset", "veryfast"]
+        args += ["-c:a", "copy"] if self.audio == "copy" else ["-c:a", "aac"]
+        return args
+
+    @property
+    def mode(self) -> str:
+        return "copy" if self.video == self.audio == "copy" else "transcode"
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "video": self.video,
+            "audio": self.audio,
+            "video_codec": self.video_codec,
+            "audio_codec": self.audio_codec,
+        }
+
+def plan_remux(video_codec: Optional[str], audio_codec: Optional[str]) -> RemuxPlan:
+    plan = RemuxPlan(video_codec, audio_codec)
+    logger.info(f"Remux plan: video {video_codec} -> {plan.video}, audio {audio_codec} -> {plan.audio}")
+    return plan
+
+MP3_QUALITY_RE = re.compile(r"^(?:(?P<vbr>[0-9])|(?P<kbps>\d{2,3})[kK]?)$")
+MP3_BITRATES = {32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320}
+
+def mp3_codec_args(audio_codec: Optional[str], audio_quality: str):
+    """ffmpeg args for mp3 output. audio_quality is yt-dlp style: 0-9 for LAME VBR
+    (0 = best) or a CBR bitrate such as 192k. mp3 sources are copied as they are."""
+    if audio_codec == "mp3":
+        return ["-c:a", "copy"], "copy"
+    match = MP3_QUALITY_RE.match(audio_quality or "0")
+    if match is None or (match.group("kbps") and int(match.group("kbps")) not in MP3_BITRATES):
+        raise ValueError(f"Invalid mp3 quality {audio_quality!r}: use 0-9 (VBR) or one of "
+                         f"{', '.join(f'{b}k' for b in sorted(MP3_BITRATES))}")
+    if match.group("vbr"):
+        return ["-c:a", "libmp3lame", "-q:a", match.group("vbr")], "transcode"
+    return ["-c:a", "libmp3lame", "-b:a", f"{match.group('kbps')}k"], "transcode"
+
+remux_stats = {
+    "merges": {"copy": 0, "transcode": 0},
+    "streams": {"video_copy": 0, "video_transcode": 0, "audio_copy": 0, "audio_transcode": 0},
+    "merge_seconds": {"copy": 0.0, "transcode": 0.0},
+}
+
+def record_remux(plan: RemuxPlan, seconds: Optional[float] = None):
+    remux_stats["merges"][plan.mode] += 1
+    remux_stats["streams"][f"video_{plan.video}"] += 1
+    remux_stats["streams"][f"audio_{plan.audio}"] += 1
+    if seconds is not None:
+        remux_stats["merge_seconds"][plan.mode] += seconds
+        merge_seconds.observe(seconds, mode=plan.mode)
+        record_phase("merge", seconds)
+
+@app.get("/debug/remux")
+async def debug_remux():
+    """Copy vs transcode decisions; merge_seconds is ffmpeg wall time for materialised merges."""
+    return {**remux_stats, "probe_cache": probe_cache.stats()}
+
+# --- Stream tee ---
+# /video/download_link streams are also written to a hidden file in the
+# Downloads dir. A stream that completes is promoted into the download store
+# (under its own "+stream" format), so the next request is served from disk.
+# Requests arriving while it is still being fetched follow the growing file
+# instead of fetching again. Only a file of the container a lookup asks for is
+# promoted: merged streams from the yt-dlp CLI are MPEG-TS, which would use
+# store quota without ever being served.
+# Off by default on the desktop app: its Downloads dir is the user's own folder,
+# with no store budget and no janitor, so every stream would leave a second copy.
+STREAM_TEE = os.environ.get("STREAM_TEE", "1" if IS_SERVER else "0") != "0"
+TEE_CHUNK_SIZE = 64 * 1024
+
+class StreamTee:
+    def __init__(self, key: str, path: Path, quality: Optional[str], download_name: str, container: str):
+        self.key = key
+        self.path = path
+        self.quality = quality
+        self.download_name = download_name
+        self.container = container
+        self.written = 0
+        self.readers = 0
+        self.outcome = None
+        self.task = None
+        self._file = open(path, "wb")
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.outcome is not None
+
+    def _bump(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def pump(self, source, label: str, **supervise_kwargs):
+        """Drains the upstream stream into the file. Runs as its own task so it
+        outlives any single client; cancelled once the last reader is gone."""
+        def record(outcome):
+            self.outcome = outcome
+
+        try:
+            async for chunk in supervise_stream(source, label, on_outcome=record, served=False, **supervise_kwargs):
+                # Page-cache write of one chunk; not worth a thread hop
+                self._file.write(chunk)
+                self._file.flush()
+                self.written += len(chunk)
+                self._bump()
+        finally:
+            self._file.close()
+            if self.outcome is None:
+                self.outcome = "aborted"
+            self._bump()
+
+    def open_reader(self):
+        """Registers a reader. Must be called synchronously when the tee is found
+        (not from inside the generator) so the file is open before it can be promoted."""
+        self.readers += 1
+        return self.follow(open(self.path, "rb"))
+
+    async def follow(self, f):
+        """Yields the file's bytes, waiting for more until the pump is done."""
+        try:
+            pos = 0
+            while True:
+                if pos < self.written:
+                    chunk = f.read(min(TEE_CHUNK_SIZE, self.written - pos))
+                    pos += len(chunk)
+                    bytes_served.inc(len(chunk), route="stream")
+                    yield chunk
+                elif self.done:
+                    break
+                else:
+                    await self._changed.wait()
+        finally:
+            # No awaits here: when the client disconnected we are inside a cancelled scope
+            f.close()
+            self.readers -= 1
+            if self.readers == 0:
+                if not self.done and self.task is not None:
+                    self.task.cancel()
+                stream_tees.finish_when_idle(self)
+
+class StreamTeeManager:
+    def __init__(self):
+        self._tees = {}  # store key -> StreamTee
+        self.started = 0
+        self.followers = 0
+        self.promoted = 0
+        self.discarded = 0
+        self.unservable = 0
+
+    def get(self, key: str) -> Optional[StreamTee]:
+        tee = self._tees.get(key)
+        if tee is not None:
+            self.followers += 1
+        return tee
+
+    def start(self, key: str, source, label: str, download_name: str, quality: Optional[str], container: str,
+              **supervise_kwargs) -> StreamTee:
+        path = DOWNLOADS_DIR / f"{TEE_NAME_PREFIX}{uuid.uuid4().hex}{os.path.splitext(download_name)[1]}"
+        file_leases.acquire(path.name)
+        tee = StreamTee(key, path, quality, download_name, container)
+        self._tees[key] = tee
+        tee.task = spawn_background(tee.pump(source, label, **supervise_kwargs))
+        tee.task.add_done_callback(lambda _: self.finish_when_idle(tee))
+        self.started += 1
+        return tee
+
+    def finish_when_idle(self, tee: StreamTee):
+        """Promotes or discards the file once the pump is done and nobody is reading
+        it any more (Windows can't rename or delete a file that is still open)."""
+        if not tee.done or tee.readers or self._tees.get(tee.key) is not tee:
+            return
+        if not tee.task.done():
+            return  # pump still closing the file; its done callback calls us again
+        del self._tees[tee.key]
+        spawn_background(self._finish(tee))
+
+    async def _finish(self, tee: StreamTee):
+        loop = asyncio.get_event_loop()
+        try:
+            if tee.outcome == "completed" and tee.written:
+                container = await loop.run_in_executor(None, sniff_container, tee.path)
+                if container != tee.container:
+                    self.unservable += 1
+                    logger.info(f"Not storing streamed download {tee.key}: {container or 'unknown'} container, "
+                                f"not {tee.container}")
+                else:
+                    try:
+                        dest = await loop.run_in_executor(None, download_store.put, tee.path, [tee.key], tee.quality,
+                                                          tee.download_name)
+                        self.promoted += 1
+                        logger.info(f"Stored streamed download {tee.key} as {dest.name} ({tee.written} bytes)")
+                        return
+                    except Exception as e:
+                        logger.warning(f"Failed to store streamed download {tee.key}: {e}")
+            self.discarded += 1
+            await loop.run_in_executor(None, cleanup_file, str(tee.path))
+        finally:
+            file_leases.release(tee.path.name)
+
+    def stats(self):
+        return {
+            "enabled": STREAM_TEE,
+            "active": len(self._tees),
+            "readers": sum(t.readers for t in self._tees.values()),
+            "started": self.started,
+            "followers": self.followers,
+            "promoted": self.promoted,
+            "discarded": self.discarded,
+            "unservable": self.unservable,
+        }
+
+stream_tees = StreamTeeManager()
+
+@app.get("/debug/tee")
+async def debug_tee():
+    return stream_tees.stats()
+
+@app.get("/debug/cache")
+async def debug_cache():
+    """Metadata cache statistics."""
+    return metadata_cache.stats()
+
+@app.get("/debug/store")
+async def debug_store():
+    """Download store statistics (hit ratio, bytes saved, evictions)."""
+    return download_store.stats()
+
+@app.get("/debug/singleflight")
+async def debug_singleflight():
+    """Coalescing statistics for concurrent identical requests."""
+    return flights.stats()
+
+@app.get("/")
+async def root():
+    html_path = BASE_DIR / "index.html"
+    if not html_path.exists():
+        logger.error(f"index.html not found at {html_path}")
+        return {"error": "index.html not found. Please ensure it exists in the application directory."}
+    return FileResponse(html_path)
+
+@app.get("/logo.png")
+async def get_logo():
+    path = BASE_DIR / "logo.png"
+    if path.exists():
+        return FileResponse(path)
+    return FileResponse(BASE_DIR / "assets" / "logo.png") # Fallback
+
+@app.get("/favicon.ico")
+async def get_favicon():
+    path = BASE_DIR / "favicon.ico"
+    if path.exists():
+        return FileResponse(path)
+    # Check if logo.png exists and serve it as fallback? 
+    # Or just return logo.png as favicon.ico content type?
+    # Better to just return logo.png if favicon.ico missing.
+    return await get_logo()
+
+@app.get("/manifest.json")
+async def get_manifest():
+    return FileResponse(BASE_DIR / "manifest.json")
+
+@app.get("/robots.txt")
+async def get_robots():
+    return FileResponse(BASE_DIR / "robots.txt")
+
+@app.get("/sitemap.xml")
+async def get_sitemap():
+    return FileResponse(BASE_DIR / "sitemap.xml")
+
+@app.post("/video/info")
+async def get_video_info(video: VideoURL):
+    url_str = str(video.url)
+    
+    def get_info_ytdlp():
+        info, _ = extract_info_cached(url_str)
+        qualities, audio = quality_ladder(info)
+        return info, qualities, audio
+
+    try:
+        # Use yt-dlp for everything (more robust against bot detection for info fetching)
+        key = (await resolve_video_key(url_str), "info", None)
+        info, qualities, audio = await flights.do(key, lambda: extract_pool.run(get_info_ytdlp))
+        return {
+            "success": True,
+            "data": {
+                "title": info.get('title'),
+                "thumbnail": info.get('thumbnail'),
+                "duration": info.get('duration'),
+                "uploader": info.get('uploader'),
+                "view_count": info.get('view_count'),
+                "qualities": qualities,
+                "audio": audio,
+            }
+        }
+            
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error info: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+def cleanup_file(path: str) -> bool:
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+            logger.info(f"Cleaned up file: {path}", extra={"sample_key": "cleanup"})
+            return True
+    except Exception as e:
+        logger.warning(f"Failed to cleanup file {path}: {e}")
+    return False
+
+@app.get("/video/download_link")
+async def download_link_get(request: Request, url: str, background_tasks: BackgroundTasks, format: str = "best", quality: str = None,
+                            audio_quality: str = "0"):
+    url_str = url
+    started_at = asyncio.get_event_loop().time()
+    if format == "mp3":
+        try:
+            mp3_codec_args(None, audio_quality)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    ffmpeg_exe = toolchain.get("ffmpeg")
+    media_type = "audio/mpeg" if format == "mp3" else "video/mp4"
+    ext = ".mp3" if format == "mp3" else ".mp4"
+
+    try:
+        # Already materialised on disk (by /video/download, or an earlier stream): serve it
+        # with Range/ETag support instead of fetching again. The key comes from the URL
+        # alone, so a hit needs no extraction; only files that really are mp3/mp4 count
+        # (an mp3 download without ffmpeg is an m4a, which we must not serve as audio/mpeg)
+        video_key = await resolve_video_key(url_str)
+        tee_key = DownloadStore.make_key(video_key, f"{format}+stream", audio_quality if format == "mp3" else quality)
+        container = "mp3" if format == "mp3" else "mp4"
+        stored = (download_store.lookup(DownloadStore.make_key(video_key, format, quality), container)
+                  or download_store.lookup(tee_key, container))
+        if stored:
+            stored_path, _, stored_name = stored
+            if not stored_name:
+                info = metadata_cache.peek(video_key)
+                stored_name = default_filename(info, ext) if info else f"{stored_path.stem}{ext}"
+            logger.info(f"Serving {url_str} from download store: {stored_path.name}", extra={"sample_key": "stream from store"})
+            headers = {"Content-Disposition": f"attachment; filename*=utf-8''{quote(stored_name)}"}
+            return file_response(request, stored_path, media_type, headers)
+
+        # 1. Get Metadata (Title/Filename/Size) quickly
+        def get_meta():
+            info, jar_id = extract_info_cached(url_str)
+            with ydl_pool.checkout({'quiet': True, 'no_warnings': True}) as ydl:
+                filename = ydl.prepare_filename(info)
+                selection = select_formats(ydl, info, format_spec_for(format, quality))
+            return filename, jar_id, info, selection
+        
+        filesize = None
+        cookie_jar = None
+        info = None
+        selection = None
+        try:
+            suggested_filename, jar_id, info, selection = await extract_pool.run(get_meta)
+            cookie_jar = cookie_pool.get(jar_id)
+            if selection and not selection["merged"]:
+                # A single format is relayed byte for byte; merged output size is only an estimate
+                filesize = selection["filesize"]
+            filename = os.path.basename(suggested_filename)
+        except PoolSaturated:
+            raise
+        except:
+             filename = f"video_{uuid.uuid4()}.mp4"
+             # yt-dlp extracts again in the stream; give it cookies from a healthy jar
+             cookie_jar = cookie_pool.acquire(trial=False)
+
+        # Ensure correct extension
+        if format == "mp3":
+            if not filename.endswith(".mp3"):
+                filename = os.path.splitext(filename)[0] + ".mp3"
+            # Filesize is likely invalid for mp3 conversion if original was video
+            filesize = None 
+        elif not filename.endswith(".mp4"):
+             filename = os.path.splitext(filename)[0] + ".mp4"
+
+        # Proper header encoding for non-ASCII filenames (RFC 5987)
+        encoded_filename = quote(filename)
+        headers = {
+            "Content-Disposition": f"attachment; filename*=utf-8''{encoded_filename}"
+        }
+
+        if filesize and format != "mp3":
+            headers["Content-Length"] = str(filesize)
+        elif selection and format != "mp3" and (selection["filesize"] or selection["filesize_approx"]):
+            # Sum of the merged parts; close to, but not exactly, the muxed size
+            headers["X-Estimated-Content-Length"] = str(selection["filesize"] or selection["filesize_approx"])
+            headers["Access-Control-Expose-Headers"] = "Content-Disposition, X-Estimated-Content-Length"
+
+        # Someone is streaming this right now: follow their file
+        tee = stream_tees.get(tee_key) if STREAM_TEE else None
+        if tee is not None:
+            logger.info(f"Following in-progress stream of {url_str}", extra={"sample_key": "stream follow"})
+            return StreamingResponse(tee.open_reader(), media_type=media_type, headers=headers)
+
+        # 2. Construct yt-dlp command for streaming to stdout
+        # -o - : Output to stdout
+        cmd = ["yt-dlp", "--no-part", "--no-colors", "--no-check-certificate", "--quiet"]
+        # Same options for the pre-forked streaming workers
+        worker_params = {'nocheckcertificate': True, 'socket_timeout': 30, 'geo_bypass': True}
+
+        # Add deno JS runtime if available (required for modern YouTube extraction)
+        deno_path = toolchain.get("deno")
+        if deno_path:
+            cmd.extend(["--js-runtimes", f"deno:{deno_path}"])
+            worker_params['js_runtimes'] = {'deno': {'path': deno_path}}
+
+        # Anti-bot: pass the cookies the extraction worked with
+        if cookie_jar is not None:
+            cmd.extend(cookie_jar.cli_args())
+            worker_params.update(cookie_jar.cookie_opts())
+        
+        cmd.extend([
+            "--socket-timeout", "30",
+            "--geo-bypass"
+        ])
         
-        # Proper header encoding for non-ASCII filenames (RFC 5987)
-        encoded_filename = quote(filename)
-        headers = {
-            "Content-Disposition": f"attachment; filename*=utf-8''{encoded_filename}"
-        }
+        if ffmpeg_exe:
+             cmd.extend(["--ffmpeg-location", ffmpeg_exe])
+             worker_params['ffmpeg_location'] = ffmpeg_exe
         
-        if filesize and format != "mp3":
-            headers["Content-Length"] = str(filesize)
+        if format == "mp3":
+             # Audio only, convert to mp3 on the fly
+             # For mp3 conversion, we cannot know final size easily, so we omit Content-Length
+             cmd.extend(["-x", "--audio-format", "mp3", "--audio-quality", audio_quality])
+             cmd.extend(["--postprocessor-args", "ffmpeg:" + " ".join(transcoder.ffmpeg_args())])
+             worker_params['postprocessors'] = [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': audio_quality}]
+             worker_params['postprocessor_args'] = {'ffmpeg': transcoder.ffmpeg_args()}
+
+        # Pin the formats resolved from the cached metadata
+        format_spec = pinned_format_spec(selection, format, quality)
+        cmd.extend(["-f", format_spec])
+        worker_params['format'] = format_spec
+        cmd.extend(["-o", "-", url_str])
+
+        # 3. Create Generator
+        mux = None
+        mp3_pipe = None
+        if PIPE_MUX and ffmpeg_exe and selection:
+            try:
+                if format == "mp3":
+                    mp3_pipe = await extract_pool.run(pipe_audio_input, info, selection)
+                else:
+                    mux = await extract_pool.run(pipe_mux_inputs, info, selection)
+            except PoolSaturated:
+                raise
+            except Exception as e:
+                logger.warning(f"Format selection for pipe streaming failed, using yt-dlp: {e}")
+
+        kind = "ytdlp"
+        source = None
+        if mp3_pipe:
+            # Encode while the audio downloads: mp3 frames go out as ffmpeg produces them
+            audio_input, audio_codec = mp3_pipe
+            codec_args, mode = mp3_codec_args(audio_codec, audio_quality)
+            logger.info(f"Streaming {url_str} as mp3 ({audio_codec} -> {mode}, quality {audio_quality})", extra={"sample_key": "stream start"})
+            kind = "mp3"
+            if mode == "copy":
+                source = mp3_stream(ffmpeg_exe, audio_input, codec_args)
+            else:
+                source = await scheduled_stream(mp3_stream(ffmpeg_exe, audio_input, codec_args + transcoder.ffmpeg_args()),
+                                                info.get('duration'))
+        elif mux:
+            # We merge video + audio ourselves: fragmented MP4, first bytes right away
+            mux_inputs, plan = mux
+            logger.info(f"Streaming {url_str} ({format_spec}) through pipe mux ({plan.mode})", extra={"sample_key": "stream start"})
+            record_remux(plan)
+            kind = "mux"
+            headers.pop("Content-Length", None)  # merged size isn't known up front
+            if plan.mode == "copy":
+                source = mux_stream(ffmpeg_exe, mux_inputs, plan.args)
+            else:
+                source = await scheduled_stream(mux_stream(ffmpeg_exe, mux_inputs, plan.args + transcoder.ffmpeg_args()),
+                                                info.get('duration'))
+        elif stream_workers:
+            # Pre-forked worker reuses the info we already extracted. It is checked out before
+            # the response starts: waiting on a busy pool inside the body would run into the
+            # stream's idle timeout and end as an empty 200
+            worker_job = {"params": worker_params, "info": info} if info else {"params": worker_params, "url": url_str}
+            source = await stream_workers.stream(worker_job, STREAM_WORKER_WAIT)
+            if source is not None:
+                logger.info(f"Streaming {url_str} ({format_spec}) through worker pool", extra={"sample_key": "stream start"})
+            else:
+                logger.info(f"All streaming workers busy, starting yt-dlp for {url_str}", extra={"sample_key": "stream workers busy"})
+        if source is None:
+            # Log command
+            logger.info(f"Streaming command: {' '.join(cmd)}", extra={"sample_key": "stream command"})
+            source = subprocess_stream(cmd)
+
+        if format == "mp3" and not mp3_pipe:
+            # yt-dlp encodes the mp3 inside this stream
+            source = await scheduled_stream(source, info.get('duration') if info else None)
+
+        # 4. Return Response
+        if STREAM_TEE:
+            tee = stream_tees.start(tee_key, source, url_str, filename, quality, container,
+                                    kind=kind, started_at=started_at)
+            body = tee.open_reader()
+        else:
+            body = supervise_stream(source, url_str, kind=kind, started_at=started_at)
 
         return StreamingResponse(
-            iter_stream(),
+            body,
             media_type=media_type,
             headers=headers
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Stream setup failed: {e}")
         return f"Error: {e}"
 
-@app.post("/video/download")
-async def download_video(request: DownloadRequest):
-    url_str = str(request.url)
+# --- Backend router ---
+# YouTube downloads can go through pytubefix or yt-dlp. The router keeps the
+# last ROUTER_WINDOW outcomes per (backend, extractor) and sends a download to
+# the backend with the lowest expected time to a finished file first: median
+# duration over the (smoothed) success rate. ROUTER_EXPLORE of the downloads
+# go the other way round so the backup's numbers stay current.
+# If the primary hasn't received a media byte (it is still extracting) after
+# its recent p95 for that, a hedged attempt starts on the other backend. The
+# first to finish wins; the loser is stopped at its next progress callback and
+# its files are removed. A primary that fails outright falls back as before.
+ROUTER_WINDOW = int(os.environ.get("ROUTER_WINDOW", "50"))
+ROUTER_MIN_SAMPLES = int(os.environ.get("ROUTER_MIN_SAMPLES", "5"))
+ROUTER_EXPLORE = float(os.environ.get("ROUTER_EXPLORE", "0.05"))
+ROUTER_HEDGE = os.environ.get("ROUTER_HEDGE", "1") != "0"
+ROUTER_HEDGE_DEFAULT = float(os.environ.get("ROUTER_HEDGE_DEFAULT", "15"))  # before there are ROUTER_MIN_SAMPLES
+ROUTER_HEDGE_MIN = float(os.environ.get("ROUTER_HEDGE_MIN", "2"))
+BACKEND_PREFERENCE = ("pytubefix", "ytdlp")  # order while there's too little data
+
+class DownloadCancelled(Exception):
+    """Raised inside a backend attempt that lost a hedge, from its progress callbacks."""
+
+class BackendAttempt:
+    def __init__(self, backend: str, attempt_id: str, loop):
+        self.backend = backend
+        self.attempt_id = attempt_id
+        self.started = time.monotonic()
+        self.first_byte = None  # seconds until media started flowing
+        self.receiving = asyncio.Event()
+        self.cancelled = threading.Event()
+        self.task = None
+        self._loop = loop
+
+    def raise_if_cancelled(self):
+        if self.cancelled.is_set():
+            raise DownloadCancelled(f"{self.backend} attempt cancelled")
+
+    def on_progress(self):
+        """Called from the download threads on every progress callback."""
+        self.raise_if_cancelled()
+        if self.first_byte is None:
+            self.first_byte = time.monotonic() - self.started
+            self._loop.call_soon_threadsafe(self.receiving.set)
+
+class AttemptProgress(ProgressReporter):
+    """Progress of one attempt; publishes only while the attempt leads the race."""
+
+    def __init__(self, attempt: BackendAttempt, race: "BackendRace"):
+        super().__init__(functools.partial(race.publish, attempt), PROGRESS_MAX_HZ)
+        self.attempt = attempt
+
+    def raise_if_cancelled(self):
+        self.attempt.raise_if_cancelled()
+
+    def update(self, part, downloaded, total, force=False):
+        self.attempt.on_progress()
+        super().update(part, downloaded, total, force)
+
+    def set_phase(self, phase: str):
+        self.attempt.on_progress()
+        super().set_phase(phase)
+
+class BackendRace:
+    """The attempts of one download."""
+
+    def __init__(self, backends: dict, publish):
+        self.backends = backends
+        self._publish = publish
+        self.attempts = []
+
+    def publish(self, attempt: BackendAttempt, snapshot):
+        leader = next((a for a in self.attempts if a.first_byte is not None and not a.cancelled.is_set()), None)
+        if leader is None or leader is attempt:
+            self._publish(snapshot)
+
+    def start(self, backend: str, attempt_id: str) -> BackendAttempt:
+        attempt = BackendAttempt(backend, attempt_id, asyncio.get_running_loop())
+        file_leases.acquire(attempt_id)
+        attempt.task = asyncio.ensure_future(self.backends[backend](attempt_id, AttemptProgress(attempt, self)))
+        self.attempts.append(attempt)
+        return attempt
+
+    async def discard(self, attempt: BackendAttempt):
+        """Waits for a losing/failed attempt's thread to stop, then removes whatever it wrote."""
+        try:
+            await asyncio.wait({attempt.task})
+            if not attempt.task.cancelled():
+                attempt.task.exception()  # already logged or expected (DownloadCancelled)
+            await asyncio.get_event_loop().run_in_executor(None, discard_attempt_files, attempt.attempt_id)
+        finally:
+            file_leases.release(attempt.attempt_id)
+
+def discard_attempt_files(attempt_id: str):
+    with os.scandir(DOWNLOADS_DIR) as entries:
+        names = [entry.name for entry in entries]
+    for name in names:
+        match = PARTIAL_NAME_RE.match(name)
+        if match and match.group(1) == attempt_id:
+            cleanup_file(str(DOWNLOADS_DIR / name))
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class BackendRouter:
+    def __init__(self, window: int, min_samples: int, explore: float, hedge: bool,
+                 hedge_default: float, hedge_min: float):
+        self.window = window
+        self.min_samples = min_samples
+        self.explore = explore
+        self.hedge = hedge
+        self.hedge_default = hedge_default
+        self.hedge_min = hedge_min
+        self._outcomes = {}  # (backend, extractor) -> deque of (ok, seconds, first_byte or None)
+        self._lock = threading.Lock()
+        self.hedges = 0
+        self.hedges_won = 0  # by the hedged attempt
+
+    def record(self, backend: str, extractor: str, ok: bool, seconds: float, first_byte: Optional[float]):
+        with self._lock:
+            outcomes = self._outcomes.setdefault((backend, extractor), deque(maxlen=self.window))
+            outcomes.append((ok, seconds, first_byte))
+
+    def _outcomes_of(self, backend: str, extractor: str) -> list:
+        with self._lock:
+            return list(self._outcomes.get((backend, extractor), ()))
+
+    def expected_seconds(self, backend: str, extractor: str) -> Optional[float]:
+        """Median duration / smoothed success rate, or None with too few samples."""
+        outcomes = self._outcomes_of(backend, extractor)
+        if len(outcomes) < self.min_samples:
+            return None
+        successes = sum(1 for ok, _, _ in outcomes if ok)
+        success_rate = (successes + 1) / (len(outcomes) + 2)
+        return percentile([seconds for _, seconds, _ in outcomes], 0.5) / success_rate
+
+    def hedge_delay(self, backend: str, extractor: str) -> float:
+        """How long the primary may go without a media byte before the hedge starts: its recent p95."""
+        first_bytes = [fb for _, _, fb in self._outcomes_of(backend, extractor) if fb is not None]
+        if len(first_bytes) < self.min_samples:
+            return self.hedge_default
+        return max(self.hedge_min, percentile(first_bytes, 0.95))
+
+    def choose(self, extractor: str, backends: List[str]):
+        """(backends in the order to try them, reason)."""
+        if len(backends) == 1:
+            return backends, "only"
+        preferred = sorted(backends, key=lambda b: BACKEND_PREFERENCE.index(b) if b in BACKEND_PREFERENCE else len(BACKEND_PREFERENCE))
+        expected = {b: self.expected_seconds(b, extractor) for b in backends}
+        if any(e is None for e in expected.values()):
+            return preferred, "default"
+        ranked = sorted(preferred, key=lambda b: expected[b])
+        if random.random() < self.explore:
+            return ranked[1:] + ranked[:1], "explore"
+        return ranked, "score"
+
+    async def run(self, extractor: str, backends: dict, download_id: str, publish, labels: dict):
+        """Runs backends[name](attempt_id, progress) -> result as routed. The first attempt
+        uses download_id, later ones get their own id. Returns (result, winning backend)."""
+        order, reason = self.choose(extractor, list(backends))
+        router_decisions.inc(extractor=extractor, backend=order[0], reason=reason)
+        race = BackendRace(backends, publish)
+        pending = list(order[1:])
+        primary = race.start(order[0], download_id)
+        running = [primary]
+        hedged = False
+
+        if self.hedge and pending:
+            receiving = asyncio.ensure_future(primary.receiving.wait())
+            try:
+                await asyncio.wait({primary.task, receiving}, timeout=self.hedge_delay(primary.backend, extractor),
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                receiving.cancel()
+            if not primary.task.done() and not primary.receiving.is_set():
+                backend = pending.pop(0)
+                logger.info(f"{primary.backend} has no data after {time.monotonic() - primary.started:.1f}s; "
+                            f"hedging with {backend}")
+                running.append(race.start(backend, str(uuid.uuid4())))
+                hedged = True
+                self.hedges += 1
+
+        error = None
+        while running:
+            done, _ = await asyncio.wait({a.task for a in running}, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in [a for a in running if a.task in done]:
+                running.remove(attempt)
+                seconds = time.monotonic() - attempt.started
+                try:
+                    result = attempt.task.result()
+                except PoolSaturated as e:
+                    # Not the backend's fault; a hedge just doesn't happen, a lone attempt reports 429
+                    spawn_background(race.discard(attempt))
+                    if not running and error is None:
+                        raise
+                    error = error or e
+                    continue
+                except Exception as e:
+                    error = e
+                    self.record(attempt.backend, extractor, False, seconds, attempt.first_byte)
+                    spawn_background(race.discard(attempt))
+                    if running or not pending:
+                        backend_results.inc(backend=attempt.backend, result="failure", extractor=extractor)
+                        logger.warning(f"{attempt.backend} failed: {e}")
+                        continue
+                    backend = pending.pop(0)
+                    backend_results.inc(backend=attempt.backend, result="fallback", extractor=extractor)
+                    logger.warning(f"{attempt.backend} failed: {e}. Falling back to {backend}.")
+                    running.append(race.start(backend, str(uuid.uuid4())))
+                    continue
+
+                self.record(attempt.backend, extractor, True, seconds, attempt.first_byte)
+                download_seconds.observe(seconds, backend=attempt.backend, **labels)
+                record_phase("download", seconds)
+                backend_results.inc(backend=attempt.backend, result="success", extractor=extractor)
+                for loser in running:
+                    loser.cancelled.set()
+                    self.record(loser.backend, extractor, False, time.monotonic() - loser.started, loser.first_byte)
+                    backend_results.inc(backend=loser.backend, result="cancelled", extractor=extractor)
+                    logger.info(f"{attempt.backend} won; cancelling {loser.backend}")
+                    spawn_background(race.discard(loser))
+                if hedged:
+                    router_hedges.inc(extractor=extractor, primary=primary.backend, winner=attempt.backend)
+                    if attempt is not primary:
+                        self.hedges_won += 1
+                # The caller stores the file right away; the janitor's orphan grace covers it until then
+                file_leases.release(attempt.attempt_id)
+                return result, attempt.backend
+
+        if hedged:
+            router_hedges.inc(extractor=extractor, primary=primary.backend, winner="none")
+        raise error
+
+    def stats(self):
+        with self._lock:
+            keys = list(self._outcomes)
+        backends = {}
+        for backend, extractor in keys:
+            outcomes = self._outcomes_of(backend, extractor)
+            first_bytes = [fb for _, _, fb in outcomes if fb is not None]
+            expected = self.expected_seconds(backend, extractor)
+            backends.setdefault(extractor, {})[backend] = {
+                "samples": len(outcomes),
+                "success_rate": round(sum(1 for ok, _, _ in outcomes if ok) / len(outcomes), 3),
+                "p50_seconds": round(percentile([s for _, s, _ in outcomes], 0.5), 3),
+                "p95_first_byte": round(percentile(first_bytes, 0.95), 3) if first_bytes else None,
+                "expected_seconds": round(expected, 3) if expected is not None else None,
+                "hedge_delay": round(self.hedge_delay(backend, extractor), 3),
+            }
+        return {
+            "hedging": self.hedge,
+            "window": self.window,
+            "min_samples": self.min_samples,
+            "explore": self.explore,
+            "hedges": self.hedges,
+            "hedges_won_by_second_attempt": self.hedges_won,
+            "extractors": backends,
+        }
+
+backend_router = BackendRouter(ROUTER_WINDOW, ROUTER_MIN_SAMPLES, ROUTER_EXPLORE, ROUTER_HEDGE,
+                               ROUTER_HEDGE_DEFAULT, ROUTER_HEDGE_MIN)
+
+@app.get("/debug/router")
+async def debug_router():
+    return backend_router.stats()
+
+async def perform_download(request: DownloadRequest):
+    """Runs a single download (pytubefix or yt-dlp for YouTube, as routed; yt-dlp otherwise) and returns the API response."""
     download_id = str(uuid.uuid4())
+    # Everything the download writes is named after its id; keep the janitor off it until it is stored
+    with file_leases.hold(download_id):
+        return await run_download(request, download_id)
+
+async def run_download(request: DownloadRequest, download_id: str):
+    url_str = str(request.url)
+
+    video_key = await resolve_video_key(url_str)
+    store_key = DownloadStore.make_key(video_key, request.format, request.quality)
+    stored = download_store.lookup(store_key)
+    if stored:
+        stored_path, stored_quality, _ = stored
+        logger.info(f"Download store hit: {store_key} -> {stored_path.name}", extra={"sample_key": "download store hit"})
+        response_data = {
+            "download_id": download_id,
+            "filename": stored_path.name,
+            "filepath": str(stored_path),
+            "filesize": stored_path.stat().st_size,
+            "is_saved_locally": True,
+            "local_path": str(stored_path),
+            "cached": True,
+        }
+        if request.quality and stored_quality and stored_quality != request.quality and request.format != "mp3":
+            response_data["warning"] = f"Requested {request.quality} not available. Downloaded {stored_quality} instead."
+        return {"success": True, "data": response_data}
     
-    # Check for FFmpeg in current directory or PATH
-    ffmpeg_exe = "ffmpeg"
-    local_ffmpeg = BASE_DIR / "ffmpeg.exe"
-    if local_ffmpeg.exists():
-        ffmpeg_exe = str(local_ffmpeg)
-    elif shutil.which("ffmpeg"):
-         ffmpeg_exe = "ffmpeg"
-    else:
-         ffmpeg_exe = None
+    ffmpeg_exe = toolchain.get("ffmpeg")
     
     try:
-        filename = ""
-        filepath = ""
-        warning_msg = None
-        
-        # Flag to indicate if we should fallback to yt-dlp
-        use_ytdlp_fallback = False
-        
-        if is_youtube_url(url_str):
-            try:
-                # --- YOUTUBE DOWNLOAD (PYTUBEFIX) ---
-                def download_pytube(download_id):
-                    # Try with OAuth allowed to potentially fix bot issues if user authenticates
-                    yt = YouTube(url_str, use_oauth=True, allow_oauth_cache=True)
-                    stream = None
-                    merged_path = None
-                    final_res = None
-                    
-                    if request.format == "mp3":
-                        stream = yt.streams.get_audio_only()
-                        ext = ".m4a" 
-                    else:
-                        # VIDEO HANDLING
-                        target_res = request.quality
-                        
-                        # 1. Try Progressive (simplest, fastest)
-                        if target_res:
-                            stream = yt.streams.filter(res=target_res, progressive=True).first()
-                        
-                        # 2. Try Adaptive (DASH) + Merge if Progressive failed and FFmpeg available
-                        if not stream and ffmpeg_exe and target_res:
-                             # Find video only stream
-                             video_stream = yt.streams.filter(res=target_res, adaptive=True).first()
+        # --- YOUTUBE DOWNLOAD (PYTUBEFIX) ---
+        def download_pytube(attempt_id, progress, remux_info):
+            # Try with OAuth allowed to potentially fix bot issues if user authenticates
+            yt = lazy_import("pytubefix").YouTube(url_str, use_oauth=True, allow_oauth_cache=True,
+                                                  on_progress_callback=progress.pytube_callback)
+            stream = None
+            merged_path = None
+            final_res = None
+            
+            if request.format == "mp3":
+                stream = yt.streams.get_audio_only()
+                ext = ".m4a" 
+            else:
+                # VIDEO HANDLING
+                target_res = request.quality
+                
+                # 1. Try Progressive (simplest, fastest)
+                if target_res:
+                    stream = yt.streams.filter(res=target_res, progressive=True).first()
+                
+                # 2. Try Adaptive (DASH) + Merge if Progressive failed and FFmpeg available
+                if not stream and ffmpeg_exe and target_res:
+                     # Find video only stream
+                     video_stream = yt.streams.filter(res=target_res, adaptive=True).first()
+                     
+                     if video_stream:
+                         audio_stream = yt.streams.get_audio_only()
+                         if audio_stream:
+                             out_name = f"{attempt_id}.mp4"
+                             out_path = DOWNLOADS_DIR / out_name
+                             parts = [video_stream, audio_stream]
+
+                             # Copy whatever MP4 can hold as is (itags map to fixed codecs)
+                             plan = plan_remux(
+                                 probe_cache.probe(f"Youtube:{video_stream.itag}", video_stream.url).get("video")
+                                 or normalize_codec(video_stream.video_codec),
+                                 probe_cache.probe(f"Youtube:{audio_stream.itag}", audio_stream.url).get("audio")
+                                 or normalize_codec(audio_stream.audio_codec),
+                             )
+                             remux_info["plan"] = plan.to_dict()
+
+                             def merge_slot():
+                                 # Stream copies are I/O bound; only encoders queue for a slot
+                                 if plan.mode == "copy":
+                                     return contextlib.nullcontext()
+                                 return transcoder.slot(PRIORITY_BACKGROUND, yt.length)
+                             merge_args = plan.args if plan.mode == "copy" else plan.args + transcoder.ffmpeg_args()
+
+                             if PIPE_MUX:
+                                 # Fetch and merge in a single pass, no part files
+                                 logger.info(f"Pipe-muxing adaptive streams: {video_stream.resolution} video + audio")
+                                 try:
+                                     with merge_slot():
+                                         started = time.monotonic()
+                                         mux_to_file(ffmpeg_exe, [(s.url, None, s.filesize) for s in parts], str(out_path), merge_args,
+                                                     on_progress=lambda index, done, total: progress.update(
+                                                         f"itag{parts[index].itag}", done, total, force=done == total))
+                                         record_remux(plan, time.monotonic() - started)
+                                     return str(out_path), video_stream.resolution
+                                 except Exception as e:
+                                     logger.warning(f"Pipe mux failed ({e}), downloading part files")
+
+                             # Download parts
+                             logger.info(f"Downloading adaptive streams: {video_stream.resolution} video + audio")
+                             v_name = f"v_{attempt_id}_{video_stream.resolution}.mp4"
+                             a_name = f"a_{attempt_id}.m4a"
+                             
+                             v_path, a_path = download_streams(parts, [v_name, a_name], progress)
                              
-                             if video_stream:
-                                 audio_stream = yt.streams.get_audio_only()
-                                 if audio_stream:
-                                     # Download parts
-                                     logger.info(f"Downloading adaptive streams: {video_stream.resolution} video + audio")
-                                     v_name = f"v_{download_id}_{video_stream.resolution}.mp4"
-                                     a_name = f"a_{download_id}.m4a"
-                                     
-                                     v_path = video_stream.download(output_path=str(DOWNLOADS_DIR), filename=v_name)
-                                     a_path = audio_stream.download(output_path=str(DOWNLOADS_DIR), filename=a_name)
-                                     
-                                     # Merge
-                                     out_name = f"{download_id}.mp4"
-                                     out_path = DOWNLOADS_DIR / out_name
-                                     
-                                     cmd = [
-                                         ffmpeg_exe, "-y",
-                                         "-i", v_path,
-                                         "-i", a_path,
-                                         "-c:v", "copy",
-                                         "-c:a", "aac", 
-                                         str(out_path)
-                                     ]
-                                     
+                             # Merge
+                             progress.set_phase("merging")
+                             cmd = [
+                                 ffmpeg_exe, "-y",
+                                 "-i", v_path,
+                                 "-i", a_path,
+                                 *merge_args,
+                                 str(out_path)
+                             ]
+                             
+                             def run_merge():
+                                 with track_subprocess():
                                      if os.name == 'nt':
                                          # Hide console window on Windows
                                          si = subprocess.STARTUPINFO()
@@ -515,117 +3839,150 @@ async def download_video(request: DownloadRequest):
                                          subprocess.check_call(cmd, startupinfo=si)
                                      else:
                                          subprocess.check_call(cmd)
-                                         
-                                     # Cleanup
-                                     try:
-                                        os.remove(v_path)
-                                        os.remove(a_path)
-                                     except: pass
-                                     
-                                     return str(out_path), video_stream.resolution
-    
-                        # 3. Fallback to Highest Progressive
-                        if not stream:
-                            stream = yt.streams.get_highest_resolution() 
-                        if not stream: 
-                            stream = yt.streams.filter(progressive=True).first()
-                            
-                        ext = ".mp4"
-                    
-                    if not stream: raise Exception("No suitable stream found")
+
+                             # The parts are already on disk, so the merge is never rejected
+                             def run_scheduled_merge():
+                                 with merge_slot():
+                                     started = time.monotonic()
+                                     run_merge()
+                                     record_remux(plan, time.monotonic() - started)
+
+                             postprocess_pool.submit(run_scheduled_merge, admit=False).result()
+                                 
+                             # Cleanup
+                             try:
+                                os.remove(v_path)
+                                os.remove(a_path)
+                             except: pass
+                             
+                             return str(out_path), video_stream.resolution
+
+                # 3. Fallback to Highest Progressive
+                if not stream:
+                    stream = yt.streams.get_highest_resolution() 
+                if not stream: 
+                    stream = yt.streams.filter(progressive=True).first()
                     
-                    # Download Progressive / Audio
-                    out_path = stream.download(output_path=str(DOWNLOADS_DIR), filename=f"{download_id}{ext}")
-                    # For audio downloads, resolution is None, maybe use bitrate?
-                    res = stream.resolution if hasattr(stream, 'resolution') else "audio"
-                    return out_path, res
-    
-                filepath, actual_quality = await asyncio.get_event_loop().run_in_executor(executor, download_pytube, download_id)
-                filename = os.path.basename(filepath)
-                
-                # Simple Rename for mp3 request (if user really wants .mp3 extension primarily)
-                if request.format == "mp3" and not filename.endswith(".mp3"):
-                    new_path = os.path.splitext(filepath)[0] + ".mp3"
-                    os.rename(filepath, new_path)
-                    filepath = new_path
-                    filename = os.path.basename(new_path)
-    
-                if request.quality and actual_quality and actual_quality != request.quality and request.format != "mp3":
-                     warning_msg = f"Requested {request.quality} not available. Downloaded {actual_quality} instead."
+                ext = ".mp4"
             
-            except Exception as e:
-                logger.warning(f"Pytubefix failed: {e}. Falling back to yt-dlp.")
-                use_ytdlp_fallback = True
+            if not stream: raise Exception("No suitable stream found")
+            
+            # Download Progressive / Audio
+            out_path, = download_streams([stream], [f"{attempt_id}{ext}"], progress)
+            # For audio downloads, resolution is None, maybe use bitrate?
+            res = stream.resolution if hasattr(stream, 'resolution') else "audio"
+            return out_path, res
+
+        async def via_pytubefix(attempt_id, progress):
+            remux_info = {}  # set when an adaptive video + audio merge ran
+            filepath, actual_quality = await download_pool.run(download_pytube, attempt_id, progress, remux_info)
 
-        if not is_youtube_url(url_str) or use_ytdlp_fallback:
-            # --- FACEBOOK/OTHER/YOUTUBE FALLBACK DOWNLOAD (YT-DLP) ---
+            # Simple Rename for mp3 request (if user really wants .mp3 extension primarily)
+            if request.format == "mp3" and not filepath.endswith(".mp3"):
+                new_path = os.path.splitext(filepath)[0] + ".mp3"
+                os.rename(filepath, new_path)
+                filepath = new_path
+            return filepath, actual_quality, remux_info.get("plan")
+
+        async def via_ytdlp(attempt_id, progress):
+            # --- YT-DLP DOWNLOAD (ALL SITES, AND YOUTUBE WHEN ROUTED HERE) ---
             has_ffmpeg = ffmpeg_exe is not None
+            transcode_ticket = TranscodeTicket(PRIORITY_BACKGROUND)
             base_opts = {
-                'outtmpl': str(DOWNLOADS_DIR / f'{download_id}.%(ext)s'),
+                'outtmpl': str(DOWNLOADS_DIR / f'{attempt_id}.%(ext)s'),
                 'quiet': False,
                 'ffmpeg_location': ffmpeg_exe if ffmpeg_exe else None,
                 'nocheckcertificate': True,
                 'socket_timeout': 30,
+                'progress_hooks': [progress.ytdlp_hook],
+                'postprocessor_hooks': [progress.ytdlp_postprocessor_hook, transcode_ticket.hook],
+                'postprocessor_args': {'ffmpeg': transcoder.ffmpeg_args()},
             }
-            cookie_opts = get_cookie_kwargs()
-            
+
             # Simple configuration for robustness
-            if request.format == "mp3":
-                if has_ffmpeg:
-                    base_opts['format'] = 'bestaudio/best'
-                    base_opts['postprocessors'] = [{'key': 'FFmpegExtractAudio','preferredcodec': 'mp3'}]
-                else:
-                    base_opts['format'] = 'bestaudio/best' # Will likely download m4a/webm
-            else:
-                 target_res = request.quality
-                 if target_res:
-                     if target_res == "1080p":
-                          base_opts['format'] = "bestvideo[height<=1080]+bestaudio/best"
-                     elif target_res == "720p":
-                          base_opts['format'] = "bestvideo[height<=720]+bestaudio/best"
-                     elif target_res == "480p":
-                          base_opts['format'] = "bestvideo[height<=480]+bestaudio/best"
-                     elif target_res == "360p":
-                          base_opts['format'] = "bestvideo[height<=360]+bestaudio/best"
-                     else:
-                          base_opts['format'] = "best"
-                 else:
-                     base_opts['format'] = 'best' # Let yt-dlp decide best single file for generic sites
+            # Without ffmpeg an mp3 request will likely download m4a/webm;
+            # without a quality, yt-dlp picks the best single file for generic sites
+            base_opts['format'] = format_spec_for(request.format, request.quality)
+            if request.format == "mp3" and has_ffmpeg:
+                base_opts['postprocessors'] = [{'key': 'FFmpegExtractAudio','preferredcodec': 'mp3'}]
 
             def download_ytdlp():
+                # Reuse the metadata from /video/info instead of extracting again
+                jar_id = None
                 try:
-                    with yt_dlp.YoutubeDL({**base_opts, **cookie_opts}) as ydl:
-                        info = ydl.extract_info(url_str, download=True)
-                        return ydl.prepare_filename(info)
+                    info, jar_id = extract_info_cached(url_str)
+                except VideoUnavailableError:
+                    raise
                 except Exception as e:
-                    logger.warning(f"Download failed with cookies: {e}. Retrying without cookies.")
-                    with yt_dlp.YoutubeDL(base_opts) as ydl:
+                    logger.warning(f"Cached extraction failed: {e}. Extracting during download.")
+                    info = None
+
+                if info is not None:
+                    try:
+                        # Download exactly the formats resolved from the cached metadata
+                        selection = resolve_formats(info, request.format, request.quality)
+                        pinned_opts = {**base_opts, 'format': pinned_format_spec(selection, request.format, request.quality)}
+                        cookie_jar = cookie_pool.get(jar_id)
+                        cookie_opts = get_cookie_kwargs(cookie_jar) if cookie_jar is not None else {}
+                        with ydl_pool.checkout({**pinned_opts, **cookie_opts}) as ydl:
+                            result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+                            return ydl.prepare_filename(result), result.get('height')
+                    except Exception as e:
+                        progress.raise_if_cancelled()
+                        # Format URLs may have expired; drop the entry and extract fresh
+                        logger.warning(f"Download from cached info failed: {e}. Extracting again.")
+                        metadata_cache.invalidate(canonical_video_key(url_str))
+
+                def download(cookie_opts):
+                    progress.raise_if_cancelled()
+                    with ydl_pool.checkout({**base_opts, **cookie_opts}) as ydl:
                         info = ydl.extract_info(url_str, download=True)
-                        return ydl.prepare_filename(info)
+                        return ydl.prepare_filename(info), info.get('height')
+
+                result, _ = run_with_cookies(download, prefer=jar_id)
+                return result
+
+            def download_ytdlp_scheduled():
+                try:
+                    return download_ytdlp()
+                finally:
+                    transcode_ticket.release()
+
+            initial_filepath, downloaded_height = await download_pool.run(download_ytdlp_scheduled)
+            actual_quality = f"{downloaded_height}p" if downloaded_height else None
 
-            # Run download
-            initial_filepath = await asyncio.get_event_loop().run_in_executor(executor, download_ytdlp)
-            
             # yt-dlp might change extension
-            # Find the file that starts with download_id
-            found_file = None
-            for f in DOWNLOADS_DIR.glob(f"{download_id}.*"):
-                found_file = str(f)
-                break
-                
-            if found_file:
-                filepath = found_file
-                filename = os.path.basename(filepath)
-                # If mp3 requested but no ffmpeg, we might have m4a. Rename if desired, but risky. 
-                # Let's keep original ext to be safe.
-            else:
-                 # fallback if simple glob failed (maybe filename didn't use id?)
-                 filepath = initial_filepath
-                 filename = os.path.basename(filepath)
+            # Find the file that starts with the attempt id
+            for f in DOWNLOADS_DIR.glob(f"{attempt_id}.*"):
+                return str(f), actual_quality, None
+            # fallback if simple glob failed (maybe filename didn't use id?)
+            return initial_filepath, actual_quality, None
+
+        backends = {"pytubefix": via_pytubefix, "ytdlp": via_ytdlp} if is_youtube_url(url_str) else {"ytdlp": via_ytdlp}
+        (filepath, actual_quality, remux_plan), backend = await backend_router.run(
+            extractor_label(url_str), backends, download_id, progress_hub.publisher(await download_flight_key(request)),
+            format_labels(request.format, request.quality))
+        filename = os.path.basename(filepath)
+
+        warning_msg = None
+        if request.quality and actual_quality and actual_quality != request.quality and request.format != "mp3":
+            warning_msg = f"Requested {request.quality} not available. Downloaded {actual_quality} instead."
 
         if not os.path.exists(filepath):
             raise Exception("File not found after download")
 
+        # Move the finished file into the store so the next identical request is instant
+        resolved_quality = "audio" if request.format == "mp3" else actual_quality
+        store_keys = [store_key]
+        if resolved_quality and resolved_quality != (request.quality or "best"):
+            store_keys.insert(0, DownloadStore.make_key(video_key, request.format, resolved_quality))
+        info = metadata_cache.peek(video_key)
+        download_name = default_filename(info, os.path.splitext(filepath)[1]) if info else None
+        stored_path = await asyncio.get_event_loop().run_in_executor(
+            None, download_store.put, Path(filepath), store_keys, resolved_quality, download_name)
+        filepath = str(stored_path)
+        filename = os.path.basename(filepath)
+
         response_data = {
             "download_id": download_id,
             "filename": filename,
@@ -637,40 +3994,774 @@ async def download_video(request: DownloadRequest):
         
         if warning_msg:
             response_data["warning"] = warning_msg
+        if remux_plan:
+            response_data["remux"] = remux_plan
 
         return {
             "success": True,
             "data": response_data
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Download invalid: {e}")
         raise HTTPException(status_code=400, detail=f"Download failed: {str(e)}")
 
+async def download_flight_key(request: DownloadRequest):
+    return (await resolve_video_key(str(request.url)), request.format, request.quality)
+
+@app.post("/video/download")
+async def download_video(request: DownloadRequest):
+    # Identical concurrent requests share one download
+    return await flights.do(await download_flight_key(request), lambda: perform_download(request))
+
+# --- Download jobs ---
+# POST /video/download keeps the connection open for the whole download + merge,
+# which proxies with idle timeouts cut off. Jobs return an id at once and report
+# progress over Server-Sent Events.
+JOB_RETENTION_SECONDS = float(os.environ.get("JOB_RETENTION_SECONDS", "3600"))
+SSE_KEEPALIVE_SECONDS = 15
+
+class DownloadJob:
+    def __init__(self, request: DownloadRequest):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.status = "queued"
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.version = 0
+        self.task = None
+        self._loop = asyncio.get_event_loop()
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.status in ("finished", "failed")
+
+    @property
+    def changed(self) -> asyncio.Event:
+        """Event that is set on the next state change."""
+        return self._changed
+
+    def _bump(self):
+        self.version += 1
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def set_status(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        if self.done:
+            self.finished_at = time.time()
+        self._bump()
+
+    def publish_progress(self, snapshot):
+        """Progress listener; called from download threads."""
+        self._loop.call_soon_threadsafe(self._set_progress, snapshot)
+
+    def _set_progress(self, snapshot):
+        self.progress = snapshot
+        self._bump()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "url": str(self.request.url),
+            "format": self.request.format,
+            "quality": self.request.quality,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+class JobManager:
+    def __init__(self, retention: float):
+        self.retention = retention
+        self._jobs = {}
+
+    def create(self, request: DownloadRequest) -> DownloadJob:
+        self.prune()
+        job = DownloadJob(request)
+        self._jobs[job.id] = job
+        job.task = asyncio.ensure_future(self._run(job))
+        return job
+
+    def get(self, job_id: str) -> Optional[DownloadJob]:
+        self.prune()
+        return self._jobs.get(job_id)
+
+    def prune(self):
+        """Forgets finished jobs older than the retention period."""
+        cutoff = time.time() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.done and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    async def _run(self, job: DownloadJob):
+        job_id_var.set(job.id)
+        key = await download_flight_key(job.request)
+        progress_hub.subscribe(key, job.publish_progress)
+        job.set_status("running")
+        try:
+            response = await flights.do(key, lambda: perform_download(job.request))
+            job.set_status("finished", result=response["data"])
+        except HTTPException as e:
+            job.set_status("failed", error=e.detail)
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            job.set_status("failed", error=str(e))
+        finally:
+            progress_hub.unsubscribe(key, job.publish_progress)
+
+    def stats(self):
+        counts = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"jobs": len(self._jobs), "by_status": counts, "retention_seconds": self.retention}
+
+jobs = JobManager(JOB_RETENTION_SECONDS)
+
+@app.post("/video/jobs", status_code=202)
+async def create_download_job(request: DownloadRequest):
+    """Starts a download in the background and returns its job id immediately."""
+    job = jobs.create(request)
+    return {"success": True, "data": job.to_dict()}
+
+@app.get("/video/jobs/{job_id}")
+async def get_download_job(job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"success": True, "data": job.to_dict()}
+
+@app.get("/video/jobs/{job_id}/events")
+async def download_job_events(job_id: str):
+    """Server-Sent Events stream of job state; ends with a 'done' or 'failed' event."""
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def iter_events():
+        seen_version = -1
+        while True:
+            changed = job.changed
+            if job.version != seen_version:
+                seen_version = job.version
+                event = {"finished": "done", "failed": "failed"}.get(job.status, "progress")
+                yield f"event: {event}\ndata: {json.dumps(job.to_dict())}\n\n"
+                if job.done:
+                    return
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        iter_events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/debug/jobs")
+async def debug_jobs():
+    return jobs.stats()
+
+# --- Batch downloads ---
+# One request for a list of links or a playlist instead of one request per
+# link. Items run a few at a time per batch and per site (shared by all
+# batches). Each result is written as one JSON line as soon as it finishes.
+# Identical items are downloaded once, and every item goes through the same
+# single-flight, metadata cache and download store as /video/download.
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "100"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "3"))
+BATCH_HOST_CONCURRENCY = int(os.environ.get("BATCH_HOST_CONCURRENCY", "2"))
+BATCH_SATURATED_RETRIES = 3  # waits of Retry-After when the download queue is full
+
+class BatchRequest(BaseModel):
+    urls: List[str] = []
+    playlist_url: Optional[HttpUrl] = None
+    format: str = "best"
+    quality: Optional[str] = None
+
+class HostLimiter:
+    """Per-site semaphores, created on first use and dropped once nobody holds or waits on them."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._slots = {}  # host -> [semaphore, holders + waiters]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host: str):
+        entry = self._slots.setdefault(host, [asyncio.Semaphore(self.limit), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._slots[host]
+
+    def stats(self):
+        return {"limit": self.limit, "hosts": {host: entry[1] for host, entry in self._slots.items()}}
+
+host_limiter = HostLimiter(BATCH_HOST_CONCURRENCY)
+batch_stats = {"batches": 0, "active": 0, "items": 0, "deduplicated": 0, "succeeded": 0, "failed": 0}
+
+def batch_host(url_str: str, video_key: str) -> str:
+    """Site an item counts against: the extractor for known sites (youtu.be and youtube.com
+    are one site), the host name otherwise."""
+    extractor, _, _ = video_key.partition(":")
+    if extractor != "url":
+        return extractor
+    return (urlsplit(url_str).hostname or "").removeprefix("www.")
+
+def expand_playlist(url_str: str, limit: int) -> List[str]:
+    """Video URLs of a playlist (just the URL itself if it isn't one), without extracting the videos."""
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': limit,
+        'nocheckcertificate': True,
+        'socket_timeout': 30,
+    }
+    def extract(cookie_opts):
+        with ydl_pool.checkout({**opts, **cookie_opts}) as ydl:
+            return ydl.extract_info(url_str, download=False)
+
+    info, _ = run_with_cookies(extract)
+    if not info.get('entries'):
+        return [url_str]
+    return [entry.get('url') or entry.get('webpage_url') for entry in info['entries']
+            if entry and (entry.get('url') or entry.get('webpage_url'))]
+
+async def download_with_retry(request: DownloadRequest):
+    """perform_download through the single-flight, waiting out a full download queue
+    instead of failing the item: a batch is already rate-limited by its own slots."""
+    for attempt in itertools.count():
+        try:
+            return await flights.do(await download_flight_key(request), lambda: perform_download(request))
+        except PoolSaturated as e:
+            if attempt >= BATCH_SATURATED_RETRIES:
+                raise
+            await asyncio.sleep(int(e.headers["Retry-After"]))
+
+@app.post("/video/batch")
+async def download_batch(batch: BatchRequest):
+    """Downloads several URLs (and/or a playlist's videos). Responds with NDJSON: a 'start'
+    line, one 'item' line per URL in completion order, then a 'done' line."""
+    urls = list(batch.urls)
+    if batch.playlist_url:
+        try:
+            urls += await extract_pool.run(expand_playlist, str(batch.playlist_url), BATCH_MAX_ITEMS)
+        except PoolSaturated:
+            raise
+        except Exception as e:
+            logger.error(f"Playlist expansion failed: {e}")
+            raise HTTPException(status_code=400, detail=f"Could not read playlist: {e}")
+    if not urls:
+        raise HTTPException(status_code=400, detail="No URLs given")
+    truncated = len(urls) > BATCH_MAX_ITEMS
+    urls = urls[:BATCH_MAX_ITEMS]
+
+    batch_id = uuid.uuid4().hex
+    results = asyncio.Queue()
+    groups = {}  # flight key -> (request, indices)
+    for index, url in enumerate(urls):
+        try:
+            request = DownloadRequest(url=url, format=batch.format, quality=batch.quality)
+        except ValueError:
+            results.put_nowait({"event": "item", "index": index, "url": url, "success": False, "error": "Invalid URL"})
+            continue
+        groups.setdefault(await download_flight_key(request), (request, []))[1].append(index)
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_item(video_key: str, request: DownloadRequest, indices: List[int]):
+        result = {"success": False}
+        # Site slot first: an item queued behind a busy site must not sit on one of the
+        # batch's slots while items for other sites could run
+        async with host_limiter.slot(batch_host(str(request.url), video_key)), semaphore:
+            try:
+                response = await download_with_retry(request)
+                result = {"success": True, "data": response["data"]}
+            except HTTPException as e:
+                result["error"] = e.detail
+            except Exception as e:
+                logger.error(f"Batch {batch_id} item {request.url} failed: {e}")
+                result["error"] = str(e)
+        for index in indices:
+            results.put_nowait({"event": "item", "index": index, "url": urls[index], **result})
+
+    tasks = [asyncio.ensure_future(run_item(key[0], request, indices)) for key, (request, indices) in groups.items()]
+    batch_stats["batches"] += 1
+    batch_stats["items"] += len(urls)
+    batch_stats["deduplicated"] += sum(len(indices) - 1 for _, indices in groups.values())
+    logger.info(f"Batch {batch_id}: {len(urls)} items, {len(groups)} distinct")
+
+    async def iter_results():
+        batch_stats["active"] += 1
+        succeeded = 0
+        try:
+            yield json.dumps({"event": "start", "batch_id": batch_id, "total": len(urls),
+                              "distinct": len(groups), "truncated": truncated}) + "\n"
+            for _ in urls:
+                item = await results.get()
+                succeeded += item["success"]
+                batch_stats["succeeded" if item["success"] else "failed"] += 1
+                yield json.dumps(item) + "\n"
+            yield json.dumps({"event": "done", "batch_id": batch_id, "succeeded": succeeded,
+                              "failed": len(urls) - succeeded}) + "\n"
+        finally:
+            # No awaits here: when the client disconnected we are inside a cancelled scope.
+            # Cancelling leaves downloads that other requests are waiting on running.
+            batch_stats["active"] -= 1
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        iter_results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/debug/batch")
+async def debug_batch():
+    return {**batch_stats, "concurrency": BATCH_CONCURRENCY, "host_limiter": host_limiter.stats()}
+
+# --- File delivery ---
+# Finished files are served with strong ETags and single/multi-range (206)
+# support so download managers and flaky mobile connections can resume.
+MAX_RANGES = 16  # more than this and we just send the whole file
+FILE_CHUNK_SIZE = 256 * 1024
+
+def file_etag(path: Path, stat_result) -> str:
+    """Strong validator: store files are named after their content key, plus size and mtime."""
+    return f'"{path.stem}-{stat_result.st_size:x}-{int(stat_result.st_mtime_ns // 1000):x}"'
+
+def parse_range_header(value: str, size: int):
+    """Parses 'bytes=a-b,c-,-n' into sorted, merged inclusive (start, end) ranges.
+    Returns None if the header is malformed (RFC 7233 says to ignore it) and [] if unsatisfiable."""
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start_s, sep, end_s = part.partition("-")
+        if not sep:
+            return None
+        try:
+            if not start_s.strip():
+                length = int(end_s)
+                if length <= 0 or size == 0:
+                    continue
+                start, end = max(0, size - length), size - 1
+            else:
+                start = int(start_s)
+                end = int(end_s) if end_s.strip() else None
+                if end is not None and start > end:
+                    return None
+                # Past the end (open-ended ranges included): unsatisfiable, not malformed
+                if start >= size:
+                    continue
+                end = size - 1 if end is None else min(end, size - 1)
+        except ValueError:
+            return None
+        ranges.append((start, end))
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def etag_matches(header_value: str, etag: str, weak: bool) -> bool:
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if weak and candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+class RangeFileResponse(Response):
+    """Sends byte ranges of a file. Uses the ASGI zero-copy (sendfile) or pathsend
+    extensions when the server offers them, threaded reads otherwise."""
+
+    def __init__(self, path: Path, size: int, ranges, status_code: int, headers: dict, media_type: str):
+        self.path = path
+        self.size = size
+        self.ranges = ranges
+        self.part_media_type = media_type
+        self.boundary = uuid.uuid4().hex if len(ranges) > 1 else None
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        if self.boundary:
+            self.headers["content-type"] = f"multipart/byteranges; boundary={self.boundary}"
+        self.headers["content-length"] = str(self._content_length())
+
+    def _part_header(self, start: int, end: int) -> bytes:
+        return (f"--{self.boundary}\r\nContent-Type: {self.part_media_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{self.size}\r\n\r\n").encode('latin-1')
+
+    def _closing(self) -> bytes:
+        return f"--{self.boundary}--\r\n".encode('latin-1')
+
+    def _content_length(self) -> int:
+        total = sum(end - start + 1 for start, end in self.ranges)
+        if self.boundary:
+            total += sum(len(self._part_header(s, e)) + 2 for s, e in self.ranges) + len(self._closing())
+        return total
+
+    async def __call__(self, scope, receive, send):
+        with file_leases.hold(self.path.name):
+            await self._send(scope, send)
+
+    async def _send(self, scope, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        extensions = scope.get("extensions") or {}
+        if not self.boundary and self.ranges == [(0, self.size - 1)] and "http.response.pathsend" in extensions:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            bytes_served.inc(self.size, route="file")
+            return
+
+        loop = asyncio.get_event_loop()
+        with open(self.path, "rb") as f:
+            for start, end in self.ranges:
+                if self.boundary:
+                    await send({"type": "http.response.body", "body": self._part_header(start, end), "more_body": True})
+                if "http.response.zerocopysend" in extensions:
+                    await send({"type": "http.response.zerocopysend", "file": f, "offset": start,
+                                "count": end - start + 1, "more_body": True})
+                    bytes_served.inc(end - start + 1, route="file")
+                else:
+                    await loop.run_in_executor(None, f.seek, start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = await loop.run_in_executor(None, f.read, min(FILE_CHUNK_SIZE, remaining))
+                        if not chunk:
+                            break
+                        remaining -= len(chunk)
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                        bytes_served.inc(len(chunk), route="file")
+                if self.boundary:
+                    await send({"type": "http.response.body", "body": b"\r\n", "more_body": True})
+        await send({"type": "http.response.body", "body": self._closing() if self.boundary else b"", "more_body": False})
+
+def file_response(request: Request, path: Path, media_type: str, headers: dict) -> Response:
+    """Response for a finished file honouring Range, If-Range and If-None-Match."""
+    st = path.stat()
+    etag = file_etag(path, st)
+    last_modified = formatdate(st.st_mtime, usegmt=True)
+    headers = {
+        **headers,
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Accept-Ranges": "bytes",
+        "Access-Control-Expose-Headers": "Content-Disposition, Content-Range, ETag",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag, weak=True):
+        return Response(status_code=304, headers={k: v for k, v in headers.items() if k != "Content-Disposition"})
+
+    full = [(0, st.st_size - 1)] if st.st_size else []
+    range_header = request.headers.get("range")
+    if range_header and st.st_size:
+        if_range = request.headers.get("if-range")
+        if if_range:
+            if if_range.strip().startswith(('"', 'W/')):
+                range_valid = etag_matches(if_range, etag, weak=False)
+            else:
+                try:
+                    range_valid = int(parsedate_to_datetime(if_range).timestamp()) >= int(st.st_mtime)
+                except (TypeError, ValueError):
+                    range_valid = False
+            if not range_valid:
+                # File changed since the client's partial copy: send it all again
+                return RangeFileResponse(path, st.st_size, full, 200, headers, media_type)
+
+        ranges = parse_range_header(range_header, st.st_size)
+        if ranges == []:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{st.st_size}", "ETag": etag})
+        if ranges and len(ranges) <= MAX_RANGES:
+            if len(ranges) == 1:
+                headers["Content-Range"] = f"bytes {ranges[0][0]}-{ranges[0][1]}/{st.st_size}"
+            return RangeFileResponse(path, st.st_size, ranges, 206, headers, media_type)
+
+    return RangeFileResponse(path, st.st_size, full, 200, headers, media_type)
+
 @app.get("/video/file/{filename}")
-async def get_file(filename: str):
-    # Try finding in Downloads dir
-    file_path = DOWNLOADS_DIR / filename
+@app.head("/video/file/{filename}")
+async def get_file(request: Request, filename: str):
+    if Path(filename).name != filename:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # Store entries first, then anything else in the Downloads dir
+    file_path = download_store.resolve(filename) or DOWNLOADS_DIR / filename
     if not file_path.exists():
          raise HTTPException(status_code=404, detail="File not found")
     
     # Force attachment to ensure download behavior across browsers
-    return FileResponse(
-        path=file_path, 
-        filename=filename, 
-        media_type='application/octet-stream',
-        headers={
-            "Content-Disposition": f'attachment; filename="{filename}"',
-            "Access-Control-Expose-Headers": "Content-Disposition"
-        }
-    )
+    return file_response(request, file_path, 'application/octet-stream', {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    })
+
+# --- ZIP bundles ---
+# Several finished downloads as one stored (uncompressed) ZIP, written straight
+# from disk as it is sent. Sizes are known up front and the CRCs follow each
+# file in a data descriptor, so Content-Length is exact without reading
+# anything twice. Members over 4 GiB, or starting past 4 GiB, use ZIP64 records.
+# Jobs that are still running are added when they finish. Their size isn't
+# known when the response starts, so such bundles go out without a length.
+ZIP_MAX_MEMBERS = int(os.environ.get("ZIP_MAX_MEMBERS", "100"))
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP_FLAGS = 0x0808  # sizes/CRC in a data descriptor, UTF-8 names
+
+def zip_dos_datetime(mtime: float):
+    t = time.localtime(max(mtime, 315532800))  # DOS dates start in 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+def zip_local_header(name: bytes, size: int, mtime: float, zip64: bool) -> bytes:
+    dos_time, dos_date = zip_dos_datetime(mtime)
+    extra = struct.pack("<HHQQ", 0x0001, 16, size, size) if zip64 else b""
+    stored = ZIP32_LIMIT if zip64 else size
+    return struct.pack("<IHHHHHIIIHH", 0x04034b50, 45 if zip64 else 20, ZIP_FLAGS, 0, dos_time, dos_date,
+                       0, stored, stored, len(name), len(extra)) + name + extra
+
+def zip_data_descriptor(crc: int, size: int, zip64: bool) -> bytes:
+    if zip64:
+        return struct.pack("<IIQQ", 0x08074b50, crc, size, size)
+    return struct.pack("<IIII", 0x08074b50, crc, size, size)
+
+def zip_central_entry(name: bytes, size: int, crc: int, mtime: float, offset: int, zip64: bool) -> bytes:
+    dos_time, dos_date = zip_dos_datetime(mtime)
+    extra = struct.pack("<HHQQQ", 0x0001, 24, size, size, offset) if zip64 else b""
+    stored, stored_offset = (ZIP32_LIMIT, ZIP32_LIMIT) if zip64 else (size, offset)
+    return struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 45 if zip64 else 20, 45 if zip64 else 20, ZIP_FLAGS, 0,
+                       dos_time, dos_date, crc, stored, stored, len(name), len(extra), 0, 0, 0,
+                       0o100644 << 16, stored_offset) + name + extra
+
+def zip_end_records(count: int, cd_offset: int, cd_size: int) -> bytes:
+    if count < 0xFFFF and cd_offset < ZIP32_LIMIT and cd_size < ZIP32_LIMIT:
+        return struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count, cd_size, cd_offset, 0)
+    zip64_end = struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, cd_size, cd_offset)
+    locator = struct.pack("<IIQI", 0x07064b50, 0, cd_offset + cd_size, 1)
+    return zip64_end + locator + struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, 0xFFFF, 0xFFFF,
+                                             ZIP32_LIMIT, ZIP32_LIMIT, 0)
+
+def zip_length(members) -> int:
+    """Exact archive size for (name, size) members, from the same records that are sent."""
+    offset = cd_size = 0
+    for name, size in members:
+        zip64 = size >= ZIP32_LIMIT or offset >= ZIP32_LIMIT
+        cd_size += len(zip_central_entry(name, size, 0, 0, offset, zip64))
+        offset += len(zip_local_header(name, size, 0, zip64)) + size + len(zip_data_descriptor(0, size, zip64))
+    return offset + cd_size + len(zip_end_records(len(members), offset, cd_size))
+
+def zip_member_name(path: Path, taken: set) -> str:
+    """Archive name for a file; a repeated name gets a ' (n)' suffix like browsers do."""
+    name, n = path.name, 1
+    while name in taken:
+        name = f"{path.stem} ({n}){path.suffix}"
+        n += 1
+    taken.add(name)
+    return name
+
+async def wait_for_job_file(job: DownloadJob) -> Optional[Path]:
+    while not job.done:
+        await job.changed.wait()
+    if job.status != "finished":
+        logger.warning(f"Leaving job {job.id} out of ZIP bundle: {job.error}")
+        return None
+    return Path(job.result["filepath"])
+
+async def iter_zip(ready, pending):
+    """Yields the archive: ready (path, size) members first, then each pending job's file as it finishes."""
+    loop = asyncio.get_event_loop()
+    offset = 0
+    central = []
+    names = set()
+
+    async def member(path: Path, size: Optional[int]):
+        nonlocal offset
+        encoded = zip_member_name(path, names).encode('utf-8')
+        with file_leases.hold(path.name):
+            with open(path, "rb") as f:
+                st = os.fstat(f.fileno())
+                size = st.st_size if size is None else size
+                zip64 = size >= ZIP32_LIMIT or offset >= ZIP32_LIMIT
+                header = zip_local_header(encoded, size, st.st_mtime, zip64)
+                yield header
+                crc = 0
+                remaining = size
+                while remaining > 0:
+                    chunk = await loop.run_in_executor(None, f.read, min(FILE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        # Content-Length is already out; a short archive is all we can do
+                        raise IOError(f"{path.name} shrank while it was being zipped")
+                    crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    bytes_served.inc(len(chunk), route="zip")
+                    yield chunk
+                descriptor = zip_data_descriptor(crc, size, zip64)
+                yield descriptor
+        central.append(zip_central_entry(encoded, size, crc, st.st_mtime, offset, zip64))
+        offset += len(header) + size + len(descriptor)
+
+    waiters = [asyncio.ensure_future(wait_for_job_file(job)) for job in pending]
+    try:
+        for path, size in ready:
+            async for chunk in member(path, size):
+                yield chunk
+        for waiter in asyncio.as_completed(waiters):
+            path = await waiter
+            if path is not None and path.exists():
+                async for chunk in member(path, None):
+                    yield chunk
+        directory = b"".join(central)
+        yield directory + zip_end_records(len(central), offset, len(directory))
+    finally:
+        # No awaits here: when the client disconnected we are inside a cancelled scope
+        for waiter in waiters:
+            waiter.cancel()
+
+@app.get("/video/zip")
+async def download_zip(file: List[str] = Query([]), job: List[str] = Query([]), name: str = "downloads.zip"):
+    """Streams finished files (by filename) and the files of download jobs (by job id) as one ZIP."""
+    if not file and not job:
+        raise HTTPException(status_code=400, detail="No files given")
+    if len(file) + len(job) > ZIP_MAX_MEMBERS:
+        raise HTTPException(status_code=400, detail=f"At most {ZIP_MAX_MEMBERS} files per bundle")
+
+    paths = []
+    for filename in file:
+        path = (download_store.resolve(filename) or DOWNLOADS_DIR / filename) if Path(filename).name == filename else None
+        if path is None or not path.is_file():
+            raise HTTPException(status_code=404, detail=f"File not found: {filename}")
+        paths.append(path)
+    pending = []
+    job_ids = {}  # path -> id of the job that produced it
+    for job_id in job:
+        download_job = jobs.get(job_id)
+        if not download_job:
+            raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+        if download_job.status == "finished":
+            path = Path(download_job.result["filepath"])
+            paths.append(path)
+            job_ids.setdefault(path, job_id)
+        elif download_job.status == "failed":
+            raise HTTPException(status_code=409, detail=f"Job {job_id} failed: {download_job.error}")
+        else:
+            pending.append(download_job)
+
+    ready = []
+    missing = []
+    for path in dict.fromkeys(paths):
+        try:
+            ready.append((path, path.stat().st_size))
+        except FileNotFoundError:
+            # A finished job's file can since have been evicted from the store or swept by the janitor
+            missing.append(job_ids.get(path, path.name))
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Files no longer available: {', '.join(missing)}")
+
+    archive_name = Path(name).name.replace('"', "") or "downloads.zip"
+    if not archive_name.lower().endswith(".zip"):
+        archive_name += ".zip"
+    headers = {"Content-Disposition": f'attachment; filename="{archive_name}"'}
+    if not pending:
+        taken = set()
+        members = [(zip_member_name(path, taken).encode('utf-8'), size) for path, size in ready]
+        headers["Content-Length"] = str(zip_length(members))
+
+    return StreamingResponse(iter_zip(ready, pending), media_type="application/zip", headers=headers)
+
+# --- Metrics endpoint ---
+# Gauges and counters that already live in the components' stats, read at scrape time
+WORKER_POOLS = (extract_pool, download_pool, postprocess_pool)
+metrics.collected("avy_pool_queued", "Tasks waiting for a worker, per pool.", "gauge",
+                  lambda: [({"pool": p.name}, p.stats()["queued"]) for p in WORKER_POOLS])
+metrics.collected("avy_pool_active", "Tasks running on a worker, per pool.", "gauge",
+                  lambda: [({"pool": p.name}, p.stats()["active"]) for p in WORKER_POOLS])
+metrics.collected("avy_pool_rejected_total", "Tasks turned away with 429 because the pool queue was full.", "counter",
+                  lambda: [({"pool": p.name}, p.stats()["rejected"]) for p in WORKER_POOLS])
+metrics.collected("avy_transcode_slots_used", "Transcode slots held by encoders.", "gauge",
+                  lambda: [({}, transcoder.stats()["running"])])
+metrics.collected("avy_transcode_queued", "Encoders waiting for a transcode slot.", "gauge",
+                  lambda: [({}, transcoder.stats()["queued"])])
+metrics.collected("avy_subprocesses_active", "ffmpeg / yt-dlp child processes currently running.", "gauge",
+                  lambda: [({}, subprocess_stats["active"])])
+metrics.collected("avy_subprocesses_started_total", "ffmpeg / yt-dlp child processes started.", "counter",
+                  lambda: [({}, subprocess_stats["started"])])
+metrics.collected("avy_streams_active", "/video/download_link streams in progress.", "gauge",
+                  lambda: [({}, stream_stats["active"])])
+metrics.collected("avy_streams_total", "/video/download_link streams by outcome.", "counter",
+                  lambda: [({"outcome": k}, v) for k, v in stream_stats.items() if k not in ("active", "started")])
+
+def cache_stats():
+    return {"metadata": metadata_cache.stats(), "store": download_store.stats()}
+
+metrics.collected("avy_cache_hits_total", "Cache hits (metadata cache, download store).", "counter",
+                  lambda: [({"cache": name}, s["hits"]) for name, s in cache_stats().items()])
+metrics.collected("avy_cache_misses_total", "Cache misses (metadata cache, download store).", "counter",
+                  lambda: [({"cache": name}, s["misses"]) for name, s in cache_stats().items()])
+metrics.collected("avy_cache_hit_ratio", "Hits / lookups since start.", "gauge",
+                  lambda: [({"cache": name}, s["hit_ratio"]) for name, s in cache_stats().items()])
+metrics.collected("avy_store_bytes", "Bytes of finished downloads in the download store.", "gauge",
+                  lambda: [({}, download_store.stats()["bytes"])])
+metrics.collected("avy_janitor_reclaimed_bytes_total", "Bytes the janitor removed, by reason.", "counter",
+                  lambda: [({"reason": k}, v) for k, v in janitor.stats()["reclaimed_by_reason"].items()])
+def router_series(field: str):
+    return [({"extractor": extractor, "backend": backend}, s[field])
+            for extractor, backends in backend_router.stats()["extractors"].items()
+            for backend, s in backends.items() if s[field] is not None]
+
+metrics.collected("avy_router_success_ratio", "Success rate of the router's recent window, per backend.", "gauge",
+                  lambda: router_series("success_rate"))
+metrics.collected("avy_router_hedge_delay_seconds", "Time without media after which a hedge starts, per backend.", "gauge",
+                  lambda: router_series("hedge_delay"))
+metrics.collected("avy_singleflight_coalesced_total", "Requests that joined an identical in-flight request.", "counter",
+                  lambda: [({}, flights.stats()["coalesced"])])
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "mode": "Hybrid (Pytubefix + yt-dlp)"}
 
+startup_timings["import_seconds"] = round(time.perf_counter() - STARTED_AT, 3)
+
+@app.on_event("startup")
+async def record_startup_time():
+    # Registered last, so this runs after every other startup hook
+    startup_timings["ready_seconds"] = round(time.perf_counter() - STARTED_AT, 3)
+
 if __name__ == "__main__":
     import uvicorn
     import webbrowser
     webbrowser.open("http://localhost:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=False)
+    # Logging is configured above (queue + JSON); uvicorn's default config would replace it
+    uvicorn.run(app, host="0.0.0.0", port=8000, reload=False, log_config=None)
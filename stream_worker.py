@@ -0,0 +1,310 @@
+"""Pre-started yt-dlp streaming workers for /video/download_link.
+
+Spawning the yt-dlp CLI for every stream pays for a Python start-up, a
+yt-dlp import and a second extraction. These workers are started once with
+yt-dlp already imported. Each job carries the already-extracted info dict
+over a local socket, together with a second socket that the worker installs
+as its stdout, so yt-dlp (and the ffmpeg it may spawn for merging) write the
+media bytes straight to the server.
+
+Workers run this file as a script rather than through multiprocessing, so
+they never re-import the server module. POSIX only: the data socket is
+passed with SCM_RIGHTS and dup2()'d onto fd 1.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+from typing import Optional
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+STATUS_TIMEOUT = 30
+
+class StreamWorkerError(Exception):
+    """The worker finished the job but yt-dlp reported an error, or the worker died."""
+
+# --- Worker process side ---
+
+def _worker_main(conn):
+    import yt_dlp
+    conn.send("ready")
+    instances = {}  # warm YoutubeDL per option set, like ydl_pool in the server
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            return
+        if job is None:
+            return
+        fd = reduction.recv_handle(conn)
+        try:
+            _run_job(yt_dlp, instances, job, fd)
+        except Exception as e:
+            conn.send(("error", str(e)))
+        else:
+            conn.send(("ok", None))
+
+def _run_job(yt_dlp, instances, job, fd):
+    params = dict(job["params"], outtmpl="-", logtostderr=True, quiet=True, noprogress=True)
+    key = json.dumps(params, sort_keys=True, default=repr)
+    ydl = instances.get(key)
+    if ydl is None:
+        ydl = instances[key] = yt_dlp.YoutubeDL(params)
+
+    # Point fd 1 at the job socket; ffmpeg merges inherit it from us
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    os.dup2(fd, 1)
+    os.close(fd)
+    try:
+        ydl._download_retcode = 0
+        if job.get("info"):
+            ydl.process_ie_result(job["info"], download=True)
+        else:
+            ydl.download([job["url"]])
+        if ydl._download_retcode:
+            raise StreamWorkerError("yt-dlp reported a download error")
+    except Exception:
+        instances.pop(key, None)
+        raise
+    finally:
+        try:
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            pass  # client went away, or sys.stdout was closed (see below)
+        # Restoring fd 1 drops the last reference to the socket -> EOF for the server
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+        if sys.stdout.closed:
+            # The fragment (HLS/DASH) downloaders close their '-' stream, which is
+            # sys.stdout.buffer; fd 1 itself stays open, so wrap it again for the next job
+            sys.stdout = open(1, "w", closefd=False)
+
+# --- Server side ---
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.jobs = 0
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+class WorkerStream:
+    """Async iterator over a job's media bytes, on a worker checked out by StreamWorkerPool.stream.
+    The worker goes back to the pool when the stream ends or is closed, and also when the
+    stream is dropped without ever being iterated (the response never started)."""
+
+    def __init__(self, pool, worker, job):
+        self._pool = pool
+        self._worker = worker
+        self._job = job
+        self._gen = None
+        self._loop = asyncio.get_running_loop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._gen is None:
+            if self._worker is None:
+                raise StopAsyncIteration
+            self._gen = self._pool._run(self._worker, self._job)
+            self._worker = None
+        return await self._gen.__anext__()
+
+    async def aclose(self):
+        if self._gen is not None:
+            await self._gen.aclose()
+        elif self._worker is not None:
+            self._pool._idle.put_nowait(self._worker)
+            self._worker = None
+
+    def __del__(self):
+        if self._gen is None and self._worker is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._pool._idle.put_nowait, self._worker)
+            except RuntimeError:
+                pass  # loop closed
+
+class StreamWorkerPool:
+    """Fixed-size pool of streaming workers. Workers are recycled after max_jobs jobs,
+    and killed and replaced when they crash or the client disconnects mid-stream."""
+
+    def __init__(self, size: int, max_jobs: int):
+        self.size = size
+        self.max_jobs = max_jobs
+        self._idle = None
+        self._start_lock = None
+        self.spawned = 0
+        self.completed = 0
+        self.failed = 0
+        self.crashed = 0
+        self.aborted = 0
+        self.recycled = 0
+        self.busy = 0  # checkouts that found no idle worker in time
+
+    @staticmethod
+    def supported() -> bool:
+        return os.name == "posix"
+
+    def _spawn(self) -> _Worker:
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), str(child_sock.fileno())],
+                pass_fds=[child_sock.fileno()],
+                stdin=subprocess.DEVNULL,
+            )
+        finally:
+            child_sock.close()
+        conn = Connection(parent_sock.detach())
+        # Wait until yt-dlp is imported so the worker is warm when it gets its first job
+        if not conn.poll(STATUS_TIMEOUT) or conn.recv() != "ready":
+            process.kill()
+            conn.close()
+            raise StreamWorkerError("Streaming worker failed to start")
+        self.spawned += 1
+        return _Worker(process, conn)
+
+    async def start(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._idle is not None:
+                return
+            loop = asyncio.get_running_loop()
+            workers = await loop.run_in_executor(None, lambda: [self._spawn() for _ in range(self.size)])
+            self._idle = asyncio.Queue()
+            for worker in workers:
+                self._idle.put_nowait(worker)
+            logger.info(f"Started {self.size} streaming workers")
+
+    async def stop(self):
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            self._retire(self._idle.get_nowait(), graceful=True)
+
+    def _retire(self, worker: _Worker, graceful: bool):
+        try:
+            if graceful:
+                worker.conn.send(None)
+                worker.process.wait(timeout=1)
+        except Exception:
+            pass  # didn't exit on its own; killed below
+        try:
+            if worker.is_alive():
+                worker.process.kill()
+                worker.process.wait(timeout=1)
+        except Exception as e:
+            logger.warning(f"Failed to stop streaming worker {worker.process.pid}: {e}")
+        finally:
+            worker.conn.close()
+
+    async def _replace(self, worker: _Worker, graceful: bool):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._retire, worker, graceful)
+        self._idle.put_nowait(await loop.run_in_executor(None, self._spawn))
+
+    async def _recv_status(self, worker: _Worker):
+        loop = asyncio.get_running_loop()
+        if not worker.conn.poll():
+            ready = loop.create_future()
+            fd = worker.conn.fileno()
+            loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await asyncio.wait_for(ready, STATUS_TIMEOUT)
+            finally:
+                loop.remove_reader(fd)
+        return worker.conn.recv()
+
+    async def stream(self, job: dict, timeout: Optional[float] = None) -> Optional[WorkerStream]:
+        """Checks out a worker for a job: {"params": ydl options, "info": info dict} or {"url": ...}.
+        Returns a WorkerStream of its media bytes, or None when no worker frees up within timeout."""
+        await self.start()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while True:
+            try:
+                remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                worker = await asyncio.wait_for(self._idle.get(), remaining)
+            except asyncio.TimeoutError:
+                self.busy += 1
+                return None
+            if worker.is_alive():
+                return WorkerStream(self, worker, job)
+            self.crashed += 1
+            await self._replace(worker, graceful=False)
+
+    async def _run(self, worker: _Worker, job: dict):
+        reusable = False
+        writer = None
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            worker.conn.send(job)
+            reduction.send_handle(worker.conn, child_sock.fileno(), worker.process.pid)
+            child_sock.close()
+
+            reader, writer = await asyncio.open_connection(sock=parent_sock)
+            try:
+                while True:
+                    chunk = await reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                writer.close()
+
+            try:
+                status, message = await self._recv_status(worker)
+            except (EOFError, OSError) as e:
+                self.crashed += 1
+                raise StreamWorkerError(f"Streaming worker {worker.process.pid} died") from e
+
+            worker.jobs += 1
+            reusable = True
+            if status != "ok":
+                self.failed += 1
+                raise StreamWorkerError(message)
+            self.completed += 1
+        except (GeneratorExit, asyncio.CancelledError):
+            # Client went away mid-stream: the job can't be interrupted cleanly, so the worker goes
+            self.aborted += 1
+            raise
+        finally:
+            child_sock.close()
+            if writer is None:
+                parent_sock.close()
+            if reusable and worker.jobs < self.max_jobs:
+                self._idle.put_nowait(worker)
+            else:
+                if reusable:
+                    self.recycled += 1
+                asyncio.ensure_future(self._replace(worker, graceful=reusable))
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "idle": self._idle.qsize() if self._idle is not None else 0,
+            "max_jobs_per_worker": self.max_jobs,
+            "spawned": self.spawned,
+            "completed": self.completed,
+            "failed": self.failed,
+            "crashed": self.crashed,
+            "aborted": self.aborted,
+            "recycled": self.recycled,
+            "busy": self.busy,
+        }
+
+if __name__ == "__main__":
+    _worker_main(Connection(int(sys.argv[1])))
@@ -0,0 +1,48 @@
+"""main is imported once for the whole run, in server mode, with its Downloads dir,
+server.log and cookie jars under a throwaway directory. Nothing here touches the network."""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+WORK_DIR = tempfile.mkdtemp(prefix="avy_tests_")
+
+os.environ["SERVER_ENV"] = "1"
+os.environ["WARM_UP"] = "0"
+os.environ["COOKIES_DIR"] = os.path.join(WORK_DIR, "cookies")
+tempfile.tempdir = WORK_DIR  # DOWNLOADS_DIR and cookie snapshots
+sys.path.insert(0, str(ROOT))
+
+# server.log goes to the working directory at import time
+_cwd = os.getcwd()
+os.chdir(WORK_DIR)
+try:
+    import main  # noqa: E402,F401
+finally:
+    os.chdir(_cwd)
+
+
+class FakeClock:
+    """Stands in for time.monotonic or time.time; tests move it forward by setting now."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+@pytest.fixture
+def wall_clock(monkeypatch):
+    """time.time frozen at the real current time, so file mtimes still compare sensibly."""
+    clock = FakeClock(main.time.time())
+    monkeypatch.setattr(main.time, "time", clock)
+    return clock
@@ -0,0 +1,83 @@
+import http.server
+import os
+import select
+import threading
+
+import pytest
+
+import main
+from main import ConnectionLimiter
+
+DATA = bytes(range(256)) * 64
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        start, end = 0, len(DATA) - 1
+        if "Range" in self.headers:
+            first, _, last = self.headers["Range"].removeprefix("bytes=").partition("-")
+            start, end = int(first), int(last or end)
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(DATA[start:end + 1])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def media_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/part.bin"
+    server.shutdown()
+
+def test_group_waits_until_all_its_slots_are_free():
+    limiter = ConnectionLimiter(3)
+    entered = threading.Event()
+    with limiter.hold(2):
+        def group():
+            with limiter.hold(2):
+                entered.set()
+
+        thread = threading.Thread(target=group)
+        thread.start()
+        assert not entered.wait(0.2)  # one slot free isn't enough for the group
+        assert limiter.stats() == {"limit": 3, "in_use": 2, "waiting": 1}
+    assert entered.wait(5)
+    thread.join(5)
+    assert limiter.stats()["in_use"] == 0
+
+def test_group_larger_than_the_limit_still_runs():
+    limiter = ConnectionLimiter(1)
+    with limiter.hold(2):
+        assert limiter.stats()["in_use"] == 1
+
+def read_all(fd):
+    chunks = []
+    while chunk := os.read(fd, 65536):
+        chunks.append(chunk)
+    os.close(fd)
+    return b"".join(chunks)
+
+def test_mux_feeders_take_global_connection_slots(media_url, monkeypatch):
+    limiter = ConnectionLimiter(2)
+    monkeypatch.setattr(main, "segment_connections", limiter)
+    pipes = [os.pipe() for _ in range(2)]
+    ours = [os.dup(read_fd) for read_fd, _ in pipes]  # start_feeders closes the originals (ffmpeg's copies)
+    with limiter.hold():
+        main.start_feeders(pipes, [(media_url, None, len(DATA)), (media_url, None, None)])
+        ready, _, _ = select.select(ours, [], [], 0.3)
+        assert ready == []  # both feeders wait for a slot each
+    assert [read_all(fd) for fd in ours] == [DATA, DATA]
+
+def test_segment_workers_take_global_connection_slots(media_url, tmp_path, monkeypatch):
+    limiter = ConnectionLimiter(2)
+    monkeypatch.setattr(main, "segment_connections", limiter)
+    monkeypatch.setattr(main, "SEGMENT_SIZE", 1024)
+    seen = []
+    main.fetch_parts([(media_url, len(DATA), str(tmp_path / "out.bin"))], connections=4,
+                     on_progress=lambda index, done, total: seen.append(limiter.stats()["in_use"]))
+    assert (tmp_path / "out.bin").read_bytes() == DATA
+    assert max(seen) <= 2 and limiter.stats()["in_use"] == 0
@@ -0,0 +1,196 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+
+import main
+from main import CookiePool
+
+class Jars:
+    """Cookie files under tmp_path, served to the pool in place of the toolchain's lookup."""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.sources = []
+
+    def write(self, name: str, content: str = "# Netscape HTTP Cookie File\n"):
+        path = self.directory / name
+        path.write_text(content)
+        self.sources = [s for s in self.sources if s["id"] != str(path)]
+        self.sources.append({"id": str(path), "kind": "file", "path": str(path),
+                             "signature": main.path_signature(str(path)),
+                             "digest": hashlib.sha1(content.encode()).hexdigest()})
+        return str(path)
+
+    def remove(self, jar_id: str):
+        self.sources = [s for s in self.sources if s["id"] != jar_id]
+
+@pytest.fixture
+def jars(tmp_path, monkeypatch):
+    jars = Jars(tmp_path)
+    real_get = main.toolchain.get
+    monkeypatch.setattr(main.toolchain, "get", lambda name: list(jars.sources) if name == "cookies" else real_get(name))
+    return jars
+
+def make_pool(**overrides):
+    settings = dict(threshold=2, cooldown=300, max_cooldown=1200, max_per_minute=0)
+    settings.update(overrides)
+    return CookiePool(**settings)
+
+def open_jar(pool, jar):
+    for _ in range(pool.threshold):
+        pool.failure(jar, Exception("Sign in to confirm you're not a bot"))
+    assert jar.state == "open"
+
+def test_requests_are_spread_least_used_first(jars, clock):
+    a, b = jars.write("a.txt"), jars.write("b.txt")
+    pool = make_pool()
+    picked = []
+    for _ in range(4):
+        jar = pool.acquire()
+        picked.append(jar.id)
+        pool.success(jar)
+        clock.now += 1
+    assert picked == [a, b, a, b]
+
+def test_preferred_jar_is_used_while_healthy(jars, clock):
+    jars.write("a.txt")
+    b = jars.write("b.txt")
+    pool = make_pool()
+    assert pool.acquire(prefer=b).id == b
+
+def test_jar_opens_after_threshold_and_is_skipped(jars, clock):
+    a, b = jars.write("a.txt"), jars.write("b.txt")
+    pool = make_pool()
+    jar_a = pool.acquire(prefer=a)
+    pool.failure(jar_a, Exception("HTTP Error 403"))
+    assert jar_a.state == "closed"  # one failure isn't enough
+    pool.failure(jar_a, Exception("HTTP Error 403"))
+    assert jar_a.state == "open"
+    assert pool.get(a) is None
+    assert {pool.acquire().id for _ in range(3)} == {b}
+
+def test_no_usable_jar_means_anonymous(jars, clock):
+    a = jars.write("a.txt")
+    pool = make_pool()
+    open_jar(pool, pool.acquire(prefer=a))
+    assert pool.acquire() is None
+    assert pool.skipped == 1
+
+def test_single_trial_after_cooldown_then_recovery(jars, clock):
+    a = jars.write("a.txt")
+    pool = make_pool()
+    jar = pool.acquire(prefer=a)
+    open_jar(pool, jar)
+    clock.now += 299
+    assert pool.acquire() is None
+    clock.now += 2
+    assert pool.acquire(trial=False) is None  # callers that can't report back never get the trial
+    trial = pool.acquire()
+    assert trial is jar and jar.state == "half_open"
+    assert pool.acquire() is None  # one trial at a time
+    pool.success(jar)
+    assert jar.state == "closed" and jar.consecutive_failures == 0 and jar.cooldown == 300
+    assert pool.get(a) is jar
+
+def test_failed_trial_doubles_the_cooldown_up_to_the_cap(jars, clock):
+    a = jars.write("a.txt")
+    pool = make_pool()
+    jar = pool.acquire(prefer=a)
+    open_jar(pool, jar)
+    for expected in (600, 1200, 1200):
+        clock.now += jar.cooldown + 1
+        assert pool.acquire() is jar
+        pool.failure(jar, Exception("HTTP Error 429: Too Many Requests"))
+        assert jar.state == "open" and jar.cooldown == expected
+        assert jar.opened_until == clock.now + expected
+
+def test_released_trial_gives_no_verdict(jars, clock):
+    a = jars.write("a.txt")
+    pool = make_pool()
+    jar = pool.acquire(prefer=a)
+    open_jar(pool, jar)
+    clock.now += 301
+    assert pool.acquire() is jar
+    pool.release(jar)
+    assert jar.state == "open" and jar.cooldown == 300
+    assert pool.acquire() is jar  # the next request gets the trial instead
+
+def test_rate_cap_per_jar(jars, clock):
+    jars.write("a.txt")
+    pool = make_pool(max_per_minute=2)
+    assert pool.acquire() is not None
+    assert pool.acquire() is not None
+    assert pool.acquire() is None
+    assert pool.rate_limited == 1
+    clock.now += 61
+    assert pool.acquire() is not None
+
+def test_replaced_jar_gets_a_fresh_start(jars, clock):
+    a = jars.write("a.txt", "old")
+    pool = make_pool()
+    open_jar(pool, pool.acquire(prefer=a))
+    jars.write("a.txt", "new")
+    assert pool.acquire().id == a
+    assert pool.get(a).state == "closed"
+
+def test_rewrite_with_the_same_cookies_keeps_the_jar_open(jars, clock):
+    a = jars.write("a.txt", "same")
+    pool = make_pool()
+    jar = pool.acquire(prefer=a)
+    open_jar(pool, jar)
+    jars.write("a.txt", "same")  # new mtime, same content (e.g. a save by yt-dlp)
+    assert pool.acquire() is None
+    assert jar.state == "open"
+
+def test_removed_jar_leaves_rotation(jars, clock):
+    a, b = jars.write("a.txt"), jars.write("b.txt")
+    pool = make_pool()
+    jars.remove(a)
+    assert {pool.acquire().id for _ in range(3)} == {b}
+    assert [j["name"] for j in pool.stats()["jars"]] == ["b.txt"]
+
+def test_yt_dlp_gets_a_snapshot_not_the_jar(jars, clock):
+    a = jars.write("a.txt", "cookies v1")
+    pool = make_pool()
+    cookiefile = pool.acquire().cookie_opts()["cookiefile"]
+    assert cookiefile != a
+    assert Path(cookiefile).read_text() == "cookies v1"
+    jars.write("a.txt", "cookies v2")
+    assert pool.acquire().cookie_opts()["cookiefile"] != cookiefile  # new version, new name
+
+@pytest.fixture
+def pool(jars, monkeypatch):
+    pool = make_pool()
+    monkeypatch.setattr(main, "cookie_pool", pool)
+    return pool
+
+def test_auth_error_blames_the_jar_when_anonymous_works(jars, clock, pool):
+    jars.write("a.txt")
+    calls = []
+
+    def fetch(cookie_opts):
+        calls.append(bool(cookie_opts.get("cookiefile")))
+        if cookie_opts.get("cookiefile"):
+            raise Exception("Sign in to confirm you're not a bot")
+        return "info"
+
+    assert main.run_with_cookies(fetch) == ("info", None)
+    assert calls == [True, False]
+    assert pool.stats()["jars"][0]["consecutive_failures"] == 1
+
+def test_unavailable_video_does_not_blame_the_jar(jars, clock, pool):
+    jars.write("a.txt")
+
+    def fetch(cookie_opts):
+        raise Exception("ERROR: [youtube] abc: Private video")
+
+    with pytest.raises(Exception, match="Private video"):
+        main.run_with_cookies(fetch)
+    jar = pool.stats()["jars"][0]
+    assert jar["failures"] == 0 and jar["state"] == "closed"
+
+def test_success_reports_the_jar(jars, clock, pool):
+    a = jars.write("a.txt")
+    assert main.run_with_cookies(lambda cookie_opts: "info") == ("info", a)
+    assert pool.stats()["jars"][0]["successes"] == 1
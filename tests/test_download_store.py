@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+import main
+from main import DownloadStore, STORE_MANIFEST_NAME
+
+MP4 = b"\x00\x00\x00\x18ftypisom" + b"\x00" * 100
+
+@pytest.fixture
+def store(tmp_path):
+    store = DownloadStore(tmp_path, max_bytes=0, flush_delay=60)
+    yield store
+    store.flush()
+
+def finished_file(directory, name, data=MP4):
+    path = directory / name
+    path.write_bytes(data)
+    return path
+
+def test_put_then_lookup_by_any_key(store, tmp_path):
+    keys = [DownloadStore.make_key("Youtube:a", "mp4", "720p"), DownloadStore.make_key("Youtube:a", "mp4", None)]
+    dest = store.put(finished_file(tmp_path, "1234.mp4"), keys, "720p", "Title [a].mp4")
+    assert not (tmp_path / "1234.mp4").exists()  # moved, not copied
+    for key in keys:
+        assert store.lookup(key) == (dest, "720p", "Title [a].mp4")
+    assert store.lookup(DownloadStore.make_key("Youtube:a", "mp3", None)) is None
+    stats = store.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 1 and stats["bytes_saved"] == 2 * len(MP4)
+
+def test_same_key_reuses_the_same_name(store, tmp_path):
+    key = DownloadStore.make_key("Youtube:a", "mp4", "720p")
+    first = store.put(finished_file(tmp_path, "1.mp4"), [key])
+    second = store.put(finished_file(tmp_path, "2.mp4", MP4 + b"more"), [key])
+    assert first == second and second.read_bytes() == MP4 + b"more"
+    assert store.stats()["entries"] == 1
+
+def test_lookup_with_container_checks_the_file_contents(store, tmp_path):
+    key = DownloadStore.make_key("Youtube:a", "mp3", None)
+    store.put(finished_file(tmp_path, "1.mp3", MP4), [key])  # an m4a named .mp3
+    assert store.lookup(key, "mp3") is None
+    assert store.lookup(key, "mp4") is not None
+
+def test_file_removed_behind_our_back_is_dropped(store, tmp_path):
+    key = DownloadStore.make_key("Youtube:a", "mp4", None)
+    store.put(finished_file(tmp_path, "1.mp4"), [key]).unlink()
+    assert store.lookup(key) is None
+    assert store.stats()["entries"] == 0
+
+def test_manifest_survives_a_restart(store, tmp_path):
+    key = DownloadStore.make_key("Youtube:a", "mp4", "720p")
+    dest = store.put(finished_file(tmp_path, "1.mp4"), [key], "720p", "a.mp4")
+    store.flush()
+    reopened = DownloadStore(tmp_path, max_bytes=0, flush_delay=60)
+    assert reopened.lookup(key) == (dest, "720p", "a.mp4")
+
+def test_manifest_writes_are_batched(store, tmp_path):
+    key = DownloadStore.make_key("Youtube:a", "mp4", None)
+    store.put(finished_file(tmp_path, "1.mp4"), [key])
+    for _ in range(50):
+        store.lookup(key)
+    assert not (tmp_path / STORE_MANIFEST_NAME).exists()  # still within the flush delay
+    store.flush()
+    store.flush()  # nothing changed since
+    assert store.stats()["manifest_writes"] == 1
+    assert json.loads((tmp_path / STORE_MANIFEST_NAME).read_text())["entries"]
+
+def test_over_budget_evicts_large_idle_files_first(tmp_path, wall_clock):
+    store = DownloadStore(tmp_path, max_bytes=3000, flush_delay=60)
+    small = store.put(finished_file(tmp_path, "s.mp4", MP4), ["small"])
+    wall_clock.now += 1
+    large = store.put(finished_file(tmp_path, "l.mp4", MP4 * 20), ["large"])
+    wall_clock.now += 3600
+    store.lookup("small")
+    newest = store.put(finished_file(tmp_path, "n.mp4", MP4 * 10), ["newest"])
+    assert store.lookup("large") is None and not large.exists()
+    assert small.exists() and newest.exists()
+    assert store.stats()["evictions"] == 1
+
+def test_files_being_sent_are_not_evicted(tmp_path, wall_clock):
+    store = DownloadStore(tmp_path, max_bytes=len(MP4), flush_delay=60)
+    first = store.put(finished_file(tmp_path, "1.mp4"), ["first"])
+    wall_clock.now += 60
+    with main.file_leases.hold(first.name):
+        store.put(finished_file(tmp_path, "2.mp4"), ["second"])
+    assert first.exists()  # over budget for now; the janitor catches up later
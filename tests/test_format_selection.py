@@ -0,0 +1,74 @@
+import main
+from main import format_spec_for, pinned_format_spec, quality_ladder, resolve_formats, select_formats
+
+MB = 1024 * 1024
+
+def fmt(format_id, ext, vcodec, acodec, height=None, filesize=None, filesize_approx=None, tbr=None, abr=None):
+    return {
+        "format_id": format_id, "ext": ext, "vcodec": vcodec, "acodec": acodec, "height": height,
+        "filesize": filesize, "filesize_approx": filesize_approx, "tbr": tbr, "abr": abr,
+        "protocol": "https", "url": f"https://media.invalid/{format_id}",
+    }
+
+# yt-dlp hands format selectors its formats sorted worst to best
+INFO = {
+    "id": "abc", "title": "Clip", "extractor": "youtube",
+    "formats": [
+        fmt("140", "m4a", "none", "mp4a.40.2", filesize=3 * MB, abr=128, tbr=128),
+        fmt("134", "mp4", "avc1.4d401e", "none", height=360, filesize=5 * MB, tbr=300),
+        fmt("18", "mp4", "avc1.42001E", "mp4a.40.2", height=360, filesize=10 * MB, tbr=500),
+        fmt("136", "mp4", "avc1.4d401f", "none", height=720, filesize=20 * MB, tbr=1200),
+        fmt("137", "mp4", "avc1.640028", "none", height=1080, filesize_approx=40 * MB, tbr=2500),
+    ],
+}
+
+def test_format_spec_for():
+    assert format_spec_for("mp3", "720p") == "bestaudio/best"
+    assert format_spec_for("best", "720p") == "bestvideo[height<=720]+bestaudio/best"
+    assert format_spec_for("mp4", None) == "best"
+    assert format_spec_for("best", "4320p") == "best"  # not offered by the UI
+
+def test_quality_merges_best_video_under_the_cap_with_audio():
+    selection = resolve_formats(INFO, "best", "720p")
+    assert selection["format_id"] == "136+140"
+    assert selection["merged"] is True
+    assert selection["height"] == 720
+    assert [f["format_id"] for f in selection["formats"]] == ["136", "140"]
+    assert selection["filesize"] == 23 * MB
+    assert selection["filesize_approx"] == 23 * MB
+
+def test_size_is_only_approximate_when_a_part_lacks_an_exact_size():
+    selection = resolve_formats(INFO, "best", "1080p")
+    assert selection["format_id"] == "137+140"
+    assert selection["filesize"] is None
+    assert selection["filesize_approx"] == 43 * MB
+
+def test_best_without_quality_is_the_best_single_file():
+    selection = resolve_formats(INFO, "best", None)
+    assert selection["format_id"] == "18"
+    assert selection["merged"] is False
+    assert selection["filesize"] == 10 * MB
+
+def test_mp3_takes_the_best_audio():
+    selection = resolve_formats(INFO, "mp3", None)
+    assert selection["format_id"] == "140"
+    assert selection["height"] is None
+
+def test_no_formats():
+    with main.ydl_pool.checkout({"quiet": True, "no_warnings": True}) as ydl:
+        assert select_formats(ydl, {"id": "abc"}, "best") is None
+
+def test_pinned_spec_falls_back_to_the_selector():
+    selection = resolve_formats(INFO, "best", "720p")
+    assert pinned_format_spec(selection, "best", "720p") == "136+140/bestvideo[height<=720]+bestaudio/best"
+    assert pinned_format_spec(None, "mp3", None) == "bestaudio/best"
+
+def test_quality_ladder_offers_each_distinct_selection_once():
+    ladder, audio = quality_ladder(INFO)
+    # 480p resolves to the same formats as 360p, so it is not offered separately
+    assert [(q["quality"], q["height"], q["format_id"]) for q in ladder] == [
+        ("1080p", 1080, "137+140"),
+        ("720p", 720, "136+140"),
+        ("360p", 360, "134+140"),
+    ]
+    assert audio == {"format_id": "140", "abr": 128, "filesize": 3 * MB, "filesize_approx": 3 * MB}
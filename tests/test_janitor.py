@@ -0,0 +1,72 @@
+import os
+import uuid
+
+import pytest
+
+import main
+from main import DownloadStore, Janitor
+
+MP4 = b"\x00\x00\x00\x18ftypisom" + b"\x00" * 1000
+
+@pytest.fixture
+def store(tmp_path):
+    return DownloadStore(tmp_path, max_bytes=0, flush_delay=60)
+
+def make_janitor(store, max_age=3600, max_bytes=0, orphan_grace=600):
+    return Janitor(store.directory, store, max_age, max_bytes, orphan_grace, dry_run=False)
+
+def stored(store, name, key, data=MP4):
+    path = store.directory / name
+    path.write_bytes(data)
+    return store.put(path, [key])
+
+def partial(directory, name, age, now):
+    path = directory / name
+    path.write_bytes(b"x" * 100)
+    os.utime(path, (now - age, now - age))
+    return path
+
+def test_old_orphaned_parts_go_and_fresh_or_leased_ones_stay(store, tmp_path, wall_clock):
+    download_id = str(uuid.uuid4())
+    old = partial(tmp_path, f"v_{uuid.uuid4()}.mp4.part", 3600, wall_clock.now)
+    fresh = partial(tmp_path, f"{uuid.uuid4()}.webm", 60, wall_clock.now)
+    running = partial(tmp_path, f"a_{download_id}.m4a", 3600, wall_clock.now)
+    tee = partial(tmp_path, f"{main.TEE_NAME_PREFIX}abc.mp4", 3600, wall_clock.now)
+    user_file = partial(tmp_path, "holiday.mp4", 10 ** 6, wall_clock.now)  # not ours to delete
+    with main.file_leases.hold(download_id):
+        report = make_janitor(store).sweep()
+    assert not old.exists() and not tee.exists()
+    assert fresh.exists() and running.exists() and user_file.exists()
+    assert report["by_reason"]["orphan"] == 200
+
+def test_stored_downloads_expire_after_max_age(store, wall_clock):
+    expired = stored(store, "1.mp4", "old")
+    wall_clock.now += 3000
+    kept = stored(store, "2.mp4", "new")
+    wall_clock.now += 601
+    report = make_janitor(store).sweep()
+    assert not expired.exists() and kept.exists()
+    assert store.lookup("old") is None and store.lookup("new") is not None
+    assert report["by_reason"] == {"orphan": 0, "expired": len(MP4), "quota": 0}
+
+def test_quota_evicts_until_the_directory_fits(store, wall_clock):
+    paths = []
+    for n in range(4):
+        paths.append(stored(store, f"{n}.mp4", f"key{n}"))
+        wall_clock.now += 10
+    janitor = make_janitor(store, max_age=0, max_bytes=2 * len(MP4))
+    with main.file_leases.hold(paths[0].name):  # being sent: skipped even though it is the oldest
+        report = janitor.sweep()
+    assert [p.exists() for p in paths] == [True, False, False, True]
+    assert report["by_reason"]["quota"] == 2 * len(MP4)
+    assert janitor.stats()["bytes_reclaimed"] == 2 * len(MP4)
+
+def test_dry_run_reports_without_deleting(store, tmp_path, wall_clock):
+    path = stored(store, "1.mp4", "old")
+    orphan = partial(tmp_path, f"{uuid.uuid4()}.part", 3600, wall_clock.now)
+    wall_clock.now += 7200
+    janitor = make_janitor(store)
+    report = janitor.sweep(dry_run=True)
+    assert report["dry_run"] and report["files"] == 2
+    assert path.exists() and orphan.exists()
+    assert janitor.stats()["bytes_reclaimed"] == 0
@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from main import DownloadRequest, JobManager, ProgressReporter
+
+URL = "https://example.com/clip.mp4"
+
+def test_progress_is_throttled_but_forced_updates_get_through(clock):
+    published = []
+    reporter = ProgressReporter(published.append, max_hz=4)
+    reporter.update("video", 0, 1000)
+    for done in range(1, 10):
+        reporter.update("video", done * 10, 1000)  # all within the same 250 ms
+    assert len(published) == 1
+    clock.now += 0.3
+    reporter.update("video", 500, 1000)
+    reporter.update("video", 1000, 1000, force=True)
+    assert [p["percent"] for p in published] == [0.0, 50.0, 100.0]
+
+def test_progress_adds_up_parts_and_phases(clock):
+    published = []
+    reporter = ProgressReporter(published.append, max_hz=0)
+    reporter.ytdlp_hook({"status": "downloading", "info_dict": {"format_id": "137"},
+                         "downloaded_bytes": 300, "total_bytes": 900})
+    reporter.ytdlp_hook({"status": "finished", "info_dict": {"format_id": "140"}, "total_bytes": 100})
+    reporter.ytdlp_postprocessor_hook({"status": "started"})
+    assert published[1] == {"phase": "downloading", "downloaded_bytes": 400, "total_bytes": 1000, "percent": 40.0}
+    assert published[-1]["phase"] == "processing"
+
+@pytest.fixture
+def job_manager(monkeypatch):
+    manager = JobManager(retention=60)
+    monkeypatch.setattr(main, "jobs", manager)
+    return manager
+
+def fake_download(monkeypatch, error=None):
+    async def perform_download(request):
+        publish = main.progress_hub.publisher(await main.download_flight_key(request))
+        publish({"phase": "downloading", "downloaded_bytes": 50, "total_bytes": 100, "percent": 50.0})
+        await asyncio.sleep(0.01)
+        if error:
+            raise error
+        return {"success": True, "data": {"filename": "clip.mp4"}}
+
+    monkeypatch.setattr(main, "perform_download", perform_download)
+
+async def sse_events(job_id):
+    response = await main.download_job_events(job_id)
+    events = []
+    async for message in response.body_iterator:
+        name, data = message.strip().split("\n")
+        events.append((name.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+def test_job_reports_progress_then_its_result(job_manager, monkeypatch):
+    fake_download(monkeypatch)
+
+    async def scenario():
+        job = job_manager.create(DownloadRequest(url=URL))
+        assert job.status == "queued"
+        events = await sse_events(job.id)
+        return job, events
+
+    job, events = asyncio.run(scenario())
+    assert job.status == "finished" and job.result == {"filename": "clip.mp4"}
+    assert any(data["progress"] and data["progress"]["percent"] == 50.0 for _, data in events)
+    assert events[-1][0] == "done" and events[-1][1]["result"] == {"filename": "clip.mp4"}
+
+def test_failed_job_keeps_the_error(job_manager, monkeypatch):
+    fake_download(monkeypatch, error=HTTPException(status_code=400, detail="Download failed: nope"))
+
+    async def scenario():
+        job = job_manager.create(DownloadRequest(url=URL))
+        await job.task
+        return job, await sse_events(job.id)
+
+    job, events = asyncio.run(scenario())
+    assert job.status == "failed" and job.error == "Download failed: nope"
+    assert [name for name, _ in events] == ["failed"]
+
+def test_finished_jobs_are_forgotten_after_retention(job_manager, monkeypatch, wall_clock):
+    fake_download(monkeypatch)
+
+    async def scenario():
+        job = job_manager.create(DownloadRequest(url=URL))
+        await job.task
+        return job
+
+    job = asyncio.run(scenario())
+    wall_clock.now += 59
+    assert job_manager.get(job.id) is job
+    wall_clock.now += 2
+    assert job_manager.get(job.id) is None
@@ -0,0 +1,68 @@
+import json
+import logging
+import queue
+import sys
+
+from fastapi.testclient import TestClient
+
+import main
+from main import JsonFormatter, LogContextFilter, LogQueueHandler, LogSampler
+
+def make_record(msg="hello %s", args=("world",), level=logging.INFO, **extra):
+    record = logging.makeLogRecord({"name": "main", "levelno": level, "levelname": logging.getLevelName(level),
+                                    "msg": msg, "args": args})
+    for key, value in extra.items():
+        setattr(record, key, value)
+    return record
+
+def test_json_lines_carry_extras_and_tracebacks():
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = make_record(exc_info=sys.exc_info(), request_id="r1", job_id=None,
+                             http={"status": 200}, sample_key="stream start")
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry["msg"] == "hello world" and entry["level"] == "INFO"
+    assert entry["request_id"] == "r1" and entry["http"] == {"status": 200}
+    assert "job_id" not in entry and "sample_key" not in entry
+    assert "ValueError: boom" in entry["exc"]
+
+def test_records_are_stamped_with_the_current_ids():
+    token = main.request_id_var.set("req-1")
+    try:
+        record = make_record()
+        LogContextFilter().filter(record)
+    finally:
+        main.request_id_var.reset(token)
+    assert record.request_id == "req-1" and record.job_id is None
+
+def test_sampler_passes_a_burst_per_window_and_reports_the_rest(clock):
+    sampler = LogSampler(burst=2, window=10)
+    passed = [sampler.filter(make_record(sample_key="stream start")) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert sampler.filter(make_record(sample_key="other"))  # keys are counted separately
+    assert sampler.filter(make_record())  # no key: never sampled
+    assert sampler.filter(make_record(sample_key="stream start", level=logging.WARNING))
+    clock.now += 10
+    record = make_record(sample_key="stream start")
+    assert sampler.filter(record) and record.suppressed == 3
+    assert sampler.suppressed == 3
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = LogQueueHandler(queue.Queue(2))
+    for n in range(5):
+        handler.emit(make_record(args=(n,)))
+    assert handler.dropped == 3
+    first = handler.queue.get_nowait()
+    assert first.msg == "hello 0" and first.args is None  # formatted before it crosses threads
+
+def test_requests_get_an_id_and_one_access_record(caplog):
+    client = TestClient(main.app)
+    with caplog.at_level(logging.INFO, logger="avy.access"):
+        response = client.get("/debug/logging", headers={"X-Request-ID": "abc-123"})
+    assert response.headers["x-request-id"] == "abc-123"
+    access = [r for r in caplog.records if r.name == "avy.access"]
+    assert len(access) == 1
+    assert access[0].http["route"] == "/debug/logging" and access[0].http["status"] == 200
+    generated = client.get("/debug/logging").headers["x-request-id"]
+    assert generated and generated != "abc-123"
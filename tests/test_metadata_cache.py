@@ -0,0 +1,134 @@
+import json
+
+import pytest
+
+import main
+from main import MetadataCache, VideoUnavailableError, canonical_video_key, youtube_video_key
+
+def info(video_id, padding=0):
+    return {"id": video_id, "title": "x" * padding}
+
+def size_of(entry):
+    return len(json.dumps(entry))
+
+def test_hit_until_ttl(clock):
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=10_000)
+    cache.put(["a"], info("a"), "jar-1")
+    clock.now += 59
+    assert cache.get("a") == (info("a"), "jar-1")
+    clock.now += 2
+    assert cache.get("a") is None
+    assert cache.total_bytes == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_all_keys_of_a_put_share_the_entry(clock):
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=10_000)
+    cache.put(["Youtube:a", "url:https://youtu.be/a"], info("a"), None)
+    assert cache.get("url:https://youtu.be/a") == (info("a"), None)
+    assert cache.get("Youtube:a") == (info("a"), None)
+
+def test_aliases_count_against_the_budget_once(clock):
+    entry_size = size_of(info("a", 100))
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=2 * entry_size)
+    cache.put(["Youtube:a", "url:https://youtu.be/a"], info("a", 100), None)
+    assert cache.total_bytes == entry_size
+    cache.put(["Youtube:b", "url:https://youtu.be/b"], info("b", 100), None)
+    assert cache.evictions == 0 and cache.get("Youtube:a") is not None
+    cache.invalidate("url:https://youtu.be/a")
+    assert cache.total_bytes == 2 * entry_size  # still held by its other key
+    cache.invalidate("Youtube:a")
+    assert cache.total_bytes == entry_size
+
+def test_least_recently_used_goes_first(clock):
+    entry_size = size_of(info("a", 100))
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=2 * entry_size)
+    cache.put(["a"], info("a", 100), None)
+    cache.put(["b"], info("b", 100), None)
+    cache.get("a")  # b is now the least recently used
+    cache.put(["c"], info("c", 100), None)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.evictions == 1
+    assert cache.total_bytes == 2 * entry_size
+
+def test_entry_over_budget_is_not_cached(clock):
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=50)
+    cache.put(["a"], info("a", 100), None)
+    assert cache.get("a") is None
+    assert cache.total_bytes == 0
+
+def test_negative_entries_expire(clock):
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=10_000)
+    cache.put_error("a", "Private video")
+    with pytest.raises(VideoUnavailableError, match="Private video"):
+        cache.get("a")
+    clock.now += 11
+    assert cache.get("a") is None
+    assert cache.negative_hits == 1
+
+def test_expired_negative_entries_are_swept_without_a_lookup(clock):
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=10_000)
+    for n in range(100):
+        cache.put_error(f"url:https://example.com/{n}", "Video unavailable")
+    clock.now += 11
+    cache.put_error("url:https://example.com/new", "Video unavailable")
+    assert cache.stats()["negative_entries"] == 1
+    clock.now += 11
+    cache.put(["a"], info("a"), None)
+    assert cache.stats()["negative_entries"] == 0
+
+def test_put_clears_negative_entry(clock):
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=10_000)
+    cache.put_error("a", "Private video")
+    cache.put(["a"], info("a"), None)
+    assert cache.get("a") == (info("a"), None)
+
+def test_peek_counts_nothing_and_keeps_lru_order(clock):
+    entry_size = size_of(info("a", 100))
+    cache = MetadataCache(ttl=60, negative_ttl=10, max_bytes=2 * entry_size)
+    cache.put(["a"], info("a", 100), None)
+    cache.put(["b"], info("b", 100), None)
+    assert cache.peek("a") == info("a", 100)
+    assert (cache.hits, cache.misses) == (0, 0)
+    cache.put(["c"], info("c", 100), None)
+    assert cache.peek("a") is None  # peek didn't make it recently used
+    clock.now += 61
+    assert cache.peek("b") is None
+
+@pytest.mark.parametrize("url", [
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&feature=share",
+    "https://m.youtube.com/shorts/dQw4w9WgXcQ",
+])
+def test_youtube_urls_share_a_key(url):
+    assert canonical_video_key(url) == "Youtube:dQw4w9WgXcQ"
+
+@pytest.mark.parametrize("url", [
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ&t=3",
+    "https://youtube.com/watch?feature=share&v=dQw4w9WgXcQ",
+    "https://music.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.youtube.com/embed/dQw4w9WgXcQ",
+    "https://www.youtube.com/live/dQw4w9WgXcQ",
+    "https://www.youtube-nocookie.com/embed/dQw4w9WgXcQ",
+])
+def test_youtube_fast_path_agrees_with_the_extractor_scan(url, monkeypatch):
+    fast = youtube_video_key(url)
+    monkeypatch.setattr(main, "youtube_video_key", lambda url: None)
+    assert fast == canonical_video_key.__wrapped__(url) == "Youtube:dQw4w9WgXcQ"
+
+def test_youtube_playlist_links_take_the_slow_path():
+    assert youtube_video_key("https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLx") is None
+    assert not canonical_video_key("https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLx").startswith("Youtube:")
+
+def test_known_site_key():
+    assert canonical_video_key("https://vimeo.com/76979871") == "Vimeo:76979871"
+
+def test_generic_url_is_normalized():
+    key = canonical_video_key("HTTPS://Example.COM/v.mp4?utm_source=x&b=2&a=1&fbclid=z#t=3")
+    assert key == "url:https://example.com/v.mp4?a=1&b=2"
+
+def test_generic_urls_differing_in_path_or_query_stay_apart():
+    assert canonical_video_key("https://example.com/v.mp4?a=1") != canonical_video_key("https://example.com/v.mp4?a=2")
+    assert canonical_video_key("https://example.com/a.mp4") != canonical_video_key("https://example.com/b.mp4")
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+import pytest
+
+from main import BoundedPool, PoolSaturated
+
+@pytest.fixture
+def pool():
+    pool = BoundedPool("test", workers=1, max_queue=2)
+    yield pool
+    pool._executor.shutdown(wait=False, cancel_futures=True)
+
+def occupy(pool):
+    """Blocks the pool's only worker until the returned event is set."""
+    started, gate = threading.Event(), threading.Event()
+    pool.submit(lambda: (started.set(), gate.wait(5)))
+    assert started.wait(5)
+    return gate
+
+def test_queue_limit_rejects_with_retry_after(pool):
+    gate = occupy(pool)
+    pool.submit(lambda: None)
+    pool.submit(lambda: None)
+    with pytest.raises(PoolSaturated) as excinfo:
+        pool.submit(lambda: None)
+    assert excinfo.value.status_code == 429
+    assert int(excinfo.value.headers["Retry-After"]) >= 1
+    assert pool.stats()["rejected"] == 1
+    pool.submit(lambda: None, admit=False).cancel()  # follow-up work skips the limit
+    gate.set()
+
+def test_queued_counts_only_waiting_tasks(pool):
+    gate = occupy(pool)
+    futures = [pool.submit(lambda: 1) for _ in range(2)]
+    assert pool.stats()["queued"] == 2 and pool.stats()["active"] == 1
+    gate.set()
+    assert [f.result(5) for f in futures] == [1, 1]
+    stats = pool.stats()
+    assert stats["queued"] == 0 and stats["active"] == 0 and stats["completed"] == 3
+
+def test_cancelled_queued_tasks_give_their_slot_back(pool):
+    gate = occupy(pool)
+    for future in [pool.submit(lambda: None) for _ in range(2)]:
+        assert future.cancel()
+    assert pool.stats()["queued"] == 0
+    later = [pool.submit(lambda: 2) for _ in range(2)]  # would be rejected if the slots leaked
+    gate.set()
+    assert [f.result(5) for f in later] == [2, 2]
+    assert pool.stats()["queued"] == 0
+
+def test_cancelled_awaiters_give_their_slot_back(pool):
+    async def scenario():
+        gate = occupy(pool)
+        waiters = [asyncio.ensure_future(pool.run(lambda: None)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        queued = pool.stats()["queued"]
+        gate.set()
+        return queued, await pool.run(lambda: 3)
+
+    assert asyncio.run(scenario()) == (0, 3)
+
+def test_retry_after_grows_with_the_queue(pool):
+    assert pool.retry_after() == 5  # no history: assume 5 s per task
+    pool._run_times.extend([2.0] * 4)
+    assert pool.retry_after() == 2
+    pool.queued = 2
+    assert pool.retry_after() == 6
+    pool.queued = 0
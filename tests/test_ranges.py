@@ -0,0 +1,60 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import parse_range_header
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", [(0, 9)]),
+    ("bytes=90-", [(90, 99)]),
+    ("bytes=-5", [(95, 99)]),
+    ("bytes=50-999999", [(50, 99)]),  # end clamped to the file
+    ("bytes=-500", [(0, 99)]),
+    ("bytes=0-0,5-", [(0, 0), (5, 99)]),
+    ("bytes=10-20,0-5,15-30", [(0, 5), (10, 30)]),  # sorted and merged
+    ("bytes=0-4,5-9", [(0, 9)]),  # adjacent ranges merge too
+    ("BYTES=0-1", [(0, 1)]),
+])
+def test_satisfiable(header, expected):
+    assert parse_range_header(header, 100) == expected
+
+@pytest.mark.parametrize("header", ["bytes=999999-", "bytes=100-", "bytes=200-300", "bytes=-0", "bytes=100-,200-"])
+def test_unsatisfiable(header):
+    assert parse_range_header(header, 100) == []
+
+@pytest.mark.parametrize("header", ["bytes=9-3", "items=0-1", "bytes=a-b", "bytes=5"])
+def test_malformed_is_ignored(header):
+    assert parse_range_header(header, 100) is None
+
+def test_unsatisfiable_ranges_mixed_with_good_ones_are_dropped():
+    assert parse_range_header("bytes=500-600,0-1", 100) == [(0, 1)]
+
+def test_empty_file():
+    assert parse_range_header("bytes=-5", 0) == []
+    assert parse_range_header("bytes=0-", 0) == []
+
+@pytest.fixture
+def hundred_byte_file():
+    path = main.DOWNLOADS_DIR / "range-test.bin"
+    path.write_bytes(bytes(range(100)))
+    yield path.name
+    path.unlink()
+
+def test_served_ranges(hundred_byte_file):
+    client = TestClient(main.app)
+    response = client.get(f"/video/file/{hundred_byte_file}", headers={"Range": "bytes=90-"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 90-99/100"
+    assert response.content == bytes(range(90, 100))
+
+def test_open_ended_range_past_eof_is_416(hundred_byte_file):
+    client = TestClient(main.app)
+    response = client.get(f"/video/file/{hundred_byte_file}", headers={"Range": "bytes=999999-"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */100"
+
+def test_malformed_range_gets_the_whole_file(hundred_byte_file):
+    client = TestClient(main.app)
+    response = client.get(f"/video/file/{hundred_byte_file}", headers={"Range": "bytes=9-3"})
+    assert response.status_code == 200
+    assert len(response.content) == 100
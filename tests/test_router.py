@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+import main
+from main import BackendRouter
+
+@pytest.fixture
+def router():
+    return BackendRouter(window=50, min_samples=3, explore=0.0, hedge=True, hedge_default=0.05, hedge_min=0.01)
+
+def seed(router, backend, seconds, ok=True, first_byte=None, count=3):
+    for _ in range(count):
+        router.record(backend, "Youtube", ok, seconds, first_byte)
+
+def test_preference_order_until_both_have_samples(router):
+    seed(router, "ytdlp", 1.0)
+    assert router.choose("Youtube", ["ytdlp", "pytubefix"]) == (["pytubefix", "ytdlp"], "default")
+    assert router.choose("Vimeo", ["ytdlp"]) == (["ytdlp"], "only")
+
+def test_lowest_expected_time_goes_first(router):
+    seed(router, "pytubefix", 2.0)
+    seed(router, "ytdlp", 3.0)
+    assert router.choose("Youtube", ["pytubefix", "ytdlp"]) == (["pytubefix", "ytdlp"], "score")
+    seed(router, "pytubefix", 2.0, ok=False, count=6)  # fast but mostly failing now
+    assert router.choose("Youtube", ["pytubefix", "ytdlp"]) == (["ytdlp", "pytubefix"], "score")
+
+def test_exploration_tries_the_backup_first(router, monkeypatch):
+    router.explore = 0.05
+    seed(router, "pytubefix", 2.0)
+    seed(router, "ytdlp", 3.0)
+    monkeypatch.setattr(main.random, "random", lambda: 0.01)
+    assert router.choose("Youtube", ["pytubefix", "ytdlp"]) == (["ytdlp", "pytubefix"], "explore")
+
+def test_hedge_delay_is_the_recent_first_byte_p95(router):
+    assert router.hedge_delay("pytubefix", "Youtube") == 0.05  # too few samples
+    for first_byte in (0.5, 0.7, 4.0):
+        router.record("pytubefix", "Youtube", True, 10.0, first_byte)
+    assert router.hedge_delay("pytubefix", "Youtube") == 4.0
+    router.hedge_min = 5.0
+    assert router.hedge_delay("pytubefix", "Youtube") == 5.0
+
+def stalled():
+    async def backend(attempt_id, progress):
+        while True:  # extracting forever, never a media byte
+            progress.raise_if_cancelled()
+            await asyncio.sleep(0.01)
+    return backend
+
+def finishes(result, delay=0.0):
+    async def backend(attempt_id, progress):
+        progress.update("media", 1, 2)
+        await asyncio.sleep(delay)
+        progress.update("media", 2, 2, force=True)
+        return result
+    return backend
+
+def fails(message):
+    async def backend(attempt_id, progress):
+        raise RuntimeError(message)
+    return backend
+
+def run(router, backends):
+    published = []
+
+    async def scenario():
+        try:
+            return await router.run("Youtube", backends, "download-id", published.append, main.format_labels("mp4", "720p"))
+        finally:
+            while main.background_tasks_refs:
+                await asyncio.gather(*main.background_tasks_refs, return_exceptions=True)
+
+    return asyncio.run(scenario()), published
+
+def test_stalled_primary_is_hedged_and_cancelled(router):
+    (result, winner), published = run(router, {"pytubefix": stalled(), "ytdlp": finishes("file.mp4")})
+    assert (result, winner) == ("file.mp4", "ytdlp")
+    assert router.hedges == 1 and router.hedges_won == 1
+    stats = router._outcomes_of("pytubefix", "Youtube")
+    assert [ok for ok, _, _ in stats] == [False]  # the loser is recorded as cancelled
+    assert published and published[-1]["percent"] == 100.0
+
+def test_primary_receiving_data_is_not_hedged(router):
+    calls = []
+
+    async def backup(attempt_id, progress):
+        calls.append(attempt_id)
+        return "backup.mp4"
+
+    (result, winner), _ = run(router, {"pytubefix": finishes("file.mp4", delay=0.2), "ytdlp": backup})
+    assert (result, winner) == ("file.mp4", "pytubefix")
+    assert calls == [] and router.hedges == 0
+
+def test_failed_primary_falls_back(router):
+    router.hedge = False
+    (result, winner), _ = run(router, {"pytubefix": fails("bot check"), "ytdlp": finishes("file.mp4")})
+    assert (result, winner) == ("file.mp4", "ytdlp")
+
+def test_error_of_the_last_backend_is_raised(router):
+    router.hedge = False
+    with pytest.raises(RuntimeError, match="also broken"):
+        run(router, {"pytubefix": fails("bot check"), "ytdlp": fails("also broken")})
@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from main import SingleFlight
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_concurrent_callers_share_one_call():
+    async def scenario():
+        flights = SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*(flights.do("k", fetch) for _ in range(5)))
+        return results, calls, flights.stats()
+
+    results, calls, stats = run(scenario())
+    assert results == [1] * 5
+    assert calls == 1
+    assert stats["started"] == 1 and stats["coalesced"] == 4 and stats["in_flight"] == 0
+
+def test_errors_are_shared():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        return await asyncio.gather(flights.do("k", fail), flights.do("k", fail), return_exceptions=True)
+
+    errors = run(scenario())
+    assert [type(e) for e in errors] == [ValueError, ValueError]
+
+def test_different_keys_run_separately():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def value(v):
+            await asyncio.sleep(0.01)
+            return v
+
+        return await asyncio.gather(flights.do("a", lambda: value(1)), flights.do("b", lambda: value(2)))
+
+    assert run(scenario()) == [1, 2]
+
+def test_finished_flight_is_not_reused():
+    async def scenario():
+        flights = SingleFlight()
+        calls = 0
+
+        async def fetch():
+            nonlocal calls
+            calls += 1
+            return calls
+
+        return await flights.do("k", fetch), await flights.do("k", fetch)
+
+    assert run(scenario()) == (1, 2)
+
+def test_task_survives_while_someone_still_waits():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return "done"
+
+        first = asyncio.ensure_future(flights.do("k", fetch))
+        second = asyncio.ensure_future(flights.do("k", fetch))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, flights.stats()["cancelled"]
+
+    assert run(scenario()) == ("done", 0)
+
+def test_task_is_cancelled_when_the_last_waiter_leaves():
+    async def scenario():
+        flights = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def fetch():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.ensure_future(flights.do("k", fetch))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.wait_for(cancelled.wait(), 1)
+        return flights.stats()
+
+    stats = run(scenario())
+    assert stats["cancelled"] == 1 and stats["in_flight"] == 0
+
+def test_caller_arriving_while_a_cancelled_flight_unwinds_starts_a_new_one():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def slow_to_unwind():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                await asyncio.sleep(0.05)
+                raise
+
+        async def fresh():
+            return "fresh"
+
+        caller = asyncio.ensure_future(flights.do("k", slow_to_unwind))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.sleep(0.01)  # the old task is still unwinding
+        return await flights.do("k", fresh)
+
+    assert run(scenario()) == "fresh"
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+import main
+from main import DownloadStore, StreamTeeManager
+
+MP4_HEAD = b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00"
+TS_PACKET = b"\x47\x40\x00\x10" + b"\xff" * 184
+
+@pytest.fixture
+def tees(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DOWNLOADS_DIR", tmp_path)
+    monkeypatch.setattr(main, "download_store", DownloadStore(tmp_path, 10 * 1024 * 1024, 0))
+    manager = StreamTeeManager()
+    monkeypatch.setattr(main, "stream_tees", manager)
+    return manager
+
+async def chunks(*parts):
+    for part in parts:
+        yield part
+
+def stream_through_tee(tees, key, container, *parts):
+    async def scenario():
+        tee = tees.start(key, chunks(*parts), "test", "clip.mp4", "720p", container)
+        body = b"".join([chunk async for chunk in tee.open_reader()])
+        while main.background_tasks_refs:
+            await asyncio.gather(*main.background_tasks_refs)
+        return body
+
+    return asyncio.run(scenario())
+
+def test_completed_stream_is_promoted(tees):
+    body = stream_through_tee(tees, "Youtube:a|best+stream|720p", "mp4", MP4_HEAD, b"\x00" * 1000)
+    assert body == MP4_HEAD + b"\x00" * 1000
+    stored = main.download_store.lookup("Youtube:a|best+stream|720p", "mp4")
+    assert stored is not None and stored[0].read_bytes() == body and stored[2] == "clip.mp4"
+    assert tees.stats()["promoted"] == 1
+
+def test_mpeg_ts_stream_is_not_promoted(tees, tmp_path):
+    body = stream_through_tee(tees, "Youtube:b|best+stream|720p", "mp4", TS_PACKET * 10)
+    assert len(body) == len(TS_PACKET) * 10  # still served to the client
+    assert main.download_store.lookup("Youtube:b|best+stream|720p") is None
+    stats = tees.stats()
+    assert stats["promoted"] == 0 and stats["unservable"] == 1 and stats["discarded"] == 1
+    assert not list(tmp_path.glob(f"{main.TEE_NAME_PREFIX}*"))  # tee file cleaned up
+
+def test_late_reader_follows_the_growing_file(tees):
+    key = "Youtube:c|best+stream|720p"
+    pulls = 0
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def upstream():
+            nonlocal pulls
+            pulls += 1
+            yield MP4_HEAD
+            await gate.wait()
+            yield b"\x01" * 5000
+
+        tee = tees.start(key, upstream(), "test", "clip.mp4", "720p", "mp4")
+        first = tee.open_reader()
+        head = await first.__anext__()
+        follower = tees.get(key)  # what a second request for the same stream finds
+        second = follower.open_reader()
+        gate.set()
+        bodies = [head + b"".join([c async for c in first]), b"".join([c async for c in second])]
+        while main.background_tasks_refs:
+            await asyncio.gather(*main.background_tasks_refs)
+        return follower is tee, bodies
+
+    same, bodies = asyncio.run(scenario())
+    assert same and pulls == 1
+    assert bodies[0] == bodies[1] == MP4_HEAD + b"\x01" * 5000
+    assert tees.stats()["followers"] == 1 and tees.stats()["promoted"] == 1
+
+def test_failed_stream_is_not_promoted(tees):
+    async def broken():
+        yield MP4_HEAD
+        raise main.StreamFailed("ERROR: fragment 3 not found")
+
+    async def scenario():
+        tee = tees.start("Youtube:d|best+stream|720p", broken(), "test", "clip.mp4", "720p", "mp4")
+        body = b"".join([chunk async for chunk in tee.open_reader()])
+        while main.background_tasks_refs:
+            await asyncio.gather(*main.background_tasks_refs)
+        return body
+
+    assert asyncio.run(scenario()) == MP4_HEAD
+    assert main.download_store.lookup("Youtube:d|best+stream|720p") is None
+    assert tees.stats()["promoted"] == 0 and tees.stats()["discarded"] == 1
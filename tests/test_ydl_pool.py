@@ -0,0 +1,58 @@
+import pytest
+
+from main import YoutubeDLPool
+
+PARAMS = {"quiet": True, "no_warnings": True}
+
+@pytest.fixture
+def pool():
+    return YoutubeDLPool(max_idle=2, max_uses=3)
+
+def test_instances_are_reused_per_profile(pool):
+    with pool.checkout(PARAMS) as first:
+        pass
+    with pool.checkout(PARAMS) as second:
+        assert second is first
+    with pool.checkout({**PARAMS, "socket_timeout": 5}) as other:
+        assert other is not first
+    assert pool.stats()["created"] == 2 and pool.stats()["reused"] == 1
+
+def test_request_state_is_dropped_on_return(pool):
+    hook = lambda d: None
+    with pool.checkout({**PARAMS, "outtmpl": "/tmp/x.%(ext)s", "format": "best", "progress_hooks": [hook]}) as ydl:
+        assert ydl.params["outtmpl"]["default"] == "/tmp/x.%(ext)s"
+        assert hook in ydl._progress_hooks
+    with pool.checkout(PARAMS) as again:
+        assert again is ydl
+        assert again.params["outtmpl"].get("default") != "/tmp/x.%(ext)s"
+        assert "format" not in again.params
+        assert hook not in again._progress_hooks
+
+def test_instance_that_raised_is_recycled(pool):
+    with pytest.raises(RuntimeError):
+        with pool.checkout(PARAMS) as ydl:
+            raise RuntimeError("boom")
+    with pool.checkout(PARAMS) as again:
+        assert again is not ydl
+    assert pool.stats()["recycled"] == 1
+
+def test_failed_reset_recycles_instead_of_failing_the_request(pool, monkeypatch):
+    def broken_reset(ydl, saved_outtmpl, params):
+        raise AttributeError("'YoutubeDL' object has no attribute '_playlist_urls'")
+
+    monkeypatch.setattr(YoutubeDLPool, "_reset", staticmethod(broken_reset))
+    with pool.checkout(PARAMS) as ydl:
+        result = "extracted"
+    assert result == "extracted"
+    monkeypatch.undo()
+    with pool.checkout(PARAMS) as again:
+        assert again is not ydl
+    stats = pool.stats()
+    assert stats["reset_failures"] == 1 and stats["recycled"] == 1
+
+def test_instances_are_recycled_after_max_uses(pool):
+    seen = []
+    for _ in range(4):
+        with pool.checkout(PARAMS) as ydl:
+            seen.append(ydl)
+    assert seen[0] is seen[1] is seen[2] and seen[3] is not seen[0]
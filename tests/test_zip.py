@@ -0,0 +1,110 @@
+import asyncio
+import io
+import struct
+import time
+import zipfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import ZIP32_LIMIT, iter_zip, zip_central_entry, zip_end_records, zip_length, zip_member_name
+
+LOCAL_HEADER = 30
+CENTRAL_ENTRY = 46
+ZIP64_LOCAL_EXTRA = 20
+ZIP64_CENTRAL_EXTRA = 28
+DESCRIPTOR, ZIP64_DESCRIPTOR = 16, 24
+END_RECORD, ZIP64_END_RECORD, ZIP64_LOCATOR = 22, 56, 20
+
+@pytest.fixture
+def media_files():
+    paths = []
+    for name, data in (("a.mp4", b"a" * 1000), ("b.mp3", bytes(range(256)) * 10), ("empty.txt", b"")):
+        path = main.DOWNLOADS_DIR / name
+        path.write_bytes(data)
+        paths.append(path)
+    yield paths
+    for path in paths:
+        path.unlink()
+
+async def collect(ready):
+    return b"".join([chunk async for chunk in iter_zip(ready, [])])
+
+def test_archive_matches_its_predicted_length_and_unpacks(media_files):
+    ready = [(path, path.stat().st_size) for path in media_files]
+    archive = asyncio.run(collect(ready))
+    assert len(archive) == zip_length([(path.name.encode(), size) for path, size in ready])
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        assert zf.testzip() is None  # CRCs from the data descriptors check out
+        assert zf.namelist() == [path.name for path in media_files]
+        for path in media_files:
+            assert zf.read(path.name) == path.read_bytes()
+
+def test_repeated_names_get_a_suffix():
+    taken = set()
+    names = [zip_member_name(Path(p), taken) for p in ("x/clip.mp4", "y/clip.mp4", "z/clip.mp4", "clip (1).mp4")]
+    assert names == ["clip.mp4", "clip (1).mp4", "clip (2).mp4", "clip (1) (1).mp4"]
+
+def test_small_archive_layout():
+    name = b"clip.mp4"
+    expected = (LOCAL_HEADER + len(name) + 100 + DESCRIPTOR) + (CENTRAL_ENTRY + len(name)) + END_RECORD
+    assert zip_length([(name, 100)]) == expected
+
+def test_zip64_layout():
+    big, small = b"big.mp4", b"small.mp4"
+    big_size = 5 * 1024 ** 3
+    # The big member needs ZIP64 for its size, the small one for its offset past 4 GiB,
+    # and the archive for its central directory offset
+    expected = (
+        LOCAL_HEADER + len(big) + ZIP64_LOCAL_EXTRA + big_size + ZIP64_DESCRIPTOR
+        + LOCAL_HEADER + len(small) + ZIP64_LOCAL_EXTRA + 10 + ZIP64_DESCRIPTOR
+        + CENTRAL_ENTRY + len(big) + ZIP64_CENTRAL_EXTRA
+        + CENTRAL_ENTRY + len(small) + ZIP64_CENTRAL_EXTRA
+        + ZIP64_END_RECORD + ZIP64_LOCATOR + END_RECORD
+    )
+    assert zip_length([(big, big_size), (small, 10)]) == expected
+
+def test_zip64_central_entry_moves_sizes_and_offset_into_the_extra_field():
+    name = b"big.mp4"
+    entry = zip_central_entry(name, 5 * 1024 ** 3, 0x1234, 0, 6 * 1024 ** 3, zip64=True)
+    fields = struct.unpack("<IHHHHHHIIIHHHHHII", entry[:CENTRAL_ENTRY])
+    assert fields[0] == 0x02014b50
+    assert fields[7] == 0x1234
+    assert fields[8] == fields[9] == ZIP32_LIMIT  # sizes
+    assert fields[16] == ZIP32_LIMIT  # local header offset
+    assert entry[CENTRAL_ENTRY:CENTRAL_ENTRY + len(name)] == name
+    assert struct.unpack("<HHQQQ", entry[CENTRAL_ENTRY + len(name):]) == (0x0001, 24, 5 * 1024 ** 3, 5 * 1024 ** 3, 6 * 1024 ** 3)
+
+def test_zip64_end_records_point_at_the_central_directory():
+    cd_offset, cd_size = 5 * 1024 ** 3, 200
+    records = zip_end_records(2, cd_offset, cd_size)
+    assert len(records) == ZIP64_END_RECORD + ZIP64_LOCATOR + END_RECORD
+    zip64_end = struct.unpack("<IQHHIIQQQQ", records[:ZIP64_END_RECORD])
+    assert zip64_end[0] == 0x06064b50
+    assert zip64_end[6:] == (2, 2, cd_size, cd_offset)
+    locator = struct.unpack("<IIQI", records[ZIP64_END_RECORD:ZIP64_END_RECORD + ZIP64_LOCATOR])
+    assert locator == (0x07064b50, 0, cd_offset + cd_size, 1)
+
+def test_endpoint_content_length_is_exact(media_files):
+    client = TestClient(main.app)
+    response = client.get("/video/zip", params={"file": [path.name for path in media_files]})
+    assert response.status_code == 200
+    assert int(response.headers["Content-Length"]) == len(response.content)
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        assert zf.testzip() is None
+
+def test_endpoint_names_jobs_whose_file_is_gone(media_files, monkeypatch):
+    def finished_job(job_id, path):
+        return SimpleNamespace(id=job_id, status="finished", done=True, finished_at=time.time(),
+                               result={"filepath": str(path)})
+
+    monkeypatch.setitem(main.jobs._jobs, "kept", finished_job("kept", media_files[0]))
+    monkeypatch.setitem(main.jobs._jobs, "evicted", finished_job("evicted", main.DOWNLOADS_DIR / "evicted.mp4"))
+    client = TestClient(main.app)
+    response = client.get("/video/zip", params={"job": ["kept", "evicted"]})
+    assert response.status_code == 404
+    assert "evicted" in response.json()["detail"] and "kept" not in response.json()["detail"]
+    assert client.get("/video/zip", params={"job": ["kept"]}).status_code == 200